@@ -1,121 +1,14 @@
 # -*- coding:utf8 -*-
-import re
+import os
+import sys
 
 from flask import Flask
 
-from flask_sqlalchemy import SQLAlchemy as BaseSQLAlchemy
-from flask_sqlalchemy import _SignallingSession as BaseSignallingSession
-from flask_sqlalchemy import orm, partial, get_state
-
 from datetime import datetime
 
-class _BindingKeyPattern(object):
-    def __init__(self, pattern):
-        self.raw_pattern = pattern
-        self.compiled_pattern = re.compile(pattern)
-
-    def __repr__(self):
-        return "%s<%s>" % (self.__class__.__name__, self.raw_pattern)
-
-    def match(self, key):
-        return self.compiled_pattern.match(key)
-
-
-class _BoundSection(object):
-    def __init__(self, db_session_cls, name):
-        self.db_session = db_session_cls()
-        self.name = name
-
-    def __enter__(self):
-        self.db_session.push_binding(self.name)
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self.db_session.pop_binding()
-        self.db_session.close()
-
-
-class _SignallingSession(BaseSignallingSession):
-    def __init__(self, *args, **kwargs):
-        BaseSignallingSession.__init__(self, *args, **kwargs)
-        self._binding_keys = []
-        self._binding_key = None
-
-    def push_binding(self, key):
-        self._binding_keys.append(self._binding_key)
-        self._binding_key = key
-
-    def pop_binding(self):
-        self._binding_key = self._binding_keys.pop()
-
-    def get_bind(self, mapper, clause=None):
-        binding_key = self.__find_binding_key(mapper)
-        if binding_key is None:
-            return BaseSignallingSession.get_bind(self, mapper, clause)
-        else:
-            state = get_state(self.app)
-            return state.db.get_engine(self.app, bind=binding_key)
-
-    def __find_binding_key(self, mapper):
-        if mapper is None: # 맵퍼 없음
-            return self._binding_key
-        else:
-            mapper_info = getattr(mapper.mapped_table, 'info', {})
-            mapped_binding_key = mapper_info.get('bind_key')
-            if mapped_binding_key: # 맵핑된 바인딩 키 존재
-                if type(mapped_binding_key) is str: # 정적 바인딩
-                    return mapped_binding_key
-                else: # 동적 바인딩
-                    if mapped_binding_key.match(self._binding_key): # 현재 바인딩
-                        return self._binding_key
-                    else: # 푸쉬된 바인딩
-                        for pushed_binding_key in reversed(self._binding_keys):
-                            if pushed_binding_key and mapped_binding_key.match(pushed_binding_key):
-                                return pushed_binding_key
-                        else:
-                            raise Exception('NOT_FOUND_MAPPED_BINDING:%s CURRENT_BINDING:%s PUSHED_BINDINGS:%s' % (repr(mapped_binding_key), repr(self._binding_key), repr(self._binding_keys[1:])))
-            else: # 맵핑된 바인딩 키가 없으면 디폴트 바인딩
-                return self._binding_key
-
-
-class SQLAlchemy(BaseSQLAlchemy):
-    def BindingKeyPattern(self, pattern):
-        return _BindingKeyPattern(pattern)
-    
-    def binding(self, key):
-        return _BoundSection(self.session, key)
-
-    def create_scoped_session(self, options=None):
-        if options is None:
-            options = {}
-        scopefunc=options.pop('scopefunc', None)
-        return orm.scoped_session(
-            partial(_SignallingSession, self, **options), scopefunc=scopefunc
-        )
-
-    def get_binds(self, app=None):
-        retval = BaseSQLAlchemy.get_binds(self, app)
-       
-        bind = None
-        engine = self.get_engine(app, bind)
-        tables = self.get_tables_for_bind(bind)
-        retval.update(dict((table, engine) for table in tables))
-        return retval
-
-    def get_tables_for_bind(self, bind=None):
-        result = []
-        for table in self.Model.metadata.tables.itervalues():
-            table_bind_key = table.info.get('bind_key')
-            if table_bind_key == bind:
-                result.append(table)
-            else:
-                if bind:
-                    if type(table_bind_key) is _BindingKeyPattern and table_bind_key.match(bind):
-                        result.append(table)
-                    elif type(table_bind_key) is str and table_bind_key == bind:
-                        result.append(table)
-
-        return result
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'server'))
 
+from database import SQLAlchemy
 
 app = Flask(__name__)
 db = SQLAlchemy(app)
@@ -153,8 +46,6 @@ class LoginLog(db.Model):
         return "%s<id=%d, uer_id=%d, ctime='%s'>" % (self.__class__.__name__, self.id, self.user_id, repr(self.ctime))
 
 if __name__ == '__main__':
-    import os
-
     app.config['SQLALCHEMY_ECHO'] = True
     app.config['SQLALCHEMY_BINDS'] = {
         'global': 'sqlite:///./global.db',
@@ -163,6 +54,10 @@ if __name__ == '__main__':
         'master_log':  'sqlite:///./master_log.db', 
         'slave_log':  'sqlite:///./slave_log.db', 
     }
+    app.config['SQLALCHEMY_REPLICAS'] = {
+        'master_user': ['slave_user'],
+        'master_log': ['slave_log'],
+    }
         
     db.drop_all()
     db.create_all()
@@ -171,26 +66,28 @@ if __name__ == '__main__':
     db.session.add(notice)
     db.session.commit()
 
-    with db.binding('master_user'):
-        notice = Notice(msg='NOTICE2')
-        db.session.add(notice)
-        db.session.commit()
-
-        user = User(nickname='jaru')
-        db.session.add(user)
-        db.session.commit()
-
-        with db.binding('master_log'):
-            notice = Notice(msg='NOTICE3')
+    with db.unit_of_work(): # 아래 commit 은 flush 만 하고 global, master_user, master_log 를 끝에서 한꺼번에 커밋한다
+        with db.binding('master_user'):
+            notice = Notice(msg='NOTICE2')
             db.session.add(notice)
             db.session.commit()
 
-            login_log = LoginLog(owner=user)
-            db.session.add(login_log)
+            user = User(nickname='jaru')
+            db.session.add(user)
             db.session.commit()
 
-    os.system('sqlite3 master_user.db ".backup slave_user.db"')
-    os.system('sqlite3 master_log.db ".backup slave_log.db"')
+            with db.binding('master_log'):
+                notice = Notice(msg='NOTICE3')
+                db.session.add(notice)
+                db.session.commit()
+
+                login_log = LoginLog(owner=user)
+                db.session.add(login_log)
+                db.session.commit()
+
+    # 마스터를 잠그지 않고 조금씩 복사한 스냅샷으로 복제본을 바꾼다
+    # SQLALCHEMY_REPLICA_REFRESH 의 interval 을 주면 db.start_replica_monitor() 가 주기적으로 한다
+    print db.refresh_replicas()
 
     with db.binding('master_user'):
         user = User.query.filter_by(nickname='jaru').first()
@@ -198,12 +95,13 @@ if __name__ == '__main__':
         db.session.add(user)
         db.session.commit()
 
-    with db.binding('master_user'):
-        print User.query.all()
+    db.session.remove() # 요청 종료: 마스터 고정 해제
 
-    with db.binding('slave_user'):
+    with db.binding('master_user'): # 읽기는 slave_user 로 간다
         print User.query.all()
 
-    with db.binding('slave_log'):
+    with db.binding('master_log'):
         print LoginLog.query.all()
 
+    print db.check_replicas()
+    print db.get_replica_ages()
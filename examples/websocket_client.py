@@ -1,4 +1,13 @@
+import sys
+
 from websocket import create_connection
+
+if len(sys.argv) > 1 and sys.argv[1] == 'notices':
+    ws = create_connection("ws://localhost:8000/notices")
+    print "Waiting notices..."
+    while True:
+        print "Received '%s'" % ws.recv()
+
 ws = create_connection("ws://localhost:8000/echo")
 print "Sending 'Hello, World'..."
 ws.send("Hello, World")
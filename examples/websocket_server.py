@@ -1,8 +1,28 @@
-from flask import Flask
+# -*- coding:utf8 -*-
+import os
+import sys
+import ujson
+
+from flask import Flask, request
 from flask_sockets import Sockets
 
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'server'))
+
+from database import SQLAlchemy
+from broadcast import BroadcastHub
+
 app = Flask(__name__)
+app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///./websocket_notice.db'
 sockets = Sockets(app)
+db = SQLAlchemy(app)
+hub = BroadcastHub(queue_size=100, policy=BroadcastHub.POLICY_COALESCE)
+
+class Notice(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    msg = db.Column(db.String, nullable=False)
+    ctime = db.Column(db.DateTime, default=datetime.now, nullable=False)
 
 @sockets.route('/echo')
 def echo_socket(ws):
@@ -10,6 +30,28 @@ def echo_socket(ws):
         message = ws.receive()
         ws.send(message)
 
+@sockets.route('/notices')
+def notice_socket(ws):
+    hub.serve(ws, ['notice'])
+
+@app.route('/notice', methods=['POST']) # flask_sockets 는 같은 경로의 http 요청도 가로챈다
+def post_notice():
+    notice = Notice(msg=request.form['msg'])
+    db.session.add(notice)
+    db.session.commit()
+    return str(hub.publish('notice', dict(id=notice.id, msg=notice.msg, ctime=notice.ctime.isoformat())))
+
+@app.route('/metrics')
+def metrics():
+    return ujson.dumps(hub.get_metrics())
+
 @app.route('/')
 def hello():
     return 'Hello World!'
+
+if __name__ == '__main__':
+    from gevent import pywsgi
+    from geventwebsocket.handler import WebSocketHandler
+
+    db.create_all()
+    pywsgi.WSGIServer(('', 8000), app, handler_class=WebSocketHandler).serve_forever()
@@ -1,39 +1,46 @@
 #!/usr/bin/env python
 # -*- coding:utf8 -*-
 import os
+import atexit
 import sys
 import code
 import argparse
 import unittest
 
-try:
-    import server
-    import server.blog
-except ImportError as e:
-    print(e)
-    print('')
-
-    venv_dir_path = os.environ.get('VIRTUAL_ENV', None)
-    if venv_dir_path is None:
-        workon_home_dir_path = os.environ.get('WORKON_HOME', None)
-        if workon_home_dir_path is None:
-            print('\t$ sudo pip install virtualenvwrapper')
-            print('')
-            print('\t$ vim ~/.bash_profile')
-            print('\texport WORKON_HOME=~/VIRTUAL_ENVIRONEMNT_ROOT')
-            print('\tsource /usr/local/bin/virtualenvwrapper.sh')
-            sys.exit(-1)
+server = None
+
+def import_server():
+    "server 패키지는 필요한 명령에서만 불러온다"
+    global server
+    try:
+        import server
+    except ImportError as e:
+        print(e)
+        print('')
+
+        venv_dir_path = os.environ.get('VIRTUAL_ENV', None)
+        if venv_dir_path is None:
+            workon_home_dir_path = os.environ.get('WORKON_HOME', None)
+            if workon_home_dir_path is None:
+                print('\t$ sudo pip install virtualenvwrapper')
+                print('')
+                print('\t$ vim ~/.bash_profile')
+                print('\texport WORKON_HOME=~/VIRTUAL_ENVIRONEMNT_ROOT')
+                print('\tsource /usr/local/bin/virtualenvwrapper.sh')
+                sys.exit(-1)
+            else:
+                print('make virtual environment')
+                print('\t$ mkvirtualenv [VIRTUAL_ENV_NAME]')
+                print('')
+                print('or work on virtual environment')
+                print('\t$ workon [VIRTUAL_ENV_NAME]')
+                sys.exit(-2)
         else:
-            print('make virtual environment')
-            print('\t$ mkvirtualenv [VIRTUAL_ENV_NAME]')
-            print('')
-            print('or work on virtual environment')
-            print('\t$ workon [VIRTUAL_ENV_NAME]')
-            sys.exit(-2)
-    else:
-        print('install requirements')
-        print('\t$ pip install -r requirements.txt')
-        raise
+            print('install requirements')
+            print('\t$ pip install -r requirements.txt')
+            raise
+
+    return server
 
 def exec_command_line(exe_path, args):
     cmd_line = '%s %s' % (exe_path, ' '.join(args))
@@ -51,20 +58,32 @@ def install_package(ns):
     exec_command_line('pip', ['freeze', '> requirements.txt'])
 
 def reset_all_databases(ns):
+    server.create_app()
     print '#### reset all databases'
     print '* config_path: %s' % ns.config_path
     print '* database uri: %s' % server.app.config['SQLALCHEMY_DATABASE_URI']
     for key, value in sorted(server.app.config['SQLALCHEMY_BINDS'].iteritems()):
         print ' * bind_key: %s uri:%s' % (key, value)
 
+    def report(operation, results):
+        for bind_key, table_count, elapsed, created_names in sorted(results, key=lambda result: result[0] or ''):
+            line = '* %s %s: %d tables %.1fms' % (operation, bind_key or 'default', table_count, elapsed * 1000)
+            if created_names:
+                line += ' created: %s' % ', '.join(created_names)
+            print line
+
+    if ns.missing_only: # 지우지 않으므로 암호를 묻지 않는다
+        report('create_missing', server.db.create_missing(parallel=not ns.serial))
+        return
+
     print '* reset_all_password:',
     password = raw_input()
     if password != server.app.config['RESET_ALL_PASSWORD']:
         print 'WRONG_DROP_ALL_PASSWORD'
         return -102
 
-    server.db.drop_all() 
-    server.db.create_all()
+    report('drop_all', server.db.drop_all(parallel=not ns.serial))
+    report('create_all', server.db.create_all(parallel=not ns.serial))
 
 def run_script(ns):
     if not ns.source_paths:
@@ -75,13 +94,191 @@ def run_script(ns):
         execfile(source_path, globals())
 
 def run_shell(ns):
+    server.create_app()
     code.interact('SHELL', local=dict(server=server))
 
 def run_server(ns):
+    server.app.config['SERVER_WORKERS'] = ns.workers
+    if ns.workers > 0: # 운영 모드
+        server.app.config['DEBUG'] = False
+        server.app.config['SQLALCHEMY_ECHO'] = False
+
+    if ns.profile_sql:
+        server.app.config['SQLALCHEMY_PROFILE'] = True
+        atexit.register(server.sql_profiler.dump, server.app) # 워커도 물려받아 끝날 때 pid 별로 남긴다
+
     server.env.prepare_all()
 
-    server.app.register_blueprint(server.blog.bp)
-    server.app.run('0.0.0.0', port=ns.port)
+    server.create_app()
+
+    if ns.workers > 0:
+        from server.serving import GunicornServer
+        GunicornServer(server.app, server.db, dict(
+            bind='0.0.0.0:%d' % ns.port,
+            workers=ns.workers,
+            worker_class=ns.worker_class,
+            preload_app=ns.preload,
+            backlog=ns.backlog)).run()
+    else:
+        server.db.start_replica_monitor()
+        server.app.run('0.0.0.0', port=ns.port)
+
+def bench(ns):
+    from server.bench import BenchSuite, save_results, load_results
+
+    baseline = load_results(ns.baseline) if ns.baseline else {}
+    regressions = []
+
+    def report(result):
+        line = '* %-26s %12.0f ops/s  p50: %9.1fus  p99: %9.1fus' % (result.name, result.ops_per_sec, result.p50_us, result.p99_us)
+        if result.name in baseline:
+            ratio = result.ops_per_sec / baseline[result.name]['ops_per_sec']
+            line += '  x%.2f' % ratio
+            if ratio < 1.0 - ns.tolerance:
+                line += ' REGRESSION'
+                regressions.append(result.name)
+        print line
+
+    print '#### bench'
+    results = BenchSuite(server, iterations=ns.iterations).run(ns.filter, report)
+    if ns.save:
+        save_results(results, ns.save)
+        print '* saved: %s' % ns.save
+
+    if regressions:
+        return -105
+
+def ingest(ns):
+    import json
+    from server.ingest import BulkIngester
+
+    server.create_app()
+    model = server.db.Model._decl_class_registry.get(ns.model_name)
+    if model is None:
+        print 'NOT_FOUND_MODEL:%s' % ns.model_name
+        return -106
+
+    ingester = BulkIngester(server.db, model, batch_size=ns.batch_size, shard_column=ns.shard_column, binding_key=ns.binding)
+    input_file = sys.stdin if ns.input_path == '-' else open(ns.input_path)
+    try:
+        rows = (ingester.coerce_row(json.loads(line)) for line in input_file if line.strip())
+        result = ingester.ingest(rows)
+    finally:
+        if input_file is not sys.stdin:
+            input_file.close()
+
+    print '#### ingest %s' % ns.model_name
+    for binding_key, row_count in sorted(result.bind_row_counts.iteritems()):
+        print '* %s: %d rows' % (binding_key or 'default', row_count)
+    print '* total: %d rows %d batches %.2fs %.0f rows/s' % (result.row_count, result.batch_count, result.elapsed, result.rows_per_sec)
+
+def rebalance_shards(ns):
+    from server.rebalance import ShardRebalancer
+
+    server.create_app()
+    model = server.db.Model._decl_class_registry.get(ns.model_name)
+    if model is None:
+        print 'NOT_FOUND_MODEL:%s' % ns.model_name
+        return -106
+
+    checkpoint_path = ns.checkpoint or os.path.join(server.app.config['TEMP_DIR_PATH'], 'rebalance.%s.json' % model.__tablename__)
+    rebalancer = ShardRebalancer(server.db, model, ns.shard_column, batch_size=ns.batch_size, throttle=ns.throttle, checkpoint_path=checkpoint_path)
+
+    print '#### rebalance shards %s.%s' % (ns.model_name, ns.shard_column)
+    for (source_key, target_key), row_count in sorted(rebalancer.plan().iteritems()):
+        print '* plan: %s -> %s %d rows' % (source_key, target_key, row_count)
+    if ns.dry_run:
+        return
+
+    before_counts = rebalancer.count()
+    if not os.access(os.path.dirname(checkpoint_path), os.R_OK):
+        os.makedirs(os.path.dirname(checkpoint_path))
+    result = rebalancer.run(max_passes=ns.max_passes)
+    after_counts = rebalancer.count()
+
+    for (source_key, target_key), row_count in sorted(result.moves.iteritems()):
+        print '* moved: %s -> %s %d rows' % (source_key, target_key, row_count)
+    for shard_key, (row_count, misplaced_count) in sorted(after_counts.iteritems()):
+        print '* %s: %d rows (before: %d) misplaced: %d' % (shard_key, row_count, before_counts.get(shard_key, (0, 0))[0], misplaced_count)
+    print '* total: scanned %d moved %d changed %d %.2fs' % (result.scanned_count, result.moved_count, result.changed_count, result.elapsed)
+
+    before_total = sum(row_count for row_count, misplaced_count in before_counts.itervalues())
+    after_total = sum(row_count for row_count, misplaced_count in after_counts.itervalues())
+    if before_total != after_total or any(misplaced_count for row_count, misplaced_count in after_counts.itervalues()):
+        print 'REBALANCE_VERIFY_FAILED:%d->%d' % (before_total, after_total)
+        return -107
+
+def import_profile(ns):
+    import time
+    import __builtin__
+
+    module_times = {}
+    child_times = [0.0]
+
+    def get_module_name(name, importer_globals, level):
+        # 상대 import 는 부르는 쪽 패키지 이름을 붙인다
+        package_name = importer_globals.get('__package__')
+        if not package_name and '__name__' in importer_globals:
+            package_name = importer_globals['__name__'] if '__path__' in importer_globals else importer_globals['__name__'].rpartition('.')[0]
+        if not package_name or level == 0:
+            return name
+
+        if level > 0: # from ..name import
+            package_parts = package_name.split('.')
+            return '.'.join(package_parts[:len(package_parts) - level + 1] + ([name] if name else []))
+
+        qualified_name = '%s.%s' % (package_name, name) # 암시적 상대 import, 실패한 것은 None 으로 남는다
+        return qualified_name if sys.modules.get(qualified_name) is not None else name
+    original_import = __builtin__.__import__
+
+    def timed_import(name, globals=None, locals=None, fromlist=None, level=-1):
+        # 처음 불러오는 모듈만 누적 시간과 자체 시간을 남긴다
+        module_count = len(sys.modules)
+        child_times.append(0.0)
+        start_time = time.time()
+        try:
+            return original_import(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.time() - start_time
+            nested_elapsed = child_times.pop()
+            child_times[-1] += elapsed
+            if len(sys.modules) != module_count: # 실패한 상대 import 자리(None)도 세므로 가장 오래 걸린 것을 남긴다
+                module_name = get_module_name(name, globals or {}, level)
+                if elapsed > module_times.get(module_name, (0.0, 0.0))[0]:
+                    module_times[module_name] = (elapsed, elapsed - nested_elapsed)
+
+    start_time = time.time()
+    __builtin__.__import__ = timed_import
+    try:
+        for module_name in ns.module_names:
+            __import__(module_name)
+    finally:
+        __builtin__.__import__ = original_import
+    total_time = time.time() - start_time
+
+    print '#### import profile: %s' % ' '.join(ns.module_names)
+    for name, (cumulative_time, self_time) in sorted(module_times.iteritems(), key=lambda item: -item[1][0])[:ns.top]:
+        print '* %-48s cumulative: %8.1fms  self: %8.1fms' % (name, cumulative_time * 1000, self_time * 1000)
+    print '* total: %.1fms %d modules' % (total_time * 1000, len(module_times))
+
+def dump_sql_profile(ns):
+    from server.profiler import SQLProfiler
+    reports = SQLProfiler.load_dumps(server.app.config['TEMP_DIR_PATH'])
+    if not reports:
+        print 'NO_SQL_PROFILE'
+        return -104
+
+    for report in reports:
+        print '#### pid: %d requests: %d' % (report['pid'], report['request_count'])
+        for bind_name, bind_total in sorted(report['binds'].iteritems()):
+            print '* %s: %d queries total: %.1fms slowest: %.1fms' % (bind_name, bind_total['count'], bind_total['total_time'] * 1000, bind_total['slowest_time'] * 1000)
+        for repeated_key, count in sorted(report['repeated'].iteritems(), key=lambda item: -item[1]):
+            print ' * repeated x%d: %s' % (count, repeated_key)
+
+def test_server(ns):
+    import server.tests
+    suite = unittest.TestLoader().loadTestsFromModule(server.tests)
+    unittest.TextTestRunner(verbosity=2).run(suite)
 
 def test_blog(ns):
     from server.blog.tests import BlogTestCase
@@ -96,9 +293,11 @@ def main(program_path, program_args):
 
     install_package_parser = sub_parsers.add_parser('install_package')
     install_package_parser.add_argument('package_names', type=str, nargs='+', help='package names')
-    install_package_parser.set_defaults(func=install_package)
+    install_package_parser.set_defaults(func=install_package, needs_server=False)
 
     reset_all_databases_parser = sub_parsers.add_parser('reset_all_databases')
+    reset_all_databases_parser.add_argument('--missing-only', action='store_true', help='only create missing tables and indexes') 
+    reset_all_databases_parser.add_argument('--serial', action='store_true', help='run ddl one bind at a time') 
     reset_all_databases_parser.set_defaults(func=reset_all_databases)
 
     run_script_parser = sub_parsers.add_parser('run_script')
@@ -107,11 +306,53 @@ def main(program_path, program_args):
 
     run_server_parser = sub_parsers.add_parser('run_server')
     run_server_parser.add_argument('-P', '--port', type=int, default=5000, help='port') 
+    run_server_parser.add_argument('-W', '--workers', type=int, default=0, help='gunicorn worker count (0: development server)') 
+    run_server_parser.add_argument('--worker-class', type=str, default='sync', choices=['sync', 'gevent'], help='gunicorn worker class') 
+    run_server_parser.add_argument('--preload', action='store_true', help='load application before forking workers') 
+    run_server_parser.add_argument('--backlog', type=int, default=2048, help='listen backlog') 
+    run_server_parser.add_argument('--profile-sql', action='store_true', help='enable per-request sql profiler') 
     run_server_parser.set_defaults(func=run_server)
 
+    bench_parser = sub_parsers.add_parser('bench')
+    bench_parser.add_argument('-n', '--iterations', type=int, default=2000, help='iterations per benchmark') 
+    bench_parser.add_argument('-k', '--filter', type=str, default=None, help='benchmark name filter') 
+    bench_parser.add_argument('--save', type=str, default=None, help='save results as json') 
+    bench_parser.add_argument('--baseline', type=str, default=None, help='compare with saved json results') 
+    bench_parser.add_argument('--tolerance', type=float, default=0.1, help='allowed slowdown ratio before REGRESSION') 
+    bench_parser.set_defaults(func=bench)
+
+    ingest_parser = sub_parsers.add_parser('ingest')
+    ingest_parser.add_argument('model_name', type=str, help='model class name') 
+    ingest_parser.add_argument('input_path', type=str, help='json lines path (-: stdin)') 
+    ingest_parser.add_argument('-b', '--batch-size', type=int, default=1000, help='rows per insert transaction') 
+    ingest_parser.add_argument('--shard-column', type=str, default=None, help='column resolving the shard key') 
+    ingest_parser.add_argument('--binding', type=str, default=None, help='binding key for pattern bound models') 
+    ingest_parser.set_defaults(func=ingest)
+
+    rebalance_shards_parser = sub_parsers.add_parser('rebalance_shards')
+    rebalance_shards_parser.add_argument('model_name', type=str, help='sharded model class name') 
+    rebalance_shards_parser.add_argument('shard_column', type=str, help='column resolving the shard key') 
+    rebalance_shards_parser.add_argument('-b', '--batch-size', type=int, default=500, help='rows per primary key batch') 
+    rebalance_shards_parser.add_argument('--throttle', type=float, default=0.0, help='seconds to sleep between batches') 
+    rebalance_shards_parser.add_argument('--max-passes', type=int, default=3, help='passes for rows changed while moving') 
+    rebalance_shards_parser.add_argument('--checkpoint', type=str, default=None, help='checkpoint json path (default: temp/rebalance.<table>.json)') 
+    rebalance_shards_parser.add_argument('--dry-run', action='store_true', help='only print the move plan') 
+    rebalance_shards_parser.set_defaults(func=rebalance_shards)
+
+    import_profile_parser = sub_parsers.add_parser('import_profile')
+    import_profile_parser.add_argument('module_names', type=str, nargs='*', default=['server', 'server.blog'], help='module names') 
+    import_profile_parser.add_argument('-n', '--top', type=int, default=30, help='number of slowest modules to show') 
+    import_profile_parser.set_defaults(func=import_profile, needs_server=False)
+
+    dump_sql_profile_parser = sub_parsers.add_parser('dump_sql_profile')
+    dump_sql_profile_parser.set_defaults(func=dump_sql_profile)
+
     run_shell_parser = sub_parsers.add_parser('run_shell')
     run_shell_parser.set_defaults(func=run_shell)
 
+    test_server_parser = sub_parsers.add_parser('test_server')
+    test_server_parser.set_defaults(func=test_server)
+
     test_blog_parser = sub_parsers.add_parser('test_blog')
     test_blog_parser.set_defaults(func=test_blog)
 
@@ -120,7 +361,8 @@ def main(program_path, program_args):
         return -1
 
     ns = main_parser.parse_args(program_args)
-    server.env.load_config_file(ns.config_path)
+    if getattr(ns, 'needs_server', True):
+        import_server().env.load_config_file(ns.config_path)
     return ns.func(ns)
 
 if __name__ == '__main__':
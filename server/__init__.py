@@ -1,15 +1,22 @@
+# -*- coding:utf8 -*-
 import os
+import importlib
 
 from flask import Flask
-from flask.ext.login import LoginManager
-from flask.ext.openid import OpenID
 from environments import Environments
 from database import SQLAlchemy
+from profiler import SQLProfiler
 
 app = Flask(__name__)
 env = Environments(app, os.path.dirname(os.path.realpath(__file__)))
 db = SQLAlchemy(app)
-oid = OpenID(app, env.temp_dir_path)
-lm = LoginManager()
-lm.init_app(app)
+sql_profiler = SQLProfiler(db, app)
+
+def create_app(blueprint_names=('blog',)):
+    "블루프린트와 로그인 확장은 필요한 명령에서만 불러와 붙인다"
+    for blueprint_name in blueprint_names:
+        if blueprint_name not in app.blueprints:
+            app.register_blueprint(importlib.import_module('server.' + blueprint_name).bp)
+
+    return app
 
@@ -0,0 +1,208 @@
+# -*- coding:utf8 -*-
+import os
+import json
+import time
+import shutil
+import tempfile
+
+from flask import Flask
+
+
+class BenchResult(object):
+    "latencies 는 연산 하나씩 잰 초"
+
+    def __init__(self, name, latencies):
+        latencies = sorted(latencies)
+        self.name = name
+        self.iterations = len(latencies)
+        self.ops_per_sec = len(latencies) / sum(latencies) if sum(latencies) else 0.0
+        self.p50_us = latencies[len(latencies) // 2] * 1000000
+        self.p99_us = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000000
+
+    def __repr__(self):
+        return "%s<%s %.0f ops/s>" % (self.__class__.__name__, self.name, self.ops_per_sec)
+
+    def to_dict(self):
+        return dict(iterations=self.iterations, ops_per_sec=self.ops_per_sec, p50_us=self.p50_us, p99_us=self.p99_us)
+
+
+class BenchSuite(object):
+    """라우팅과 ORM 경로를 로컬 SQLite 로 측정한다
+    bench_* 는 준비를 마치면 한 번, 그 뒤로 연산마다 한 번 yield 한다"""
+
+    SHARD_COUNT = 16
+    TABLES_FOR_BIND_COUNT = 300
+
+    def __init__(self, server_module, iterations=2000, batch_size=10):
+        self.server = server_module
+        self.iterations = iterations
+        self.batch_size = batch_size
+        self.benches = [
+            ('get_bind', self._prepare_routing, self.bench_get_bind),
+            ('binding_push_pop', self._prepare_routing, self.bench_binding_push_pop),
+            ('get_shard_key', self._prepare_routing, self.bench_get_shard_key),
+            ('get_tables_for_bind', self._prepare_routing, self.bench_get_tables_for_bind),
+            ('make_unique_nickname', self._prepare_blog, self.bench_make_unique_nickname),
+            ('load_user_before_request', self._prepare_blog, self.bench_load_user_before_request),
+        ]
+        self._temp_dir_path = None
+        self._routing = None
+        self._blog_user_id = None
+        self._saved_blog_config = None
+
+    def run(self, name_filter=None, report=None):
+        results = []
+        self._temp_dir_path = tempfile.mkdtemp(prefix='bench_')
+        try:
+            for name, prepare, bench in self.benches:
+                if name_filter and name_filter not in name:
+                    continue
+
+                prepare()
+                result = self._measure(name, bench)
+                results.append(result)
+                if report:
+                    report(result)
+        finally:
+            self._cleanup()
+
+        return results
+
+    def bench_get_bind(self):
+        db, mapper, shard_keys = self._routing['db'], self._routing['mapper'], self._routing['shard_keys']
+        session = db.session()
+        session.push_binding(shard_keys[0])
+        try:
+            yield
+            for index in xrange(self.batch_size):
+                session.get_bind(mapper)
+                yield
+        finally:
+            session.pop_binding()
+
+    def bench_binding_push_pop(self):
+        db, shard_keys = self._routing['db'], self._routing['shard_keys']
+        yield
+        for index in xrange(self.batch_size):
+            with db.binding(shard_keys[0]):
+                with db.binding('log'):
+                    pass
+            yield
+
+    def bench_get_shard_key(self):
+        pattern = self._routing['pattern']
+        yield
+        for index in xrange(self.batch_size):
+            pattern.get_shard_key('user%d' % index)
+            yield
+
+    def bench_get_tables_for_bind(self):
+        db, shard_keys = self._routing['db'], self._routing['shard_keys']
+        yield
+        for index in xrange(self.batch_size):
+            db.get_tables_for_bind(shard_keys[index % len(shard_keys)])
+            yield
+
+    def bench_make_unique_nickname(self):
+        from server.blog.models import User
+        yield
+        for index in xrange(self.batch_size):
+            User.make_unique_nickname('john')
+            yield
+
+    def bench_load_user_before_request(self):
+        from flask.ext.login import login_user
+        from server.blog.views import load_user, before_request
+        app, db = self.server.app, self.server.db
+        yield
+        for index in xrange(self.batch_size):
+            with app.test_request_context('/blog/index'):
+                login_user(load_user(unicode(self._blog_user_id)))
+                before_request()
+                db.session.remove()
+            yield
+
+    def _measure(self, name, bench):
+        for index in xrange(max(1, self.iterations // self.batch_size // 10)): # 예열
+            for step in bench():
+                pass
+
+        # 배치 평균은 꼬리를 가리므로 yield 사이를 연산 하나로 잰다
+        latencies = []
+        for index in xrange(max(1, self.iterations // self.batch_size)):
+            steps = bench()
+            next(steps) # 준비
+            start_time = time.time()
+            for step in steps:
+                end_time = time.time()
+                latencies.append(end_time - start_time)
+                start_time = end_time
+
+        return BenchResult(name, latencies)
+
+    def _cleanup(self):
+        if self._blog_user_id is not None: # 임시 디렉토리를 지우기 전에 last_seen 을 모두 쓴다
+            from server.blog.views import last_seen_buffer
+            last_seen_buffer.close()
+            self.server.db.session.remove()
+            self.server.db.dispose_engines()
+
+        if self._saved_blog_config is not None: # 지운 임시 DB 를 가리키지 않게 되돌린다
+            self.server.app.config.update(self._saved_blog_config)
+            self._saved_blog_config = None
+
+        shutil.rmtree(self._temp_dir_path)
+
+    def _prepare_routing(self):
+        if self._routing is not None:
+            return
+
+        from server.database import SQLAlchemy
+
+        app = Flask(__name__)
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(self._temp_dir_path, 'default.db')
+        app.config['SQLALCHEMY_BINDS'] = dict(
+            ('master_user_%02d' % index, 'sqlite:///' + os.path.join(self._temp_dir_path, 'master_user_%02d.db' % index)) for index in xrange(self.SHARD_COUNT))
+        app.config['SQLALCHEMY_BINDS']['log'] = 'sqlite:///' + os.path.join(self._temp_dir_path, 'log.db')
+        db = SQLAlchemy(app)
+
+        pattern = db.BindingKeyPattern('master_user_\d\d')
+        for index in xrange(self.TABLES_FOR_BIND_COUNT):
+            db.Table('bench_table_%03d' % index, db.Column('id', db.Integer, primary_key=True), info=dict(bind_key=pattern if index % 2 else 'log'))
+
+        class BenchUser(db.Model):
+            __bind_key__ = pattern
+
+            id = db.Column(db.Integer, primary_key=True)
+            nickname = db.Column(db.String(64), unique=True)
+
+        self._routing = dict(db=db, pattern=pattern, mapper=db.class_mapper(BenchUser), shard_keys=pattern.get_shard_keys())
+
+    def _prepare_blog(self):
+        if self._blog_user_id is not None:
+            return
+
+        app, db = self.server.create_app(), self.server.db
+        self._saved_blog_config = dict((key, app.config[key]) for key in ('SQLALCHEMY_DATABASE_URI', 'SQLALCHEMY_ECHO'))
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(self._temp_dir_path, 'blog.db')
+        app.config['SQLALCHEMY_ECHO'] = False
+
+        from server.blog.models import User
+
+        db.create_all(bind=None)
+        db.session.add(User(nickname='john', email='john@example.com'))
+        for index in xrange(2, 200):
+            db.session.add(User(nickname='john%d' % index, email='john%d@example.com' % index))
+        db.session.commit()
+
+        self._blog_user_id = User.query.filter_by(nickname='john').first().id
+        db.session.remove()
+
+
+def save_results(results, result_file_path):
+    with open(result_file_path, 'w') as result_file:
+        json.dump(dict((result.name, result.to_dict()) for result in results), result_file, indent=2, sort_keys=True)
+
+def load_results(result_file_path):
+    with open(result_file_path) as result_file:
+        return json.load(result_file)
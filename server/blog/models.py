@@ -1,5 +1,9 @@
+import re
 from server import db
 from hashlib import md5
+from datetime import datetime
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.attributes import set_committed_value
 
 ROLE_USER = 0
 ROLE_ADMIN = 1
@@ -32,27 +36,134 @@ class User(db.Model):
     def avatar(self, size):
         return 'http://www.gravatar.com/avatar/' + md5(self.email).hexdigest() + '?d=mm&s=' + str(size)
 
+    DEFAULT_NICKNAME = u'user'
+    NICKNAME_VERSION_PATTERN = re.compile(r'[1-9][0-9]*$')
+
     @staticmethod
     def make_unique_nickname(nickname):
-        if User.query.filter_by(nickname = nickname).first() == None:
+        nickname = User._normalize_nickname(nickname)
+        taken_versions = set()
+        for taken_nickname, in User._query_nicknames_with_prefix(nickname):
+            suffix = taken_nickname[len(nickname):]
+            if suffix == '':
+                taken_versions.add(1)
+            elif User.NICKNAME_VERSION_PATTERN.match(suffix): # unicode isdigit() also takes superscripts
+                taken_versions.add(int(suffix))
+
+        if 1 not in taken_versions:
             return nickname
         version = 2
-        while True:
-            new_nickname = nickname + str(version)
-            if User.query.filter_by(nickname = new_nickname).first() == None:
-                break
+        while version in taken_versions:
             version += 1
-        return new_nickname
+        return nickname + str(version)
+
+    @staticmethod
+    def create_with_unique_nickname(nickname, max_attempts = 5, **kwargs):
+        nickname = User._normalize_nickname(nickname)
+        for attempt in xrange(max_attempts):
+            user = User(nickname = User.make_unique_nickname(nickname), **kwargs)
+            db.session.add(user)
+            try:
+                db.session.commit()
+                return user
+            except IntegrityError:
+                # another signup took the same nickname between our query and commit
+                # (a sharded user table only has the unique constraint within each shard)
+                db.session.rollback()
+                if attempt + 1 == max_attempts or not User._is_nickname_taken(user.nickname):
+                    raise
+
+    @staticmethod
+    def _normalize_nickname(nickname):
+        if isinstance(nickname, str):
+            nickname = nickname.decode('utf8')
+        return nickname.strip() if nickname and nickname.strip() else User.DEFAULT_NICKNAME
+
+    @staticmethod
+    def _query_nicknames(*criterion):
+        if hasattr(User.__table__.info.get('bind_key'), 'get_shard_keys'):
+            return db.across_shards(User).with_entities(User.nickname).filter(*criterion)
+        return db.session.query(User.nickname).filter(*criterion)
+
+    @staticmethod
+    def _query_nicknames_with_prefix(nickname):
+        upper_bound = nickname[:-1] + unichr(ord(nickname[-1]) + 1)
+        return User._query_nicknames(
+            User.nickname >= nickname,
+            User.nickname < upper_bound,
+            db.func.length(User.nickname) <= len(nickname) + 10)
+
+    @staticmethod
+    def _is_nickname_taken(nickname):
+        return User._query_nicknames(User.nickname == nickname).first() is not None
 
 class Post(db.Model):
+    __table_args__ = (
+        db.Index('ix_post_user_id_timestamp_id', 'user_id', 'timestamp', 'id'),
+        db.Index('ix_post_timestamp_id', 'timestamp', 'id'),
+    )
+
+    MAX_PAGE_SIZE = 50
+    CURSOR_TIMESTAMP_FORMAT = '%Y%m%d%H%M%S%f'
+
     id = db.Column(db.Integer, primary_key = True)
     body = db.Column(db.String(140))
-    timestamp = db.Column(db.DateTime)
+    timestamp = db.Column(db.DateTime, default = datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
 
     def __repr__(self):
         return '<Post %r>' % (self.body)
 
+    @staticmethod
+    def timeline(user = None, before = None, limit = 20):
+        # newest first, seeking past the (timestamp, id) cursor instead of using OFFSET
+        limit = max(1, min(limit, Post.MAX_PAGE_SIZE))
+        posts = Post.timeline_query(user, before).limit(limit + 1).all()
+        next_cursor = None
+        if len(posts) > limit:
+            posts = posts[:limit]
+            next_cursor = Post.make_cursor(posts[-1])
+
+        Post._load_authors(posts, user)
+        return posts, next_cursor
+
+    @staticmethod
+    def timeline_query(user = None, before = None):
+        # rows written before timestamp had a default have no place in the (timestamp, id) order
+        query = Post.query.filter(Post.timestamp != None)
+        if user is not None:
+            query = query.filter(Post.user_id == user.id)
+        if before is not None:
+            timestamp, id = before
+            query = query.filter(db.tuple_(Post.timestamp, Post.id) < db.tuple_(timestamp, id))
+        return query.order_by(Post.timestamp.desc(), Post.id.desc())
+
+    @staticmethod
+    def make_cursor(post):
+        return '%s-%d' % (post.timestamp.strftime(Post.CURSOR_TIMESTAMP_FORMAT), post.id)
+
+    @staticmethod
+    def parse_cursor(cursor):
+        if not cursor:
+            return None
+        try:
+            timestamp, id = cursor.split('-')
+            return datetime.strptime(timestamp, Post.CURSOR_TIMESTAMP_FORMAT), int(id)
+        except ValueError:
+            return None
+
+    @staticmethod
+    def _load_authors(posts, user = None):
+        # one IN query for the whole page instead of one lazy load per post
+        if user is not None:
+            authors = {user.id: user}
+        else:
+            author_ids = set(post.user_id for post in posts if post.user_id is not None)
+            authors = dict((author.id, author) for author in User.query.filter(User.id.in_(author_ids))) if author_ids else {}
+
+        for post in posts:
+            set_committed_value(post, 'author', authors.get(post.user_id))
+
 if __name__ == '__main__':
     db.drop_all()
     db.create_all()
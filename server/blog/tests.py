@@ -1,15 +1,25 @@
 import os
+import shutil
+import tempfile
 import unittest
 
+from datetime import datetime
+
+from sqlalchemy.exc import IntegrityError
+
 from server import app, db
 
-from server.blog.models import User
+from server.blog.models import User, Post
+from server.blog import bp
+from server.blog.views import last_seen_buffer, user_cache, page_cache
 
 class BlogTestCase(unittest.TestCase):
     def setUp(self):
         app.config['TESTING'] = True
         app.config['CSRF_ENABLED'] = False
         app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + ':memory:'
+        if 'blog' not in app.blueprints:
+            app.register_blueprint(bp)
         self.app = app.test_client()
         db.create_all()
 
@@ -36,5 +46,174 @@ class BlogTestCase(unittest.TestCase):
         assert nickname2 != 'john'
         assert nickname2 != nickname
 
+    def test_make_unique_nickname_fills_gap(self):
+        for nickname in ['john', 'john2', 'john4', 'johnny', 'john05']:
+            db.session.add(User(nickname = nickname, email = nickname + '@example.com'))
+        db.session.commit()
+        assert User.make_unique_nickname('john') == 'john3'
+        assert User.make_unique_nickname('susan') == 'susan'
+        u = User.create_with_unique_nickname('john', email = 'john3@example.com')
+        assert u.nickname == 'john3'
+
+    def test_make_unique_nickname_normalizes_input(self):
+        db.session.add(User(nickname = u'\uc9c0\ud6c8', email = 'jihoon@example.com'))
+        db.session.commit()
+        assert User.make_unique_nickname(u'\uc9c0\ud6c8'.encode('utf8')) == u'\uc9c0\ud6c82'
+        assert User.make_unique_nickname('') == User.DEFAULT_NICKNAME
+        assert User.make_unique_nickname(None) == User.DEFAULT_NICKNAME
+        u = User.create_with_unique_nickname('  ', email = 'nobody@example.com')
+        assert u.nickname == User.DEFAULT_NICKNAME
+
+    def test_make_unique_nickname_ignores_non_ascii_digits(self):
+        db.session.add(User(nickname = u'john\u00b2', email = 'john@example.com'))
+        db.session.commit()
+        assert User.make_unique_nickname('john') == 'john'
+
+    def test_create_with_unique_nickname_only_retries_nickname_conflicts(self):
+        db.session.add(User(nickname = 'john', email = 'john@example.com'))
+        db.session.commit()
+        make_unique_nickname = User.make_unique_nickname
+        attempts = []
+        User.make_unique_nickname = staticmethod(lambda nickname: attempts.append(nickname) or make_unique_nickname(nickname))
+        try:
+            self.assertRaises(IntegrityError, User.create_with_unique_nickname, 'susan', email = 'john@example.com')
+        finally:
+            User.make_unique_nickname = staticmethod(make_unique_nickname)
+        assert attempts == [u'susan']
+
+    def test_make_unique_nickname_across_shards(self):
+        temp_dir_path = tempfile.mkdtemp()
+        binds = app.config['SQLALCHEMY_BINDS']
+        bind_key = User.__table__.info.get('bind_key')
+        app.config['SQLALCHEMY_BINDS'] = dict(('blog_user_%02d' % index, 'sqlite:///' + os.path.join(temp_dir_path, 'blog_user_%02d.db' % index)) for index in (1, 2))
+        User.__table__.info['bind_key'] = db.BindingKeyPattern('blog_user_\d\d')
+        db.invalidate_bind_cache()
+        try:
+            db.create_all(bind = sorted(app.config['SQLALCHEMY_BINDS']))
+            for shard_key, nickname in [('blog_user_01', 'john'), ('blog_user_02', 'john2')]:
+                with db.binding(shard_key):
+                    db.session.add(User(nickname = nickname, email = nickname + '@example.com'))
+                    db.session.commit()
+            assert User.make_unique_nickname('john') == 'john3'
+        finally:
+            db.session.remove()
+            User.__table__.info['bind_key'] = bind_key
+            app.config['SQLALCHEMY_BINDS'] = binds
+            db.invalidate_bind_cache()
+            shutil.rmtree(temp_dir_path, ignore_errors = True)
+
+    def test_user_cache(self):
+        u = User(nickname = 'john', email = 'john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        user_id = u.id
+        db.session.remove()
+
+        assert user_cache.get(user_id).nickname == 'john'
+        db.session.remove()
+        cached_user = user_cache.get(user_id)
+        assert cached_user in db.session
+        cached_user.nickname = 'susan'
+        db.session.add(cached_user)
+        db.session.commit()
+        db.session.remove()
+        assert user_cache.get(user_id).nickname == 'susan'
+
+    def test_timeline_keyset_pagination(self):
+        john = User(nickname = 'john', email = 'john@example.com')
+        susan = User(nickname = 'susan', email = 'susan@example.com')
+        db.session.add_all([john, susan])
+        db.session.commit()
+        timestamp = datetime(2014, 1, 1)
+        for index in xrange(5):
+            db.session.add(Post(body = 'post %d' % index, timestamp = timestamp, author = john if index % 2 else susan))
+        db.session.commit()
+        db.session.expunge_all()
+
+        bodies = []
+        cursor = None
+        while True:
+            posts, cursor = Post.timeline(before = Post.parse_cursor(cursor), limit = 2)
+            assert all('author' in post.__dict__ for post in posts)
+            bodies.extend((post.author.nickname, post.body) for post in posts)
+            if cursor is None:
+                break
+        assert [body for nickname, body in bodies] == ['post 4', 'post 3', 'post 2', 'post 1', 'post 0']
+        assert bodies[1] == ('john', 'post 3')
+
+        posts, cursor = Post.timeline(User.query.filter_by(nickname = 'john').first(), limit = 10)
+        assert [post.body for post in posts] == ['post 3', 'post 1']
+        assert cursor is None
+        assert Post.parse_cursor('broken') is None
+
+    def test_timeline_query_plan(self):
+        john = User(nickname = 'john', email = 'john@example.com')
+        db.session.add(john)
+        db.session.commit()
+        before = (datetime(2014, 1, 1), 10)
+        plans = []
+        for user in [None, john]:
+            statement = Post.timeline_query(user, before).limit(21).statement
+            compiled = statement.compile(dialect = db.engine.dialect)
+            params = tuple(compiled.params[name] for name in compiled.positiontup)
+            rows = db.engine.execute('EXPLAIN QUERY PLAN ' + unicode(compiled), params).fetchall()
+            plans.append(' '.join(row[len(row) - 1] for row in rows))
+        assert 'SEARCH post USING INDEX ix_post_timestamp_id (timestamp>? AND timestamp<?)' in plans[0]
+        assert 'SEARCH post USING INDEX ix_post_user_id_timestamp_id (user_id=? AND timestamp>? AND timestamp<?)' in plans[1]
+        assert 'TEMP B-TREE' not in ' '.join(plans)
+
+    def test_timeline_skips_posts_without_timestamp(self):
+        john = User(nickname = 'john', email = 'john@example.com')
+        db.session.add(john)
+        db.session.commit()
+        db.session.execute(Post.__table__.insert().values(body = 'legacy', timestamp = None, user_id = john.id))
+        db.session.add(Post(body = 'new', timestamp = datetime(2014, 1, 1), author = john))
+        db.session.commit()
+        posts, cursor = Post.timeline(limit = 1)
+        assert [post.body for post in posts] == ['new'] and cursor is None
+
+    def test_page_cache_etag(self):
+        response = self.app.get('/blog/index')
+        etag = response.headers['ETag']
+        assert response.status_code == 200
+        response = self.app.get('/blog/index', headers = {'If-None-Match': etag})
+        assert response.status_code == 304
+        generation = page_cache.backend.get(page_cache.GENERATION_KEY_PREFIX + 'User')
+        db.session.add(User(nickname = 'john', email = 'john@example.com'))
+        db.session.commit()
+        assert page_cache.backend.get(page_cache.GENERATION_KEY_PREFIX + 'User') != generation
+        response = self.app.get('/blog/index', headers = {'If-None-Match': '"stale"'})
+        assert response.status_code == 200
+        assert response.headers['ETag'] == etag
+
+    def test_last_seen_write_behind(self):
+        u = User(nickname = 'john', email = 'john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        last_seen = datetime(2014, 1, 1, 12, 0, 0)
+        last_seen_buffer.touch(u.id, datetime(2014, 1, 1, 11, 0, 0))
+        last_seen_buffer.touch(u.id, last_seen)
+        assert last_seen_buffer.flush() == 1
+        db.session.expire_all()
+        assert User.query.get(u.id).last_seen == last_seen
+
+    def test_last_seen_flush_invalidates_caches(self):
+        u = User(nickname = 'john', email = 'john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        user_id = u.id
+        db.session.remove()
+        assert user_cache.get(user_id).last_seen is None
+        db.session.remove()
+
+        self.app.get('/blog/index')
+        generation = page_cache.backend.get(page_cache.GENERATION_KEY_PREFIX + 'User')
+
+        last_seen = datetime(2014, 1, 1, 12, 0, 0)
+        last_seen_buffer.touch(user_id, last_seen)
+        assert last_seen_buffer.flush() == 1
+        assert user_cache.get(user_id).last_seen == last_seen
+        assert page_cache.backend.get(page_cache.GENERATION_KEY_PREFIX + 'User') != generation
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,4 +1,9 @@
-from .. import app, db, lm, oid
+# -*- coding:utf8 -*-
+from .. import app, db
+from ..extensions import lm, oid
+from ..writebehind import WriteBehindBuffer
+from ..cache import ModelCache
+from ..pagecache import PageCache
 
 from flask import Blueprint
 from flask import render_template
@@ -8,19 +13,32 @@ from flask import g, session, request
 
 from flask.ext.login import current_user, login_user, logout_user, login_required
 
+from sqlalchemy.orm.attributes import set_committed_value
+
 from datetime import datetime
 
 from forms import LoginForm
 from forms import EditForm
 
 from models import User
-from models import User, ROLE_USER, ROLE_ADMIN
+from models import User, Post, ROLE_USER, ROLE_ADMIN
 
 lm.login_view = '.login'
 
+last_seen_buffer = WriteBehindBuffer(db, User, 'last_seen', config_prefix='LAST_SEEN')
+user_cache = ModelCache(db, User, config_prefix='USER_CACHE')
+page_cache = PageCache(db, config_prefix='PAGE_CACHE')
+
+def invalidate_last_seen(user_ids):
+    for user_id in user_ids:
+        user_cache.invalidate(user_id)
+    page_cache.invalidate('User') # user.html 이 last_seen 을 보여준다
+
+last_seen_buffer.flush_listeners.append(invalidate_last_seen)
+
 @lm.user_loader
 def load_user(id):
-    return User.query.get(int(id))
+    return user_cache.get(int(id))
 
 bp = Blueprint('blog', __name__, url_prefix='/blog',  template_folder='templates')
 
@@ -32,28 +50,29 @@ def page_not_found(error):
 def before_request():
     g.user = current_user
     if g.user.is_authenticated():
-        g.user.last_seen = datetime.utcnow()
-        db.session.add(g.user)
-        db.session.commit()
+        if app.config['LAST_SEEN_WRITE_BEHIND']: # 모았다가 한 번에 쓴다
+            user = g.user._get_current_object()
+            last_seen = datetime.utcnow()
+            last_seen_buffer.touch(user.id, last_seen)
+            set_committed_value(user, 'last_seen', last_seen)
+        else:
+            g.user.last_seen = datetime.utcnow()
+            db.session.add(g.user)
+            db.session.commit()
 
 @bp.route('/')
 @bp.route('/index')
+@page_cache.cached('User', 'Post')
 def index():
     user = g.user
-    posts = [ # fake array of posts
-        { 
-            'author': { 'nickname': 'John' }, 
-            'body': 'Beautiful day in Portland!' 
-        },
-        { 
-            'author': { 'nickname': 'Susan' }, 
-            'body': 'The Avengers movie was so cool!' 
-        }
-    ]
+    posts, next_cursor = Post.timeline(
+        before = Post.parse_cursor(request.args.get('before')),
+        limit = app.config['POSTS_PER_PAGE'])
     return render_template("index.html",
         title = 'Home',
         user = user,
-        posts = posts)
+        posts = posts,
+        next_cursor = next_cursor)
 
 @bp.route('/login', methods=['GET', 'POST'])
 @oid.loginhandler
@@ -82,10 +101,7 @@ def after_login(resp):
         if nickname is None or nickname == "":
             nickname = resp.email.split('@')[0]
     
-        unique_nickname = User.make_unique_nickname(nickname)
-        user = User(nickname=unique_nickname, email=resp.email, role=ROLE_USER)
-        db.session.add(user)
-        db.session.commit()
+        user = User.create_with_unique_nickname(nickname, email=resp.email, role=ROLE_USER)
     remember_me = False
     if 'remember_me' in session:
         remember_me = session['remember_me']
@@ -101,18 +117,19 @@ def logout():
 
 @bp.route('/user/<nickname>')
 @login_required
+@page_cache.cached('User', 'Post')
 def user(nickname):
-    user = User.query.filter_by(nickname = nickname).first()
+    user = User.query.filter_by(nickname = nickname).cache().first()
     if user == None:
         flash('User ' + nickname + ' not found.')
         return redirect(url_for('index'))
-    posts = [
-        { 'author': user, 'body': 'Test post #1' },
-        { 'author': user, 'body': 'Test post #2' }
-    ]
+    posts, next_cursor = Post.timeline(user,
+        before = Post.parse_cursor(request.args.get('before')),
+        limit = app.config['POSTS_PER_PAGE'])
     return render_template('user.html',
         user = user,
-        posts = posts)
+        posts = posts,
+        next_cursor = next_cursor)
 
 @bp.route('/edit', methods=['GET', 'POST'])
 @login_required
@@ -0,0 +1,179 @@
+# -*- coding:utf8 -*-
+import ujson
+import gevent
+
+from collections import deque
+from gevent.event import Event
+
+
+class _Subscriber(object):
+    "연결 하나의 보낼 메시지 큐와 보내는 그린렛"
+
+    def __init__(self, hub, ws):
+        self.hub = hub
+        self.ws = ws
+        self.channels = set()
+        self.pending = deque() # (채널, 직렬화된 메시지)
+        self.pending_event = Event()
+        self.dropped_count = 0
+        self.closed = False
+        self.sender = None
+
+    def __repr__(self):
+        return "%s<channels=%d pending=%d>" % (self.__class__.__name__, len(self.channels), len(self.pending))
+
+    def put(self, channel, payload):
+        "큐가 가득 차면 drop 정책은 False, coalesce 정책은 오래된 메시지를 버린다"
+        if len(self.pending) >= self.hub.queue_size:
+            if self.hub.policy == BroadcastHub.POLICY_DROP:
+                return False
+
+            self.dropped_count += 1
+            self.hub.coalesced_count += 1
+            for index, (pending_channel, pending_payload) in enumerate(self.pending):
+                if pending_channel == channel: # 같은 채널의 밀린 메시지를 최신으로 바꾼다
+                    del self.pending[index]
+                    break
+            else:
+                self.pending.popleft()
+
+        self.pending.append((channel, payload))
+        self.pending_event.set()
+        return True
+
+    def run_sender(self):
+        try:
+            while not self.closed:
+                self.pending_event.wait()
+                self.pending_event.clear()
+                while self.pending and not self.closed:
+                    channel, payload = self.pending.popleft()
+                    self.ws.send(payload)
+                    self.hub.sent_count += 1
+        except Exception: # 끊긴 연결
+            pass
+        finally:
+            self.hub.disconnect(self)
+
+    def close(self):
+        self.closed = True
+        self.pending.clear()
+        self.pending_event.set()
+
+
+class BroadcastHub(object):
+    "채널 별 구독자에게 메시지를 한 번만 직렬화해서 보낸다"
+
+    POLICY_DROP = 'drop' # 느린 연결을 끊는다
+    POLICY_COALESCE = 'coalesce' # 밀린 메시지를 최신 것으로 합친다
+
+    def __init__(self, queue_size=100, policy=POLICY_COALESCE):
+        if policy not in (self.POLICY_DROP, self.POLICY_COALESCE):
+            raise Exception('NOT_SUPPORTED_BROADCAST_POLICY:%s' % policy)
+
+        self.queue_size = queue_size
+        self.policy = policy
+        self.channels = {}
+        self.subscribers = set()
+        self.published_count = 0
+        self.sent_count = 0
+        self.coalesced_count = 0 # 끊긴 연결에서 합친 것도 남도록 허브에서 센다
+        self.dropped_subscriber_count = 0
+
+    def __repr__(self):
+        return "%s<connections=%d channels=%d>" % (self.__class__.__name__, len(self.subscribers), len(self.channels))
+
+    def connect(self, ws, channels=()):
+        subscriber = _Subscriber(self, ws)
+        self.subscribers.add(subscriber)
+        for channel in channels:
+            self.subscribe(subscriber, channel)
+
+        subscriber.sender = gevent.spawn(subscriber.run_sender)
+        return subscriber
+
+    def disconnect(self, subscriber):
+        if subscriber not in self.subscribers:
+            return
+
+        self.subscribers.discard(subscriber)
+        for channel in list(subscriber.channels):
+            self.unsubscribe(subscriber, channel)
+
+        subscriber.close()
+
+    def subscribe(self, subscriber, channel):
+        subscriber.channels.add(channel)
+        self.channels.setdefault(channel, set()).add(subscriber)
+
+    def unsubscribe(self, subscriber, channel):
+        subscriber.channels.discard(channel)
+        channel_subscribers = self.channels.get(channel)
+        if channel_subscribers is not None:
+            channel_subscribers.discard(subscriber)
+            if not channel_subscribers:
+                del self.channels[channel]
+
+    def publish(self, channel, data):
+        "직렬화한 바이트를 모든 구독자가 같이 쓴다"
+        channel_subscribers = self.channels.get(channel)
+        if not channel_subscribers:
+            return 0
+
+        payload = ujson.dumps(dict(channel=channel, data=data))
+        self.published_count += 1
+
+        subscriber_count = 0
+        for subscriber in list(channel_subscribers):
+            if subscriber.put(channel, payload):
+                subscriber_count += 1
+            else:
+                self.dropped_subscriber_count += 1
+                self.disconnect(subscriber)
+                try:
+                    subscriber.ws.close()
+                except Exception:
+                    pass
+
+        return subscriber_count
+
+    def serve(self, ws, channels=()):
+        "연결이 끊길 때까지 {\"subscribe\": 채널}, {\"unsubscribe\": 채널} 요청을 받는다"
+        subscriber = self.connect(ws, channels)
+        try:
+            while not subscriber.closed:
+                message = ws.receive()
+                if message is None:
+                    break
+
+                try:
+                    request = ujson.loads(message)
+                except ValueError:
+                    continue
+
+                if not isinstance(request, dict):
+                    continue
+
+                # 채널 이름은 문자열만 받는다 (목록 같은 값은 set 에 넣을 수 없다)
+                channel = request.get('subscribe')
+                if channel and isinstance(channel, basestring):
+                    self.subscribe(subscriber, channel)
+                channel = request.get('unsubscribe')
+                if channel and isinstance(channel, basestring):
+                    self.unsubscribe(subscriber, channel)
+        finally:
+            self.disconnect(subscriber)
+
+    def get_metrics(self):
+        "연결 수, 채널 별 구독자 수, 큐 깊이와 누적 카운터"
+        queue_depths = [len(subscriber.pending) for subscriber in self.subscribers]
+        return dict(
+            connections=len(self.subscribers),
+            channels=dict((channel, len(channel_subscribers)) for channel, channel_subscribers in self.channels.iteritems()),
+            queue_depth_total=sum(queue_depths),
+            queue_depth_max=max(queue_depths) if queue_depths else 0,
+            queue_size=self.queue_size,
+            published_count=self.published_count,
+            sent_count=self.sent_count,
+            coalesced_count=self.coalesced_count,
+            dropped_subscriber_count=self.dropped_subscriber_count)
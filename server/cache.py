@@ -0,0 +1,165 @@
+# -*- coding:utf8 -*-
+import time
+import threading
+
+from collections import OrderedDict
+
+from sqlalchemy.orm import class_mapper
+from sqlalchemy.orm.attributes import instance_state, set_committed_value
+
+
+class LRUCache(object):
+    "크기와 TTL 로 제한하는 프로세스 내 캐시 (werkzeug.contrib.cache 와 같은 인터페이스)"
+
+    def __init__(self, max_size=1000, default_timeout=300):
+        self.max_size = max_size
+        self.default_timeout = default_timeout
+        self.hit_count = 0
+        self.miss_count = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "%s<size=%d/%d>" % (self.__class__.__name__, len(self._entries), self.max_size)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.miss_count += 1
+                return None
+
+            expire_time, value = entry
+            if expire_time and expire_time < time.time():
+                self.miss_count += 1
+                return None
+
+            self._entries[key] = entry # 최근 사용으로 옮긴다
+            self.hit_count += 1
+            return value
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + timeout if timeout else 0, value)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            return self._entries.pop(key, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+        return True
+
+    def get_stats(self):
+        return dict(size=len(self._entries), max_size=self.max_size, hit_count=self.hit_count, miss_count=self.miss_count)
+
+
+def check_cache_backend(config, config_prefix):
+    "워커 프로세스가 여럿이면 memory 캐시는 다른 워커의 커밋으로 지워지지 않으므로 쓸 수 없다"
+    return not (config.get(config_prefix + '_TYPE', 'memory') == 'memory' and config.get('SERVER_WORKERS', 0) > 1)
+
+def make_cache_backend(config, config_prefix):
+    "<prefix>_TYPE 에 따라 memory(LRUCache), redis, memcached 캐시를 만든다"
+    if not check_cache_backend(config, config_prefix): # prepare_all 이 미리 꺼 둔다
+        raise Exception('NOT_SUPPORTED_MEMORY_CACHE_WITH_WORKERS:%s' % config_prefix)
+    cache_type = config.get(config_prefix + '_TYPE', 'memory')
+    default_timeout = config.get(config_prefix + '_TTL', 300)
+    if cache_type == 'memory':
+        return LRUCache(config.get(config_prefix + '_SIZE', 1000), default_timeout)
+    elif cache_type == 'redis':
+        from werkzeug.contrib.cache import RedisCache
+        host, port = config.get(config_prefix + '_SERVERS', ['localhost:6379'])[0].split(':')
+        return RedisCache(host, int(port), default_timeout=default_timeout, key_prefix=config_prefix + ':')
+    elif cache_type == 'memcached':
+        from werkzeug.contrib.cache import MemcachedCache
+        return MemcachedCache(config.get(config_prefix + '_SERVERS', ['localhost:11211']), default_timeout=default_timeout, key_prefix=config_prefix + ':')
+    else:
+        raise Exception('NOT_SUPPORTED_CACHE_TYPE:%s' % cache_type)
+
+
+class ModelCache(object):
+    "기본 키로 모델 행을 캐시하고 커밋되면 지운다"
+
+    def __init__(self, db, model, config_prefix):
+        self.db = db
+        self.model = model
+        self.config_prefix = config_prefix
+        self.backend = None
+        self._lock = threading.Lock()
+
+        db.commit_listeners.append(self._on_commit)
+
+    def __repr__(self):
+        return "%s<%s %r>" % (self.__class__.__name__, self.model.__name__, self.backend)
+
+    def get(self, primary_key):
+        "캐시에 있으면 SELECT 없이 현재 세션에 붙인 인스턴스를 돌려준다"
+        backend = self._get_backend()
+        if backend is None:
+            return self.model.query.get(primary_key)
+
+        values = backend.get(self._make_key(primary_key))
+        if values is None:
+            instance = self.model.query.get(primary_key)
+            if instance is not None:
+                backend.set(self._make_key(primary_key), self._get_values(instance))
+            return instance
+
+        return self.db.session.merge(self._make_detached(values), load=False)
+
+    def invalidate(self, primary_key):
+        backend = self._get_backend()
+        if backend is not None:
+            backend.delete(self._make_key(primary_key))
+
+    def _get_backend(self):
+        if self.backend is None:
+            config = self.db.get_app().config
+            if not config.get(self.config_prefix + '_ENABLE', False):
+                return None
+
+            with self._lock:
+                if self.backend is None:
+                    self.backend = make_cache_backend(config, self.config_prefix)
+
+        return self.backend
+
+    def _make_key(self, primary_key):
+        return '%s:%s' % (self.model.__name__, primary_key)
+
+    def _get_values(self, instance):
+        return dict((column_property.key, getattr(instance, column_property.key)) for column_property in class_mapper(self.model).column_attrs)
+
+    def _make_detached(self, values):
+        # 저장된 행 값으로 분리(detached) 상태 인스턴스를 만든다
+        mapper = class_mapper(self.model)
+        instance = mapper.class_manager.new_instance()
+        for key, value in values.iteritems():
+            set_committed_value(instance, key, value)
+
+        state = instance_state(instance)
+        state.key = mapper._identity_key_from_state(state)
+        return instance
+
+    def _on_commit(self, session, changes):
+        if self.backend is None:
+            return
+
+        for instance, operation in changes:
+            if isinstance(instance, self.model):
+                identity = instance_state(instance).identity
+                if identity:
+                    self.backend.delete(self._make_key(identity[0]))
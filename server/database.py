@@ -1,16 +1,36 @@
 # -*- coding:utf8 -*-
 import re
+import time
+import threading
 
+from multiprocessing.pool import ThreadPool
 from flask_sqlalchemy import SQLAlchemy as BaseSQLAlchemy
 from flask_sqlalchemy import _SignallingSession as BaseSignallingSession
-from flask_sqlalchemy import orm, partial, get_state
+from flask_sqlalchemy import _EngineConnector as BaseEngineConnector
+from flask_sqlalchemy import _EngineDebuggingSignalEvents, _record_queries
+from flask_sqlalchemy import orm, partial, get_state, make_url, sqlalchemy
+
+from sqlalchemy import event, inspect
+from sqlalchemy.pool import QueuePool, StaticPool
+from sqlalchemy.sql.expression import Select
+
+from hashring import HashRing
+from replication import ReplicaRouter
+from pooling import PoolManager, is_memory_database
+from sqlitetuning import SQLiteTuner
+from sqlitereplica import SQLiteReplicaRefresher
+from querycache import CachingQuery, QueryCache
+from shardquery import ShardQuery
 
 class _BindingKeyPattern(object):
     def __init__(self, db, pattern):
         self.db = db 
         self.raw_pattern = pattern
         self.compiled_pattern = re.compile(pattern)
-        self._shard_keys = None
+        self._hash_ring = None
+        self._hash_ring_config = None
+        self._previous_hash_ring = None
+        self._previous_hash_ring_config = None
 
     def __repr__(self):
         return "%s<%s>" % (self.__class__.__name__, self.raw_pattern)
@@ -18,47 +38,424 @@ class _BindingKeyPattern(object):
     def match(self, key):
         return self.compiled_pattern.match(key)
 
-    def get_shard_key(self, hash_num):
-        if self._shard_keys is None:
-            self._shard_keys = [key for key, value in self.db.app.config['SQLALCHEMY_BINDS'].iteritems() if self.compiled_pattern.match(key)]
-            self._shard_keys.sort()
-
-        return self._shard_keys[hash_num % len(self._shard_keys)]
+    def get_shard_key(self, shard_value):
+        return self.get_hash_ring().get_node(shard_value)
+
+    def get_shard_keys(self):
+        return self.get_hash_ring().nodes
+
+    def get_hash_ring(self):
+        config = self.db.get_app().config
+        binds, weights = config['SQLALCHEMY_BINDS'], config.get('SQLALCHEMY_SHARD_WEIGHTS')
+        # 사전은 같은 객체면 내용을 비교하지 않고 길이만 본다 (값만 고치면 invalidate_bind_cache() 로 알린다)
+        hash_ring_config = (binds, len(binds or ()), weights, len(weights or ()), config.get('SQLALCHEMY_SHARD_VIRTUAL_NODES'), self.db.config_version)
+        if self._hash_ring is None or hash_ring_config != self._hash_ring_config: # 설정이 바뀌면 링을 다시 만든다
+            shard_keys = [key for key in (config['SQLALCHEMY_BINDS'] or {}) if self.compiled_pattern.match(key)]
+            self._hash_ring = HashRing(
+                shard_keys,
+                weights=config.get('SQLALCHEMY_SHARD_WEIGHTS'),
+                virtual_node_count=config.get('SQLALCHEMY_SHARD_VIRTUAL_NODES') or HashRing.DEFAULT_VIRTUAL_NODE_COUNT)
+            self._hash_ring_config = hash_ring_config
+
+        return self._hash_ring
+
+    def get_previous_hash_ring(self):
+        "리밸런싱 중이면 SQLALCHEMY_SHARD_PREVIOUS_WEIGHTS 의 이전 샤드 링"
+        config = self.db.get_app().config
+        previous_weights = config.get('SQLALCHEMY_SHARD_PREVIOUS_WEIGHTS')
+        if not previous_weights:
+            return None
+
+        previous_hash_ring_config = (previous_weights, len(previous_weights), config.get('SQLALCHEMY_SHARD_VIRTUAL_NODES'), self.db.config_version)
+        if self._previous_hash_ring is None or previous_hash_ring_config != self._previous_hash_ring_config:
+            self._previous_hash_ring = HashRing(
+                [key for key in previous_weights if self.compiled_pattern.match(key)],
+                weights=previous_weights,
+                virtual_node_count=config.get('SQLALCHEMY_SHARD_VIRTUAL_NODES') or HashRing.DEFAULT_VIRTUAL_NODE_COUNT)
+            self._previous_hash_ring_config = previous_hash_ring_config
+
+        return self._previous_hash_ring
+
+    def get_read_shard_keys(self, shard_value):
+        "새 샤드 다음에 아직 옮기지 않았을 수 있는 이전 샤드를 읽는다"
+        shard_key = self.get_shard_key(shard_value)
+        previous_hash_ring = self.get_previous_hash_ring()
+        if previous_hash_ring is None or not len(previous_hash_ring):
+            return [shard_key]
+
+        previous_shard_key = previous_hash_ring.get_node(shard_value)
+        return [shard_key] if previous_shard_key == shard_key else [shard_key, previous_shard_key]
+
+    def plan_add_shard(self, shard_key, weight=1):
+        "샤드를 추가할 때 이동하는 키 구간을 계산한다"
+        return self.get_hash_ring().plan_add(shard_key, weight)
+
+    def plan_remove_shard(self, shard_key):
+        "샤드를 제거할 때 이동하는 키 구간을 계산한다"
+        return self.get_hash_ring().plan_remove(shard_key)
 
 
 class _BoundSection(object):
-    def __init__(self, db_session_cls, name):
+    def __init__(self, db_session_cls, name, close=False):
         self.db_session = db_session_cls()
         self.name = name
+        self.close = close
 
     def __enter__(self):
+        if self.close and self.db_session._unit_of_work_depth: # 닫으면 단위 작업에서 쓴 것까지 버린다
+            raise Exception('NOT_SUPPORTED_CLOSE_IN_UNIT_OF_WORK:%s' % self.name)
+
         self.db_session.push_binding(self.name)
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.db_session.pop_binding()
-        self.db_session.close()
+        if self.db_session._unit_of_work_depth and exc_type is not None: # 단위 작업은 열어 둔 채 되돌린다
+            self.db_session.pop_binding(keep_instances=False)
+            self.db_session.rollback()
+        elif exc_type is not None or self.close: # 예외가 나면 예전처럼 세션을 버린다
+            self.db_session.pop_binding(keep_instances=False)
+            self.db_session.close()
+        else: # 세션과 커넥션은 요청이 끝날 때까지 유지한다
+            self.db_session.pop_binding()
+
+
+class _UnitOfWork(object):
+    def __init__(self, db_session_cls, two_phase=False, parallel=True):
+        self.db_session = db_session_cls()
+        self.two_phase = two_phase
+        self.parallel = parallel
+
+    def __enter__(self):
+        self.db_session.begin_unit_of_work(self.two_phase)
+        return self.db_session
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.db_session.end_unit_of_work(exc_type is None, self.parallel)
+
+
+class _CommittedTransaction(object):
+    "병렬로 먼저 커밋한 트랜잭션 (SessionTransaction 이 다시 커밋하지 않는다)"
+
+    def __init__(self, transaction):
+        self.transaction = transaction
+
+    def prepare(self):
+        pass
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.transaction.close()
+
+
+class _EngineConnector(BaseEngineConnector):
+    def get_engine(self):
+        # 바인딩 키를 아는 곳에서 풀 설정을 넣도록 기본 구현을 옮겨 왔다
+        with self._lock:
+            uri = self.get_uri()
+            echo = self._app.config['SQLALCHEMY_ECHO']
+            if (uri, echo) == self._connected_for:
+                return self._engine
+
+            info = make_url(uri)
+            options = {'convert_unicode': True}
+            self._sa.apply_pool_defaults(self._app, options)
+            self._sa.apply_driver_hacks(self._app, info, options)
+            self._sa.pool_manager.apply_options(self._app, self._bind, info, options)
+            self._sa.sqlite_tuner.apply_options(self._app, self._bind, info, options)
+            if echo:
+                options['echo'] = True
+
+            engine = sqlalchemy.create_engine(info, **options)
+            if _record_queries(self._app):
+                _EngineDebuggingSignalEvents(engine, self._app.import_name).register()
+
+            for engine_listener in self._sa.engine_listeners: # 새로 만든 엔진
+                engine_listener(self._app, self._bind, engine)
+
+            self._engine = engine
+            self._connected_for = (uri, echo)
+            return engine
+
+
+class _BindCache(object):
+    def __init__(self):
+        self.engines = {}
+        self.hit_count = 0
+        self.miss_count = 0
+        self._config_snapshot = None
+
+    def __repr__(self):
+        return "%s<size=%d hit_rate=%.4f>" % (self.__class__.__name__, len(self.engines), self.hit_rate)
+
+    @property
+    def hit_rate(self):
+        total_count = self.hit_count + self.miss_count
+        return float(self.hit_count) / total_count if total_count else 0.0
+
+    def validate(self, config):
+        # 바인딩 설정이 바뀌면 엔진이 바뀔 수 있으므로 비운다 (값만 고치면 invalidate_bind_cache() 가 비운다)
+        binds = config['SQLALCHEMY_BINDS']
+        config_snapshot = (binds, len(binds or ()), config['SQLALCHEMY_DATABASE_URI'], config['SQLALCHEMY_ECHO'])
+        if config_snapshot != self._config_snapshot:
+            self.engines.clear()
+            self._config_snapshot = config_snapshot
+
+    def clear(self):
+        self.engines.clear()
+        self._config_snapshot = None
+
+    def get_stats(self):
+        return dict(size=len(self.engines), hit_count=self.hit_count, miss_count=self.miss_count, hit_rate=self.hit_rate)
 
 
 class _SignallingSession(BaseSignallingSession):
-    def __init__(self, *args, **kwargs):
-        BaseSignallingSession.__init__(self, *args, **kwargs)
+    def __init__(self, db, *args, **kwargs):
+        BaseSignallingSession.__init__(self, db, *args, **kwargs)
+        self._db = db
         self._binding_keys = []
         self._binding_key = None
+        self._binding_stack = (None,)
+        self._written_binding_keys = set()
+        self._flushed_changes = []
+        self._stashed_instances = {} # 바인딩 키: 그 바인딩을 벗어나며 떼어 둔 동적 바인딩 객체
+        self._has_dynamic_instances = False # 동적 바인딩 맵퍼로 읽거나 붙인 적이 있다
+        self._unit_of_work_depth = 0
+        self._unit_of_work_twophase = None
 
     def push_binding(self, key):
+        self.__switch_binding(partial(self.__push_binding_key, key))
+
+    def pop_binding(self, keep_instances=True):
+        if keep_instances:
+            self.__switch_binding(self.__pop_binding_key)
+        else:
+            self.__pop_binding_key()
+
+    def rollback(self):
+        self._stashed_instances = {} # 떼어 둔 객체도 되돌린 트랜잭션에서 쓴 것일 수 있다
+        BaseSignallingSession.rollback(self)
+
+    def close(self):
+        self._stashed_instances = {}
+        self._has_dynamic_instances = False
+        BaseSignallingSession.close(self)
+
+    def _attach(self, state, include_before=False):
+        if self.__is_dynamic_mapper(state.mapper):
+            self._has_dynamic_instances = True
+        BaseSignallingSession._attach(self, state, include_before)
+
+    def begin_unit_of_work(self, two_phase=False):
+        "끝날 때까지 commit 은 flush 만 하고 바인딩 별 트랜잭션을 한꺼번에 커밋한다"
+        if self._unit_of_work_depth == 0 and two_phase:
+            if self.transaction is not None and self.transaction._connections: # 이미 시작한 트랜잭션은 2단계로 바꿀 수 없다
+                raise Exception('NOT_EMPTY_TRANSACTION_FOR_TWO_PHASE:%d' % len(set(self.transaction._connections.values())))
+
+            self._unit_of_work_twophase, self.twophase = self.twophase, True
+
+        self._unit_of_work_depth += 1
+
+    def end_unit_of_work(self, commit=True, parallel=True):
+        self._unit_of_work_depth -= 1
+        if self._unit_of_work_depth: # 바깥 단위 작업이 커밋한다
+            return
+
+        try:
+            if commit:
+                self.__commit_grouped(parallel)
+            else:
+                self.rollback()
+        finally:
+            if self._unit_of_work_twophase is not None:
+                self.twophase, self._unit_of_work_twophase = self._unit_of_work_twophase, None
+
+    def commit(self):
+        if self._unit_of_work_depth: # 단위 작업 안에서는 지금 바인딩으로 쓰기만 한다
+            self.flush()
+        else:
+            BaseSignallingSession.commit(self)
+
+    def __commit_grouped(self, parallel):
+        transaction = self.transaction
+        if transaction is None:
+            return
+
+        self.flush()
+        connection_entries = list(set(transaction._connections.values()))
+        if len(connection_entries) < 2:
+            BaseSignallingSession.commit(self)
+            return
+
+        worker_pool = self._db.get_worker_pool(self.app)
+        def run(func):
+            # pysqlite 커넥션은 만든 스레드에서만 쓸 수 있다 (QueuePool, StaticPool 은 check_same_thread=False 로 연다)
+            parallel_entries = []
+            results = {}
+            for connection, connection_transaction, autoclose in connection_entries:
+                if parallel and (connection.engine.dialect.name != 'sqlite' or isinstance(connection.engine.pool, (QueuePool, StaticPool))):
+                    parallel_entries.append(connection_transaction)
+                else:
+                    results[connection_transaction] = func(connection_transaction)
+
+            results.update(zip(parallel_entries, worker_pool.map(func, parallel_entries)))
+            return results
+
+        def call(method_name):
+            def call_method(connection_transaction):
+                try:
+                    getattr(connection_transaction, method_name)()
+                except Exception as e:
+                    return e
+            return call_method
+
+        if self.twophase: # 모두 준비되어야 커밋한다
+            errors = [error for error in run(call('prepare')).values() if error is not None]
+            if errors:
+                self.rollback()
+                raise errors[0]
+
+        errors = run(call('commit'))
+        for key, (connection, connection_transaction, autoclose) in transaction._connections.items():
+            if errors.get(connection_transaction, True) is None:
+                transaction._connections[key] = (connection, _CommittedTransaction(connection_transaction), autoclose)
+
+        failed_engines = [connection.engine for connection, connection_transaction, autoclose in connection_entries if errors[connection_transaction] is not None]
+        if failed_engines:
+            # 되돌리면 커밋한 바인딩의 변경 기록도 지워지므로 그 전에 알린다 (되돌린 뒤에는 새 객체의 기본 키도 없다)
+            committed_changes = [change for change in self._flushed_changes if self._db.get_engine(self.app, bind=change[2]) not in failed_engines]
+            _dispatch_changes(self, committed_changes)
+            self.rollback() # 커밋하지 못한 바인딩만 되돌린다
+            if len(failed_engines) < len(connection_entries):
+                raise Exception('PARTIAL_COMMIT:%s' % ','.join(repr(engine.url) for engine in failed_engines))
+            raise next(error for error in errors.values() if error is not None)
+
+        BaseSignallingSession.commit(self) # 커밋 이벤트와 세션 정리
+
+    def __push_binding_key(self, key):
         self._binding_keys.append(self._binding_key)
         self._binding_key = key
+        self._binding_stack = self._binding_stack + (key,)
 
-    def pop_binding(self):
+    def __pop_binding_key(self):
         self._binding_key = self._binding_keys.pop()
+        self._binding_stack = self._binding_stack[:-1]
+
+    def __switch_binding(self, switch):
+        # 샤드마다 기본 키가 겹치므로 바인딩이 바뀌는 동적 바인딩 객체는 identity map 에서 떼어 두었다가
+        # 같은 바인딩으로 돌아오면 다시 붙인다
+        # 동적 바인딩 객체를 읽거나 붙인 적이 없으면 identity map 을 훑지 않는다
+        if not self._stashed_instances:
+            if not len(self.identity_map) and not self._new:
+                self._has_dynamic_instances = False
+            if not self._has_dynamic_instances:
+                switch()
+                return
+
+        pending_states = list(self._new) + list(self._deleted) + list(self.identity_map._modified)
+        if any(self.__is_dynamic_mapper(state.mapper) for state in pending_states): # 바뀌기 전 바인딩으로 먼저 쓴다
+            self.flush()
+
+        states = [state for state in self.identity_map.all_states() if self.__is_dynamic_mapper(state.mapper)]
+        mappers = set(state.mapper for state in states)
+        for instances in self._stashed_instances.itervalues():
+            mappers.update(orm.object_mapper(instance) for instance in instances)
+
+        previous_binding_keys = self.__resolve_binding_keys(mappers)
+        switch()
+        binding_keys = self.__resolve_binding_keys(mappers)
+
+        for state in states:
+            previous_binding_key = previous_binding_keys[state.mapper]
+            instance = state.obj()
+            if previous_binding_key != binding_keys[state.mapper] and instance is not None:
+                self._expunge_state(state)
+                self._stashed_instances.setdefault(previous_binding_key, []).append(instance)
+
+        for binding_key, instances in self._stashed_instances.items():
+            remaining_instances = []
+            for instance in instances:
+                state = orm.attributes.instance_state(instance)
+                if binding_keys[state.mapper] != binding_key:
+                    remaining_instances.append(instance)
+                elif state.key not in self.identity_map: # 그 사이 다시 읽은 객체가 있으면 그것을 쓴다
+                    self._update_impl(state)
+
+            if remaining_instances:
+                self._stashed_instances[binding_key] = remaining_instances
+            else:
+                del self._stashed_instances[binding_key]
+
+    def __resolve_binding_keys(self, mappers):
+        binding_keys = {}
+        for mapper in mappers:
+            try:
+                binding_keys[mapper] = self.__find_binding_key(mapper)
+            except Exception: # 맞는 바인딩이 없다
+                binding_keys[mapper] = None
+
+        return binding_keys
+
+    def __is_dynamic_mapper(self, mapper):
+        return hasattr(getattr(mapper.mapped_table, 'info', {}).get('bind_key'), 'match')
+
+    def get_binding_key(self, mapper):
+        "복제본으로 보내기 전의 바인딩 키 (기본 DB 는 None)"
+        return self.__find_binding_key(mapper)
 
     def get_bind(self, mapper, clause=None):
-        binding_key = self.__find_binding_key(mapper)
-        if binding_key is None:
-            return BaseSignallingSession.get_bind(self, mapper, clause)
+        bind_cache = self._db.bind_cache
+        bind_cache.validate(self.app.config)
+
+        cache_key = (mapper, self._binding_stack)
+        cache_value = bind_cache.engines.get(cache_key)
+        if cache_value is None:
+            bind_cache.miss_count += 1
+            binding_key = self.__find_binding_key(mapper)
+            if binding_key is None:
+                engine = BaseSignallingSession.get_bind(self, mapper, clause)
+                if mapper is None: # 맵퍼가 없으면 clause 에 따라 엔진이 달라진다
+                    return engine
+            else:
+                engine = self._db.get_engine(self.app, bind=binding_key)
+
+            is_dynamic = mapper is not None and self.__is_dynamic_mapper(mapper)
+            bind_cache.engines[cache_key] = (binding_key, engine, is_dynamic)
         else:
-            state = get_state(self.app)
-            return state.db.get_engine(self.app, bind=binding_key)
+            bind_cache.hit_count += 1
+            binding_key, engine, is_dynamic = cache_value
+
+        if is_dynamic: # 이 맵퍼로 읽은 객체는 바인딩을 바꿀 때 떼어 두어야 한다
+            self._has_dynamic_instances = True
+
+        if binding_key is None:
+            return engine
+
+        replica_group = self._db.replica_router.get_group(self.app, binding_key)
+        if replica_group is None:
+            return engine
+
+        return self.__route_replica(replica_group, engine, clause)
+
+    def __route_replica(self, replica_group, master_engine, clause):
+        master_key = replica_group.master_key
+        if master_key not in self._written_binding_keys:
+            # FOR UPDATE 는 잠금이 필요하므로 쓰기처럼 마스터로 보낸다
+            if not self._flushing and isinstance(clause, Select) and clause._for_update_arg is None and self._is_clean(): # 쓰기가 없는 읽기
+                replica_key = replica_group.pick_replica_key()
+                if replica_key != master_key:
+                    replica_engine = self._db.get_engine(self.app, bind=replica_key)
+                    replica_group.watch_load(replica_key, replica_engine)
+                    return replica_engine
+
+                return master_engine
+
+            self._written_binding_keys.add(master_key) # 쓰기 이후는 마스터에 고정
+
+        return master_engine
 
     def __find_binding_key(self, mapper):
         if mapper is None: # 맵퍼 없음
@@ -70,7 +467,7 @@ class _SignallingSession(BaseSignallingSession):
                 if type(mapped_binding_key) is str: # 정적 바인딩
                     return mapped_binding_key
                 else: # 동적 바인딩
-                    if mapped_binding_key.match(self._binding_key): # 현재 바인딩
+                    if self._binding_key and mapped_binding_key.match(self._binding_key): # 현재 바인딩
                         return self._binding_key
                     else: # 푸쉬된 바인딩
                         for pushed_binding_key in reversed(self._binding_keys):
@@ -82,21 +479,153 @@ class _SignallingSession(BaseSignallingSession):
                 return self._binding_key
 
 
+def _dispatch_changes(session, changes):
+    if changes:
+        changes = [(instance, operation) for instance, operation, binding_key in changes]
+        for commit_listener in session._db.commit_listeners:
+            commit_listener(session, changes)
+
+@event.listens_for(_SignallingSession, 'after_flush')
+def _record_flushed_changes(session, flush_context):
+    # 일부 바인딩만 커밋되었을 때 그 바인딩의 변경만 알리도록 바인딩 키를 같이 남긴다
+    for instances, operation in ((session.new, 'insert'), (session.dirty, 'update'), (session.deleted, 'delete')):
+        session._flushed_changes.extend((instance, operation, session.get_binding_key(orm.object_mapper(instance))) for instance in instances)
+
+@event.listens_for(_SignallingSession, 'after_commit')
+def _dispatch_committed_changes(session):
+    changes, session._flushed_changes = session._flushed_changes, []
+    _dispatch_changes(session, changes)
+
+@event.listens_for(_SignallingSession, 'after_soft_rollback')
+def _discard_flushed_changes(session, previous_transaction):
+    session._flushed_changes = []
+
+
 class SQLAlchemy(BaseSQLAlchemy):
+    def __init__(self, *args, **kwargs):
+        self.bind_cache = _BindCache()
+        self.config_version = 0 # invalidate_bind_cache() 를 부를 때마다 올린다
+        self.engine_listeners = []
+        self.commit_listeners = []
+        self.replica_router = ReplicaRouter(self)
+        self.pool_manager = PoolManager(self)
+        self.sqlite_tuner = SQLiteTuner(self)
+        self.replica_refresher = SQLiteReplicaRefresher(self)
+        self.query_cache = QueryCache(self)
+        self._worker_pool = None
+        self._worker_pool_lock = threading.Lock()
+        self._tables_for_bind = {}
+        self._tables_for_bind_names = frozenset()
+        BaseSQLAlchemy.__init__(self, *args, **kwargs)
+        self.Query = CachingQuery
+
     def BindingKeyPattern(self, pattern):
         return _BindingKeyPattern(self, pattern)
 
-    def binding(self, key):
-        return _BoundSection(self.session, key)
+    def binding(self, key, close=False):
+        "close 면 블럭이 끝날 때 세션을 닫는다 (identity map 과 커넥션을 버린다)"
+        return _BoundSection(self.session, key, close)
+
+    def unit_of_work(self, two_phase=False, parallel=True):
+        "블럭 안의 commit 을 모아 끝날 때 바인딩 별 트랜잭션을 병렬로 커밋한다"
+        return _UnitOfWork(self.session, two_phase, parallel)
+
+    def across_shards(self, model):
+        "모든 샤드에 동시에 보내는 질의"
+        return ShardQuery(self, model)
+
+    def dual_read(self, model, shard_value, query_func):
+        "리밸런싱 중에는 새 샤드에서 못 찾으면 이전 샤드에서 읽는다"
+        for shard_key in model.__table__.info['bind_key'].get_read_shard_keys(shard_value):
+            with self.binding(shard_key):
+                result = query_func()
+            if result is not None:
+                return result
+
+        return None
+
+    def create_session(self, options=None):
+        "범위 밖에서 쓰는 독립 세션"
+        options = dict(options or {})
+        options.setdefault('query_cls', CachingQuery)
+        return _SignallingSession(self, **options)
+
+    def get_worker_pool(self, app=None):
+        "바인딩 별 병렬 작업용 스레드 풀"
+        with self._worker_pool_lock:
+            if self._worker_pool is None:
+                self._worker_pool = ThreadPool(self.get_app(app).config.get('SQLALCHEMY_WORKER_POOL_SIZE') or 8)
+
+            return self._worker_pool
+
+    def make_connector(self, app, bind=None):
+        return _EngineConnector(self, app, bind)
 
     def create_scoped_session(self, options=None):
         if options is None:
             options = {}
         scopefunc=options.pop('scopefunc', None)
+        options.setdefault('query_cls', CachingQuery)
         return orm.scoped_session(
             partial(_SignallingSession, self, **options), scopefunc=scopefunc
         )
 
+    def make_declarative_base(self):
+        base = BaseSQLAlchemy.make_declarative_base(self)
+        base.query_class = CachingQuery
+        return base
+
+    def get_query_cache_stats(self):
+        "질의 결과 캐시 적중률"
+        return self.query_cache.get_stats()
+
+    def get_bind_cache_stats(self):
+        "get_bind 캐시 적중률"
+        return self.bind_cache.get_stats()
+
+    def invalidate_bind_cache(self):
+        "바인딩 설정 값을 제자리에서 고친 뒤 부른다 (샤드 링과 복제본 그룹도 다시 만든다)"
+        self.config_version += 1
+        self.bind_cache.clear()
+
+    def check_replicas(self, app=None):
+        "복제본 지연을 한 번 검사한다"
+        app = self.get_app(app)
+        self.replica_router.get_group(app, None)
+        self.replica_router.check_all(app)
+        return dict((master_key, dict(group.lags)) for master_key, group in self.replica_router.groups.iteritems())
+
+    def start_replica_monitor(self, app=None):
+        app = self.get_app(app)
+        self.replica_router.start_monitor(app)
+        self.replica_refresher.start(app)
+
+    def refresh_replicas(self, app=None):
+        "sqlite 복제본을 마스터의 새 스냅샷으로 한 번 바꾼다"
+        return self.replica_refresher.refresh_all(self.get_app(app))
+
+    def get_replica_ages(self):
+        "sqlite 복제본 별 마지막 스냅샷 이후 지난 초"
+        return self.replica_refresher.get_ages()
+
+    def prepare_pools(self, app=None):
+        "모든 바인딩 풀을 미리 채운다"
+        return self.pool_manager.prepare(self.get_app(app))
+
+    def get_pool_stats(self, app=None):
+        "바인딩 별 커넥션 풀 통계"
+        return self.pool_manager.get_stats(self.get_app(app))
+
+    def dispose_engines(self, app=None):
+        "fork 이후 부모 프로세스의 커넥션과 스레드를 버린다"
+        for connector in get_state(self.get_app(app)).connectors.values():
+            if connector._engine is not None: # 설정에서 빠진 바인딩의 커넥터도 남아 있으므로 만든 엔진만 버린다
+                connector._engine.dispose()
+
+        self.bind_cache.clear()
+        with self._worker_pool_lock:
+            self._worker_pool = None
+
     def get_binds(self, app=None):
         retval = BaseSQLAlchemy.get_binds(self, app)
        
@@ -107,19 +636,90 @@ class SQLAlchemy(BaseSQLAlchemy):
         return retval
 
     def get_tables_for_bind(self, bind=None):
-        result = []
-        for table in self.Model.metadata.tables.itervalues():
-            table_bind_key = table.info.get('bind_key')
-            if table_bind_key == bind:
-                result.append(table)
+        tables = self.Model.metadata.tables
+        table_names = frozenset(tables)
+        if table_names != self._tables_for_bind_names: # 테이블이 추가되거나 빠지면 다시 모은다 (수만 보면 바꿔치기를 놓친다)
+            self._tables_for_bind = {}
+            self._tables_for_bind_names = table_names
+
+        result = self._tables_for_bind.get(bind)
+        if result is None:
+            result = []
+            for table in tables.itervalues():
+                table_bind_key = table.info.get('bind_key')
+                if table_bind_key == bind:
+                    result.append(table)
+                elif bind and type(table_bind_key) is _BindingKeyPattern and table_bind_key.match(bind):
+                    result.append(table)
+
+            self._tables_for_bind[bind] = result
+
+        return list(result) # 부른 쪽이 고쳐도 색인은 그대로 둔다
+
+    def create_all(self, bind='__all__', app=None, parallel=True):
+        return self._execute_for_all_tables(app, bind, 'create_all', parallel)
+
+    def drop_all(self, bind='__all__', app=None, parallel=True):
+        return self._execute_for_all_tables(app, bind, 'drop_all', parallel)
+
+    def create_missing(self, bind='__all__', app=None, parallel=True):
+        "없는 테이블과 인덱스만 만든다"
+        return self._execute_for_all_tables(app, bind, 'create_missing', parallel)
+
+    def _execute_for_all_tables(self, app, bind, operation, parallel=False):
+        "바인딩 별 DDL 을 worker 풀에서 동시에 실행하고 (바인딩 키, 테이블 수, 시간, 만든 것) 목록을 돌려준다"
+        app = self.get_app(app)
+        if bind == '__all__':
+            binds = [None] + list(app.config.get('SQLALCHEMY_BINDS') or ())
+        elif isinstance(bind, basestring) or bind is None:
+            binds = [bind]
+        else:
+            binds = bind
+
+        def execute(bind):
+            start_time = time.time()
+            engine = self.get_engine(app, bind)
+            tables = self.get_tables_for_bind(bind)
+            if operation == 'create_missing':
+                created_names = self._create_missing(engine, tables)
             else:
-                if bind:
-                    if type(table_bind_key) is _BindingKeyPattern and table_bind_key.match(bind):
-                        result.append(table)
-                    elif type(table_bind_key) is str and table_bind_key == bind:
-                        result.append(table)
-
-        return result
+                getattr(self.Model.metadata, operation)(bind=engine, tables=tables)
+                created_names = None
+
+            return bind, len(tables), time.time() - start_time, created_names
+
+        results = []
+        parallel_binds = []
+        for bind in binds:
+            if parallel and not is_memory_database(self.get_engine(app, bind).url):
+                parallel_binds.append(bind)
+            else: # 메모리 DB 는 스레드마다 커넥션이 달라 부른 스레드에서 한다
+                results.append(execute(bind))
+
+        if parallel_binds:
+            results.extend(self.get_worker_pool(app).map(execute, parallel_binds))
+
+        return results
+
+    def _create_missing(self, engine, tables):
+        inspector = inspect(engine)
+        existing_table_names = set(inspector.get_table_names())
+        missing_tables = [table for table in tables if table.name not in existing_table_names]
+        if missing_tables:
+            self.Model.metadata.create_all(bind=engine, tables=missing_tables)
+
+        created_names = [table.name for table in missing_tables]
+        for table in tables:
+            if table.name not in existing_table_names:
+                continue
+
+            existing_index_names = set(index['name'] for index in inspector.get_indexes(table.name))
+            for index in table.indexes:
+                if index.name not in existing_index_names:
+                    index.create(bind=engine)
+                    created_names.append(index.name)
+
+        return created_names
 
 
 if __name__ == '__main__':
@@ -1,14 +1,22 @@
 # -*- coding:utf8 -*-
 import os
 import yaml
+import cPickle
 import logging
 
+from hashlib import md5
+
 from logging.handlers import RotatingFileHandler
 
+from logqueue import QueueLogHandler
+from cache import check_cache_backend
+
 
 class Environments(object):
     SQLITE_SCHEMA = 'sqlite:///'
     SQLITE_URI_MEMORY = 'sqlite:///:memory:'
+    CONFIG_SNAPSHOT_VERSION = 2
+    YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader) # libyaml 이 있으면 C 로더
 
     def __init__(self, app, server_dir_path):
         project_dir_path = os.path.dirname(server_dir_path)
@@ -33,11 +41,57 @@ class Environments(object):
 
         self.app.config['LOG_FORMAT'] = "%(asctime)-15s %(message)s"
 
+        self.app.config['LOG_QUEUE_ENABLE'] = True
+        self.app.config['LOG_QUEUE_MAX_SIZE'] = 10000
+        self.app.config['LOG_QUEUE_BATCH_SIZE'] = 100
+
         self.app.config['SQLALCHEMY_DATABASE_URI'] = self.SQLITE_URI_MEMORY
         self.app.config['SQLALCHEMY_BINDS'] = {} 
         self.app.config['SQLALCHEMY_ECHO'] = True
+        self.app.config['SQLALCHEMY_SHARD_VIRTUAL_NODES'] = 100
+        self.app.config['SQLALCHEMY_SHARD_WEIGHTS'] = {}
+        self.app.config['SQLALCHEMY_SHARD_PREVIOUS_WEIGHTS'] = {}
+        self.app.config['SQLALCHEMY_REPLICAS'] = {}
+        self.app.config['SQLALCHEMY_REPLICA_POLICY'] = 'round_robin'
+        self.app.config['SQLALCHEMY_REPLICA_MAX_LAG'] = 10
+        self.app.config['SQLALCHEMY_REPLICA_CHECK_INTERVAL'] = 5
+        self.app.config['SQLALCHEMY_REPLICA_REFRESH'] = {}
+        self.app.config['SQLALCHEMY_WORKER_POOL_SIZE'] = 8
+        self.app.config['SQLALCHEMY_POOLS'] = {}
+        self.app.config['SQLALCHEMY_POOL_WARMUP'] = True
+        self.app.config['SQLALCHEMY_SQLITE_PROFILE'] = {}
+        self.app.config['SQLALCHEMY_SQLITE_PROFILES'] = {}
+        self.app.config['SQLALCHEMY_PROFILE'] = False
+        self.app.config['SQLALCHEMY_PROFILE_REPEAT_THRESHOLD'] = 5
+        self.app.config['SQLALCHEMY_PROFILE_DUMP_INTERVAL'] = 100
+
+        self.app.config['LAST_SEEN_WRITE_BEHIND'] = True
+        self.app.config['LAST_SEEN_FLUSH_INTERVAL'] = 10
+        self.app.config['LAST_SEEN_FLUSH_SIZE'] = 500
+
+        self.app.config['USER_CACHE_ENABLE'] = True
+        self.app.config['USER_CACHE_TYPE'] = 'memory'
+        self.app.config['USER_CACHE_SIZE'] = 10000
+        self.app.config['USER_CACHE_TTL'] = 300
+
+        self.app.config['POSTS_PER_PAGE'] = 20
+
+        self.app.config['SERVER_WORKERS'] = 0
+
+        self.app.config['PAGE_CACHE_ENABLE'] = True
+        self.app.config['PAGE_CACHE_TYPE'] = 'memory'
+        self.app.config['PAGE_CACHE_SIZE'] = 1000
+        self.app.config['PAGE_CACHE_TTL'] = 60
+
+        self.app.config['QUERY_CACHE_ENABLE'] = False
+        self.app.config['QUERY_CACHE_TYPE'] = 'memory'
+        self.app.config['QUERY_CACHE_SIZE'] = 10000
+        self.app.config['QUERY_CACHE_TTL'] = 60
 
         self.log_formatter = None
+        self.log_file_handlers = []
+        self.log_queue_handler = None
+        self.loaded_config_snapshot = False
 
     def __repr__(self):
         return '#### environments\n%s' % '\n'.join(sorted('* %s: %s' % (key, value) for key, value in self.app.config.items()))
@@ -55,29 +109,67 @@ class Environments(object):
     def convert_project_path(self, src_path):
         return os.path.normpath(os.path.join(self.project_dir_path, src_path))
 
-    def load_config_file(self, config_file_path):
-        "설정 파일을 불러온다"
-
+    def convert_database_uri(self, db_uri):
+        "SQLITE uri 경로를 실제 경로로 변경"
+        if db_uri.startswith(self.SQLITE_SCHEMA) and db_uri != self.SQLITE_URI_MEMORY:
+            return self.SQLITE_SCHEMA + self.convert_project_path(db_uri[len(self.SQLITE_SCHEMA):])
+        else:
+            return db_uri
+
+    def load_config_file(self, config_file_path, use_snapshot=True):
+        "설정 파일을 불러온다 (해석한 설정을 temp 에 스냅샷으로 남겨 내용이 같으면 다음 시작에 그대로 쓴다)"
+        config_file_real_path = self.convert_project_path(config_file_path)
+        snapshot_file_path = self._get_config_snapshot_path(config_file_real_path)
         try:
-            with self._open_file(config_file_path) as config_file:
-                self.load_config_dict(yaml.load(config_file))
-        except IOError as e:
+            with open(config_file_real_path, 'rb') as config_file:
+                config_source = config_file.read()
+        except (IOError, OSError) as e:
             print('Solution:')
             print('\tcp configs/template.yml %s' % config_file_path)
             print('')
             raise
 
+        # mtime 과 크기는 같은 초 안의 같은 길이 수정을 놓치므로 언제나 내용 digest 로 비교한다
+        config_digest = md5(config_source).hexdigest()
+        snapshot = self._load_config_snapshot(snapshot_file_path) if use_snapshot else None
+        if snapshot and snapshot['digest'] == config_digest:
+            self.app.config.update(snapshot['config'])
+            self.loaded_config_snapshot = True
+            return
+
+        config = self.compile_config_dict(yaml.load(config_source, Loader=self.YAML_LOADER))
+        self.loaded_config_snapshot = False
+        if use_snapshot:
+            self._save_config_snapshot(snapshot_file_path, dict(
+                version=self.CONFIG_SNAPSHOT_VERSION,
+                digest=config_digest,
+                config=config))
+
+        self.app.config.update(config)
+
     def load_config_dict(self, config_dict):
         "설정 사전을 불러온다"
-        if config_dict:
-            for config_key, config_value in config_dict.iteritems():
-                if config_key == 'SQLALCHEMY_DATABASE_URI':
-                    if config_value.startswith(self.SQLITE_SCHEMA): # SQLITE uri 경로를 실제 경로로 변경
-                        self.app.config[config_key] = self.SQLITE_SCHEMA + self.convert_project_path(config_value[len(self.SQLITE_SCHEMA):])
-                elif config_key == 'SQLALCHEMY_BINDS': # SQLITE uri 경로를 실제 경로로 변경
-                    self.app.config[config_key] = dict((bind_key, self.SQLITE_SCHEMA + self.convert_project_path(bind_value[len(self.SQLITE_SCHEMA):])) for bind_key, bind_value in config_value)
-                else:
-                    self.app.config[config_key] = config_value
+        self.app.config.update(self.compile_config_dict(config_dict))
+
+    def compile_config_dict(self, config_dict):
+        "값 타입을 검사하고 sqlite 경로를 실제 경로로 바꾼 설정 사전"
+        if config_dict is None:
+            return {}
+
+        if not isinstance(config_dict, dict):
+            raise Exception('WRONG_CONFIG_ROOT:%s' % type(config_dict).__name__)
+
+        compiled_config = {}
+        for config_key, config_value in config_dict.iteritems():
+            self._validate_config_value(config_key, config_value)
+            if config_key == 'SQLALCHEMY_DATABASE_URI':
+                compiled_config[config_key] = self.convert_database_uri(config_value)
+            elif config_key == 'SQLALCHEMY_BINDS':
+                compiled_config[config_key] = dict((bind_key, self.convert_database_uri(bind_value)) for bind_key, bind_value in (config_value or {}).iteritems())
+            else:
+                compiled_config[config_key] = config_value
+
+        return compiled_config
 
     def prepare_all(self):
         "모든 환경을 준비한다"
@@ -86,12 +178,64 @@ class Environments(object):
         self._prepare_debug_log()
         self._prepare_error_log()
         self._prepare_info_log()
+        self._prepare_log_handlers()
 
         self._prepare_sqlalchemy_database(self.app.config['SQLALCHEMY_DATABASE_URI'])
 
         for bind_uri in self.app.config['SQLALCHEMY_BINDS'].values():
             self._prepare_sqlalchemy_database(bind_uri)
 
+        self._prepare_sqlalchemy_pools()
+
+        self._validate_cache_backends()
+
+    def _validate_config_value(self, config_key, config_value):
+        # 기본값이 있는 키는 기본값과 같은 종류의 값만 받는다
+        default_value = self.app.config.get(config_key)
+        if default_value is None or config_value is None:
+            return
+
+        if isinstance(default_value, bool):
+            expected_types = bool
+        elif isinstance(default_value, (int, long, float)):
+            expected_types = (int, long, float)
+        elif isinstance(default_value, basestring):
+            expected_types = basestring
+        elif isinstance(default_value, (dict, list)):
+            expected_types = type(default_value)
+        else:
+            return
+
+        if not isinstance(config_value, expected_types) or (expected_types is not bool and isinstance(config_value, bool)):
+            raise Exception('WRONG_CONFIG_TYPE:%s=%r' % (config_key, config_value))
+
+    def _get_config_snapshot_path(self, config_file_real_path):
+        # 같은 설정 파일이라도 프로젝트 위치가 다르면 해석한 경로가 다르다
+        snapshot_key = md5('%s\0%s' % (config_file_real_path, self.project_dir_path)).hexdigest()
+        return os.path.join(self.temp_dir_path, 'config_snapshots', snapshot_key + '.pickle')
+
+    def _load_config_snapshot(self, snapshot_file_path):
+        try:
+            with open(snapshot_file_path, 'rb') as snapshot_file:
+                snapshot = cPickle.load(snapshot_file)
+        except Exception: # 없거나 깨진 스냅샷은 다시 만든다
+            return None
+
+        if not isinstance(snapshot, dict) or snapshot.get('version') != self.CONFIG_SNAPSHOT_VERSION:
+            return None
+
+        return snapshot
+
+    def _save_config_snapshot(self, snapshot_file_path, snapshot):
+        temp_file_path = '%s.%d' % (snapshot_file_path, os.getpid())
+        try:
+            self._make_directory(os.path.dirname(snapshot_file_path))
+            with open(temp_file_path, 'wb') as snapshot_file:
+                cPickle.dump(snapshot, snapshot_file, cPickle.HIGHEST_PROTOCOL)
+            os.rename(temp_file_path, snapshot_file_path) # 워커들이 반쯤 쓴 파일을 읽지 않도록
+        except (IOError, OSError):
+            pass
+
     def _open_file(self, file_path, *args, **kwargs):
         file_real_path = self.convert_project_path(file_path)
         return open(file_real_path, *args, **kwargs)
@@ -142,7 +286,18 @@ class Environments(object):
         if self.log_formatter:
             log_file_handler.setFormatter(self.log_formatter)
 
-        self.app.logger.addHandler(log_file_handler)
+        self.log_file_handlers.append(log_file_handler)
+
+    def _prepare_log_handlers(self):
+        if self.app.config['LOG_QUEUE_ENABLE']: # 쓰기 스레드 하나가 파일들에 나눠 쓴다
+            self.log_queue_handler = QueueLogHandler(
+                self.log_file_handlers,
+                max_size=self.app.config['LOG_QUEUE_MAX_SIZE'],
+                batch_size=self.app.config['LOG_QUEUE_BATCH_SIZE'])
+            self.app.logger.addHandler(self.log_queue_handler)
+        else:
+            for log_file_handler in self.log_file_handlers:
+                self.app.logger.addHandler(log_file_handler)
 
     def _prepare_sqlalchemy_database(self, db_uri):
         if db_uri.startswith(self.SQLITE_SCHEMA):
@@ -152,6 +307,23 @@ class Environments(object):
             
             self._make_directory(data_dir_path)
 
+    def _validate_cache_backends(self):
+        # 워커끼리 나눠 쓸 수 없는 캐시는 띄우기 전에 끄고 알린다
+        for config_key, config_value in self.app.config.items():
+            if config_key.endswith('_CACHE_ENABLE') and config_value:
+                config_prefix = config_key[:-len('_ENABLE')]
+                if not check_cache_backend(self.app.config, config_prefix):
+                    self.app.logger.warning('DISABLED_MEMORY_CACHE_WITH_WORKERS:%s WORKERS:%d', config_prefix, self.app.config['SERVER_WORKERS'])
+                    self.app.config[config_key] = False
+
+    def _prepare_sqlalchemy_pools(self):
+        # 워커가 있으면 fork 한 뒤 post_fork 에서 채운다 (부모에서 연 커넥션은 어차피 버린다)
+        if self.app.config['SERVER_WORKERS'] > 0:
+            return
+
+        if self.app.config['SQLALCHEMY_POOL_WARMUP'] and 'sqlalchemy' in self.app.extensions:
+            self.app.extensions['sqlalchemy'].db.prepare_pools(self.app)
+
 if __name__ == '__main__':
     from flask import Flask
 
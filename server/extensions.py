@@ -0,0 +1,10 @@
+# -*- coding:utf8 -*-
+from flask.ext.login import LoginManager
+from flask.ext.openid import OpenID
+
+from server import app, env
+
+# 로그인을 쓰는 블루프린트를 불러올 때 만든다
+oid = OpenID(app, env.temp_dir_path)
+lm = LoginManager()
+lm.init_app(app)
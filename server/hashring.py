@@ -0,0 +1,143 @@
+# -*- coding:utf8 -*-
+import bisect
+
+from hashlib import md5
+
+
+def stable_hash(value):
+    "프로세스와 무관하게 같은 값을 돌려주는 해시"
+    if type(value) is unicode:
+        value = value.encode('utf8')
+    elif type(value) is not str:
+        value = str(value)
+
+    return int(md5(value).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    HASH_SPACE = 1 << 64
+    DEFAULT_VIRTUAL_NODE_COUNT = 100
+
+    def __init__(self, nodes=(), weights=None, virtual_node_count=DEFAULT_VIRTUAL_NODE_COUNT):
+        self.virtual_node_count = virtual_node_count
+        self.weights = {}
+        self._tokens = []
+        self._token_nodes = []
+
+        weights = weights or {}
+        for node in nodes:
+            self.weights[node] = weights.get(node, 1)
+
+        self._build()
+
+    def __repr__(self):
+        return "%s<%s>" % (self.__class__.__name__, ','.join(self.nodes))
+
+    def __len__(self):
+        return len(self.weights)
+
+    @property
+    def nodes(self):
+        return sorted(self.weights)
+
+    def copy(self):
+        return HashRing(self.nodes, self.weights, self.virtual_node_count)
+
+    def add_node(self, node, weight=1):
+        self.weights[node] = weight
+        self._build()
+
+    def remove_node(self, node):
+        del self.weights[node]
+        self._build()
+
+    def get_node(self, key):
+        if not self._tokens:
+            raise Exception('EMPTY_HASH_RING')
+
+        index = bisect.bisect(self._tokens, stable_hash(key))
+        if index == len(self._tokens):
+            index = 0
+
+        return self._token_nodes[index]
+
+    def plan(self, new_ring):
+        "new_ring 으로 바꿀 때 소유자가 바뀌는 토큰 구간 목록을 계산한다"
+        boundaries = sorted(set(self._tokens) | set(new_ring._tokens))
+        moves = []
+        for index, end_token in enumerate(boundaries):
+            start_token = boundaries[index - 1] if index > 0 else boundaries[-1]
+            src_node = self._get_token_owner(end_token)
+            dst_node = new_ring._get_token_owner(end_token)
+            if src_node != dst_node:
+                if moves and moves[-1][1] == start_token and moves[-1][2:] == (src_node, dst_node):
+                    moves[-1] = (moves[-1][0], end_token, src_node, dst_node)
+                else:
+                    moves.append((start_token, end_token, src_node, dst_node))
+
+        return _RingChangePlan(moves)
+
+    def plan_add(self, node, weight=1):
+        new_ring = self.copy()
+        new_ring.add_node(node, weight)
+        return self.plan(new_ring)
+
+    def plan_remove(self, node):
+        new_ring = self.copy()
+        new_ring.remove_node(node)
+        return self.plan(new_ring)
+
+    def _get_token_owner(self, token):
+        # 구간 (이전 토큰, token] 은 token 이상인 첫 토큰의 노드가 소유한다
+        index = bisect.bisect_left(self._tokens, token)
+        if index == len(self._tokens):
+            index = 0
+
+        return self._token_nodes[index]
+
+    def _build(self):
+        points = []
+        for node, weight in self.weights.iteritems():
+            for replica_index in xrange(int(self.virtual_node_count * weight)):
+                points.append((stable_hash('%s#%d' % (node, replica_index)), node))
+
+        points.sort()
+        self._tokens = [token for token, node in points]
+        self._token_nodes = [node for token, node in points]
+
+
+class _RingChangePlan(object):
+    def __init__(self, moves):
+        self.moves = moves
+
+    def __repr__(self):
+        return "%s<moves=%d ratio=%.4f>" % (self.__class__.__name__, len(self.moves), self.moved_ratio)
+
+    @property
+    def moved_ratio(self):
+        "전체 키 공간 중 이동하는 비율"
+        return sum(self._get_span(start_token, end_token) for start_token, end_token, src_node, dst_node in self.moves) / float(HashRing.HASH_SPACE)
+
+    def get_transfers(self):
+        "(원본 노드, 대상 노드) 별 이동 비율"
+        transfers = {}
+        for start_token, end_token, src_node, dst_node in self.moves:
+            span = self._get_span(start_token, end_token) / float(HashRing.HASH_SPACE)
+            transfers[(src_node, dst_node)] = transfers.get((src_node, dst_node), 0.0) + span
+
+        return transfers
+
+    def is_moved(self, key):
+        token = stable_hash(key)
+        for start_token, end_token, src_node, dst_node in self.moves:
+            if start_token < end_token:
+                if start_token < token <= end_token:
+                    return True
+            elif token > start_token or token <= end_token: # 링 경계를 넘는 구간
+                return True
+
+        return False
+
+    @staticmethod
+    def _get_span(start_token, end_token):
+        return (end_token - start_token) % HashRing.HASH_SPACE
@@ -0,0 +1,128 @@
+# -*- coding:utf8 -*-
+import time
+import itertools
+
+from datetime import datetime
+
+from sqlalchemy import DateTime, Date
+
+from pooling import is_memory_database
+
+
+class IngestResult(object):
+    def __init__(self):
+        self.row_count = 0
+        self.batch_count = 0
+        self.bind_row_counts = {}
+        self.elapsed = 0.0
+
+    def __repr__(self):
+        return "%s<rows=%d batches=%d %.0f rows/s>" % (self.__class__.__name__, self.row_count, self.batch_count, self.rows_per_sec)
+
+    @property
+    def rows_per_sec(self):
+        return self.row_count / self.elapsed if self.elapsed else 0.0
+
+
+class BulkIngester(object):
+    "행을 바인딩 키 별로 모아 배치 단위 executemany 로 넣고 샤드끼리는 동시에 쓴다"
+
+    DATETIME_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S')
+
+    def __init__(self, db, model, batch_size=1000, shard_column=None, binding_key=None):
+        self.db = db
+        self.model = model
+        self.table = model.__table__
+        self.batch_size = batch_size
+        self.shard_column = shard_column
+        self.binding_key = binding_key
+
+    def __repr__(self):
+        return "%s<%s>" % (self.__class__.__name__, self.model.__name__)
+
+    def get_binding_key(self, row):
+        "행이 들어갈 바인딩 키 (None 이면 디폴트)"
+        mapped_binding_key = self.table.info.get('bind_key')
+        if not mapped_binding_key or type(mapped_binding_key) is str: # 정적 바인딩
+            return mapped_binding_key
+
+        if self.shard_column is not None:
+            if self.shard_column not in row:
+                raise Exception('MISSING_SHARD_COLUMN:%s MODEL:%s' % (self.shard_column, self.model.__name__))
+            return mapped_binding_key.get_shard_key(row[self.shard_column])
+
+        if self.binding_key and mapped_binding_key.match(self.binding_key):
+            return self.binding_key
+
+        raise Exception('NOT_FOUND_INGEST_BINDING:%s BINDING:%s' % (repr(mapped_binding_key), repr(self.binding_key)))
+
+    def coerce_row(self, row):
+        "JSON 문자열로 온 날짜 값을 컬럼 타입에 맞춘다"
+        for column in self.table.columns:
+            value = row.get(column.key)
+            if isinstance(value, basestring) and isinstance(column.type, (DateTime, Date)):
+                row[column.key] = self._parse_datetime(value, column)
+
+        return row
+
+    def ingest(self, rows, app=None):
+        app = self.db.get_app(app)
+        pool = self.db.get_worker_pool(app)
+        result = IngestResult()
+        pending_batches = {}
+        pending_results = {}
+        start_time = time.time()
+
+        def submit(binding_key):
+            batch = pending_batches.pop(binding_key)
+            previous_result = pending_results.get(binding_key)
+            if previous_result is not None: # 같은 샤드의 배치는 순서대로 하나씩
+                previous_result.get()
+
+            engine = self.db.get_engine(app, bind=binding_key)
+            if is_memory_database(engine.url): # 메모리 DB 는 스레드마다 커넥션이 달라 부른 스레드에서 넣는다
+                self._insert_batch(engine, batch)
+            else:
+                pending_results[binding_key] = pool.apply_async(self._insert_batch, (engine, batch))
+            result.batch_count += 1
+            result.bind_row_counts[binding_key] = result.bind_row_counts.get(binding_key, 0) + len(batch)
+
+        for row in rows:
+            binding_key = self.get_binding_key(row)
+            batch = pending_batches.setdefault(binding_key, [])
+            batch.append(row)
+            result.row_count += 1
+            if len(batch) >= self.batch_size:
+                submit(binding_key)
+
+        for binding_key in pending_batches.keys():
+            submit(binding_key)
+
+        for pending_result in pending_results.itervalues():
+            pending_result.get()
+
+        result.elapsed = time.time() - start_time
+        return result
+
+    def _insert_batch(self, engine, batch):
+        # executemany 는 첫 행의 키로 문장을 만들므로 키가 같은 연속 행끼리 나눈다 (빠진 컬럼은 기본값을 쓴다)
+        with engine.begin() as connection: # 배치 당 트랜잭션 하나
+            for keys, rows in itertools.groupby(batch, lambda row: frozenset(row)):
+                connection.execute(self.table.insert(), list(rows))
+
+    def _parse_datetime(self, value, column):
+        for datetime_format in self.DATETIME_FORMATS:
+            try:
+                parsed_value = datetime.strptime(value, datetime_format)
+            except ValueError:
+                continue
+
+            return parsed_value if isinstance(column.type, DateTime) else parsed_value.date()
+
+        if isinstance(column.type, Date):
+            try:
+                return datetime.strptime(value, '%Y-%m-%d').date()
+            except ValueError:
+                pass
+
+        raise Exception('WRONG_DATETIME_VALUE:%s=%s' % (column.key, value))
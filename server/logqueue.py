@@ -0,0 +1,129 @@
+# -*- coding:utf8 -*-
+import os
+import Queue
+import logging
+import threading
+
+
+def _write_line(stream, msg):
+    # StreamHandler.emit 과 같이 유니코드는 스트림 인코딩으로, 안 되면 utf-8 로 쓴다 (flush 는 모아서 한다)
+    try:
+        if isinstance(msg, unicode) and getattr(stream, 'encoding', None):
+            try:
+                stream.write(u'%s\n' % msg)
+            except UnicodeEncodeError:
+                stream.write((u'%s\n' % msg).encode(stream.encoding))
+        else:
+            stream.write('%s\n' % msg)
+    except UnicodeError:
+        stream.write('%s\n' % msg.encode('utf-8'))
+
+
+class QueueLogHandler(logging.Handler):
+    "요청 스레드는 큐에 넣기만 하고 쓰기 스레드가 파일 핸들러들에 모아서 쓴다"
+
+    def __init__(self, file_handlers, max_size=10000, batch_size=100):
+        logging.Handler.__init__(self)
+        self.file_handlers = file_handlers
+        self.batch_size = batch_size
+        self.dropped_count = 0
+        self._reported_dropped_count = 0
+        self._queue = Queue.Queue(max_size)
+        self._stop_record = object()
+        self._writer_thread = None
+        self._writer_pid = None
+        self._writer_lock = threading.Lock()
+
+    def emit(self, record):
+        try:
+            self._start_writer()
+            self._queue.put_nowait(self._prepare(record))
+        except Queue.Full: # 과부하면 버리고 센다
+            self.dropped_count += 1
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        "큐에 남은 기록을 모두 쓰고 파일을 닫는다"
+        if self._writer_pid == os.getpid() and self._writer_thread.is_alive():
+            self._queue.put(self._stop_record)
+            self._writer_thread.join()
+
+        for file_handler in self.file_handlers:
+            file_handler.close()
+
+        logging.Handler.close(self)
+
+    def _start_writer(self):
+        # fork 한 자식에는 쓰기 스레드가 없으므로 프로세스마다 처음 쓸 때 띄운다
+        if self._writer_pid == os.getpid():
+            return
+
+        with self._writer_lock:
+            if self._writer_pid == os.getpid():
+                return
+
+            if self._writer_pid is not None: # 부모의 큐에 남은 기록은 부모가 쓴다
+                self._queue = Queue.Queue(self._queue.maxsize)
+                self._reported_dropped_count = self.dropped_count
+
+            self._writer_thread = threading.Thread(target=self._run, name='log-writer')
+            self._writer_thread.daemon = True
+            self._writer_thread.start()
+            self._writer_pid = os.getpid()
+
+    def _prepare(self, record):
+        # 인자와 예외는 지금 문자열로 만들어 두고 나머지 포맷은 쓰기 스레드에서 한다
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+
+        return record
+
+    def _run(self):
+        while True:
+            records = [self._queue.get()]
+            try:
+                while len(records) < self.batch_size:
+                    records.append(self._queue.get_nowait())
+            except Queue.Empty:
+                pass
+
+            stopped = self._stop_record in records
+            if stopped:
+                records = [record for record in records if record is not self._stop_record]
+
+            if self.dropped_count != self._reported_dropped_count:
+                records.append(logging.makeLogRecord(dict(
+                    name=__name__, levelno=logging.WARNING, levelname='WARNING',
+                    msg='LOG_QUEUE_DROPPED:%d' % (self.dropped_count - self._reported_dropped_count))))
+                self._reported_dropped_count = self.dropped_count
+
+            self._write(records)
+
+            if stopped:
+                return
+
+    def _write(self, records):
+        for file_handler in self.file_handlers:
+            file_handler.acquire()
+            try:
+                for record in records:
+                    if record.levelno < file_handler.level:
+                        continue
+
+                    try:
+                        if file_handler.shouldRollover(record):
+                            file_handler.doRollover()
+                        if file_handler.stream is None: # delay=True 면 처음 쓸 때 연다
+                            file_handler.stream = file_handler._open()
+                        _write_line(file_handler.stream, file_handler.format(record))
+                    except Exception:
+                        file_handler.handleError(record)
+
+                file_handler.flush()
+            finally:
+                file_handler.release()
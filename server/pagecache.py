@@ -0,0 +1,100 @@
+# -*- coding:utf8 -*-
+import uuid
+import threading
+
+from hashlib import md5
+from functools import wraps
+
+from flask import g, request, session, make_response, Response
+
+from cache import make_cache_backend
+
+
+class PageCache(object):
+    "뷰 응답을 경로, 인자, 사용자 별로 캐시하고 ETag 로 304 를 돌려준다"
+
+    GENERATION_KEY_PREFIX = 'generation:'
+
+    def __init__(self, db, config_prefix='PAGE_CACHE'):
+        self.db = db
+        self.config_prefix = config_prefix
+        self.backend = None
+        self._lock = threading.Lock()
+
+        db.commit_listeners.append(self._on_commit)
+
+    def __repr__(self):
+        return "%s<%r>" % (self.__class__.__name__, self.backend)
+
+    def cached(self, *model_names):
+        "model_names 의 모델이 커밋되면 무효화되는 뷰 캐시"
+        def decorator(view):
+            @wraps(view)
+            def cached_view(*args, **kwargs):
+                backend = self._get_backend()
+                if backend is None or request.method != 'GET' or session.get('_flashes'): # 플래시 메시지가 있는 화면은 캐시하지 않는다
+                    return view(*args, **kwargs)
+
+                cache_key = self._make_key(backend, model_names)
+                entry = backend.get(cache_key)
+                if entry is None:
+                    response = make_response(view(*args, **kwargs))
+                    if response.status_code != 200 or response.direct_passthrough:
+                        return response
+
+                    body = response.get_data()
+                    entry = (md5(body).hexdigest(), body, response.headers.get('Content-Type'))
+                    backend.set(cache_key, entry)
+
+                etag, body, content_type = entry
+                if etag in request.if_none_match: # 렌더링 없이 304
+                    response = Response(status=304)
+                else:
+                    response = Response(body, content_type=content_type)
+
+                response.set_etag(etag)
+                response.headers['Cache-Control'] = 'private, no-cache'
+                return response
+
+            return cached_view
+
+        return decorator
+
+    def invalidate(self, *model_names):
+        backend = self._get_backend()
+        if backend is not None:
+            for model_name in model_names:
+                backend.set(self.GENERATION_KEY_PREFIX + model_name, uuid.uuid4().hex, timeout=0)
+
+    def _get_backend(self):
+        if self.backend is None:
+            config = self.db.get_app().config
+            if not config.get(self.config_prefix + '_ENABLE', False):
+                return None
+
+            with self._lock:
+                if self.backend is None:
+                    self.backend = make_cache_backend(config, self.config_prefix)
+
+        return self.backend
+
+    def _make_key(self, backend, model_names):
+        user = getattr(g, 'user', None)
+        user_key = user.get_id() if user is not None and user.is_authenticated() else 'anonymous'
+
+        generations = []
+        for model_name in model_names:
+            generation = backend.get(self.GENERATION_KEY_PREFIX + model_name)
+            if generation is None: # 세대 값이 없어지면 새로 만들어 옛 항목을 다시 쓰지 않는다
+                generation = uuid.uuid4().hex
+                backend.set(self.GENERATION_KEY_PREFIX + model_name, generation, timeout=0)
+            generations.append(generation)
+
+        view_args = ','.join('%s=%s' % item for item in sorted((request.view_args or {}).iteritems()))
+        return '%s:%s:%s:%s:%s' % (request.endpoint, view_args, request.query_string, user_key, ':'.join(generations))
+
+    def _on_commit(self, session, changes):
+        if self.backend is None:
+            return
+
+        self.invalidate(*set(instance.__class__.__name__ for instance, operation in changes))
@@ -0,0 +1,120 @@
+# -*- coding:utf8 -*-
+import time
+import threading
+
+from flask_sqlalchemy import get_state
+
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+
+
+def is_memory_database(url):
+    return url.drivername == 'sqlite' and url.database in (None, '', ':memory:')
+
+def _ping_connection(dbapi_connection, connection_record, connection_proxy):
+    # 끊긴 커넥션이면 풀이 새 커넥션으로 다시 시도한다
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('SELECT 1')
+    except Exception:
+        raise exc.DisconnectionError()
+    finally:
+        try:
+            cursor.close()
+        except Exception:
+            pass
+
+
+class _TimedQueuePool(QueuePool):
+    "커넥션을 얻기까지 기다린 시간을 잰다"
+
+    def __init__(self, *args, **kwargs):
+        QueuePool.__init__(self, *args, **kwargs)
+        self.checkout_count = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self._stats_lock = threading.Lock()
+
+    def _do_get(self):
+        start_time = time.time()
+        try:
+            return QueuePool._do_get(self)
+        finally:
+            wait_time = time.time() - start_time
+            with self._stats_lock:
+                self.checkout_count += 1
+                self.wait_time += wait_time
+                self.max_wait_time = max(self.max_wait_time, wait_time)
+
+
+class PoolManager(object):
+    "SQLALCHEMY_POOLS 의 바인딩 별 풀 설정, 예열, 통계"
+
+    OPTION_NAMES = dict(size='pool_size', max_overflow='max_overflow', recycle='pool_recycle', timeout='pool_timeout')
+
+    def __init__(self, db):
+        self.db = db
+
+        db.engine_listeners.append(self.watch_engine)
+
+    def get_pool_config(self, app, bind_key):
+        return (app.config.get('SQLALCHEMY_POOLS') or {}).get(bind_key or 'default') or {}
+
+    def apply_options(self, app, bind_key, info, options):
+        "create_engine 옵션에 바인딩 별 풀 설정을 넣는다"
+        pool_config = self.get_pool_config(app, bind_key)
+        if not pool_config:
+            return
+
+        if info.drivername == 'sqlite':
+            if is_memory_database(info) or not pool_config.get('size'): # 메모리 DB 는 싱글톤 풀, 크기 없는 파일 DB 는 NullPool 그대로
+                return
+
+            options['connect_args'] = dict(options.get('connect_args') or {}, check_same_thread=False)
+
+        for config_name, option_name in self.OPTION_NAMES.iteritems():
+            if pool_config.get(config_name) is not None:
+                options[option_name] = pool_config[config_name]
+
+        options['poolclass'] = _TimedQueuePool
+
+    def watch_engine(self, app, bind_key, engine):
+        if self.get_pool_config(app, bind_key).get('pre_ping'):
+            event.listen(engine, 'checkout', _ping_connection)
+
+    def prepare(self, app):
+        "모든 바인딩의 엔진을 만들고 커넥션을 미리 열어 둔다"
+        def warm(bind_key):
+            start_time = time.time()
+            engine = self.db.get_engine(app, bind=bind_key)
+            if is_memory_database(engine.url):
+                return bind_key, 0, time.time() - start_time
+
+            pool_config = self.get_pool_config(app, bind_key)
+            connections = [engine.raw_connection() for index in xrange(pool_config.get('warmup', pool_config.get('size') or 1))]
+            for connection in connections:
+                connection.close() # 풀로 돌려준다
+
+            return bind_key, len(connections), time.time() - start_time
+
+        bind_keys = [None] + sorted(app.config.get('SQLALCHEMY_BINDS') or {})
+        return self.db.get_worker_pool(app).map(warm, bind_keys)
+
+    def get_stats(self, app):
+        "바인딩 별 사용 중, 유휴, 초과 커넥션 수와 대기 시간"
+        stats = {}
+        for bind_key, connector in get_state(app).connectors.items():
+            engine = connector._engine
+            if engine is None:
+                continue
+
+            pool = engine.pool
+            pool_stats = dict(pool_class=pool.__class__.__name__)
+            if isinstance(pool, QueuePool):
+                pool_stats.update(size=pool.size(), checked_out=pool.checkedout(), idle=pool.checkedin(), overflow=max(0, pool.overflow()))
+            if isinstance(pool, _TimedQueuePool):
+                pool_stats.update(checkout_count=pool.checkout_count, wait_time=pool.wait_time, max_wait_time=pool.max_wait_time)
+
+            stats[bind_key or 'default'] = pool_stats
+
+        return stats
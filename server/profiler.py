@@ -0,0 +1,161 @@
+# -*- coding:utf8 -*-
+import os
+import re
+import glob
+import json
+import time
+import threading
+
+from collections import deque
+
+from flask import g, request, has_request_context
+from sqlalchemy import event
+
+
+def _get_statement_shape(statement):
+    # IN (?, ?, ?) 처럼 길이만 다른 문장을 같은 모양으로 본다
+    return re.sub(r'\((?:\s*(?:\?|%s|:\w+)\s*,)+\s*(?:\?|%s|:\w+)\s*\)', '(?)', ' '.join(statement.split()))
+
+
+class _RequestProfile(object):
+    def __init__(self):
+        self.binds = {}
+        self.shapes = {}
+
+    def record(self, bind_key, statement, elapsed):
+        bind_stats = self.binds.get(bind_key)
+        if bind_stats is None:
+            bind_stats = self.binds[bind_key] = [0, 0.0, 0.0]
+
+        bind_stats[0] += 1
+        bind_stats[1] += elapsed
+        bind_stats[2] = max(bind_stats[2], elapsed)
+
+        shape_key = (bind_key, _get_statement_shape(statement))
+        self.shapes[shape_key] = self.shapes.get(shape_key, 0) + 1
+
+    def get_repeated_shapes(self, repeat_threshold):
+        "N+1 로 의심되는 (바인딩 키, 문장 모양, 횟수)"
+        repeated_shapes = []
+        for (bind_key, shape), count in self.shapes.iteritems():
+            if count >= repeat_threshold:
+                repeated_shapes.append((bind_key, shape, count))
+
+        return repeated_shapes
+
+
+class SQLProfiler(object):
+    "요청 별 SQL 실행 횟수와 시간을 바인딩 키 별로 모은다"
+
+    HEADER_NAME = 'X-SQL-Profile'
+    REPORT_FILE_PATTERN = 'sql_profile.*.json'
+
+    def __init__(self, db, app=None):
+        self.db = db
+        self.reports = deque(maxlen=1000)
+        self._report_lock = threading.Lock()
+        self._request_count = 0
+
+        db.engine_listeners.append(self.watch_engine)
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.before_request(self._begin_request)
+        app.after_request(self._end_request)
+
+    def is_enabled(self, app):
+        return app.config.get('SQLALCHEMY_PROFILE', False)
+
+    def watch_engine(self, app, bind_key, engine):
+        if not self.is_enabled(app): # 꺼져 있으면 리스너를 달지 않는다
+            return
+
+        bind_name = bind_key or 'default'
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault('_sql_profile_start_times', []).append(time.time())
+
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            start_time = conn.info['_sql_profile_start_times'].pop()
+            if has_request_context():
+                profile = getattr(g, '_sql_profile', None)
+                if profile is not None:
+                    profile.record(bind_name, statement, time.time() - start_time)
+
+        def dbapi_error(conn, cursor, statement, parameters, context, exception): # 실패한 실행은 after 가 오지 않는다
+            start_times = conn.info.get('_sql_profile_start_times')
+            if start_times:
+                start_times.pop()
+
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+        event.listen(engine, 'dbapi_error', dbapi_error)
+
+    def get_report(self):
+        "바인딩 키 별 누적 통계와 반복 문장"
+        with self._report_lock:
+            reports = list(self.reports)
+
+        bind_totals = {}
+        repeated_shapes = {}
+        for report in reports:
+            for bind_name, (count, total_time, slowest_time) in report['binds'].iteritems():
+                bind_total = bind_totals.setdefault(bind_name, dict(count=0, total_time=0.0, slowest_time=0.0))
+                bind_total['count'] += count
+                bind_total['total_time'] += total_time
+                bind_total['slowest_time'] = max(bind_total['slowest_time'], slowest_time)
+
+            for bind_name, shape, count in report['repeated']:
+                repeated_key = '%s %s %s' % (report['endpoint'], bind_name, shape)
+                repeated_shapes[repeated_key] = max(repeated_shapes.get(repeated_key, 0), count)
+
+        return dict(pid=os.getpid(), request_count=len(reports), binds=bind_totals, repeated=repeated_shapes, recent=reports[-20:])
+
+    def dump(self, app):
+        if not os.access(app.config['TEMP_DIR_PATH'], os.R_OK):
+            os.makedirs(app.config['TEMP_DIR_PATH'])
+
+        report_file_path = os.path.join(app.config['TEMP_DIR_PATH'], 'sql_profile.%d.json' % os.getpid())
+        with open(report_file_path, 'w') as report_file:
+            json.dump(self.get_report(), report_file, indent=2, sort_keys=True)
+
+        return report_file_path
+
+    @classmethod
+    def load_dumps(cls, temp_dir_path):
+        reports = []
+        for report_file_path in sorted(glob.glob(os.path.join(temp_dir_path, cls.REPORT_FILE_PATTERN))):
+            with open(report_file_path) as report_file:
+                reports.append(json.load(report_file))
+
+        return reports
+
+    def _begin_request(self):
+        if self.is_enabled(self.db.get_app()):
+            g._sql_profile = _RequestProfile()
+
+    def _end_request(self, response):
+        profile = getattr(g, '_sql_profile', None)
+        if profile is None:
+            return response
+
+        app = self.db.get_app()
+        repeated_shapes = profile.get_repeated_shapes(app.config.get('SQLALCHEMY_PROFILE_REPEAT_THRESHOLD', 5))
+
+        header_values = ['%s=%dq/%.1fms/%.1fms' % (bind_name, count, total_time * 1000, slowest_time * 1000) for bind_name, (count, total_time, slowest_time) in sorted(profile.binds.iteritems())]
+        if repeated_shapes:
+            header_values.append('repeated=%d' % len(repeated_shapes))
+        response.headers[self.HEADER_NAME] = '; '.join(header_values)
+
+        with self._report_lock:
+            self.reports.append(dict(endpoint=request.endpoint, path=request.path, binds=profile.binds, repeated=repeated_shapes))
+            self._request_count += 1
+            dump_interval = app.config.get('SQLALCHEMY_PROFILE_DUMP_INTERVAL', 100)
+            should_dump = dump_interval and self._request_count % dump_interval == 0
+
+        if should_dump:
+            self.dump(app)
+
+        return response
@@ -0,0 +1,168 @@
+# -*- coding:utf8 -*-
+import re
+import uuid
+import cPickle
+import threading
+
+from hashlib import md5
+
+from flask_sqlalchemy import BaseQuery
+
+from sqlalchemy import event
+from sqlalchemy.sql.util import find_tables
+from sqlalchemy.sql.expression import UpdateBase, TextClause
+
+from cache import make_cache_backend
+
+
+class CachingQuery(BaseQuery):
+    "cache() 를 붙인 질의는 QUERY_CACHE 에서 결과를 찾는다"
+
+    _cached = False
+    _cache_timeout = None
+
+    def cache(self, timeout=None):
+        "timeout 이 없으면 QUERY_CACHE_TTL"
+        query = self._clone()
+        query._cached = True
+        query._cache_timeout = timeout
+        return query
+
+    def __iter__(self):
+        query_cache = getattr(getattr(self.session, '_db', None), 'query_cache', None)
+        if not self._cached or query_cache is None:
+            return BaseQuery.__iter__(self)
+
+        return query_cache.iterate(self)
+
+    def _iter_uncached(self):
+        return BaseQuery.__iter__(self)
+
+
+class QueryCache(object):
+    "바인딩 키, SQL, 파라미터로 결과를 캐시하고 (바인딩 키, 테이블) 에 쓰면 세대를 바꿔 무효화한다"
+
+    GENERATION_KEY_PREFIX = 'generation:'
+    WRITE_STATEMENT_PATTERN = re.compile(r'^\s*(?:INSERT\s+(?:OR\s+\w+\s+)?INTO|REPLACE\s+INTO|UPDATE(?:\s+OR\s+\w+)?|DELETE\s+FROM)\s+[`"\[]?(\w+)', re.I)
+
+    def __init__(self, db, config_prefix='QUERY_CACHE'):
+        self.db = db
+        self.config_prefix = config_prefix
+        self.backend = None
+        self._lock = threading.Lock()
+
+        db.engine_listeners.append(self.watch_engine)
+
+    def __repr__(self):
+        return "%s<%r>" % (self.__class__.__name__, self.backend)
+
+    def iterate(self, query):
+        session = query.session
+        backend = self._get_backend()
+        if backend is None or query._populate_existing:
+            return query._iter_uncached()
+
+        if query._autoflush:
+            session._autoflush()
+        if session._flushed_changes: # 커밋 전 자기 쓰기가 보이는 결과는 다른 요청과 나누지 않는다
+            return query._iter_uncached()
+
+        statement = query.statement
+        mapper = query._mapper_zero()
+        binding_key = session.get_binding_key(mapper)
+        cache_key = self._make_key(backend, binding_key, statement, session.get_bind(mapper, clause=statement).dialect)
+
+        payload = backend.get(cache_key)
+        if payload is not None:
+            return query.merge_result(cPickle.loads(payload), load=False)
+
+        rows = list(query._iter_uncached())
+        try:
+            payload = cPickle.dumps(rows, cPickle.HIGHEST_PROTOCOL)
+        except Exception: # 피클할 수 없는 값은 캐시하지 않는다
+            return iter(rows)
+
+        backend.set(cache_key, payload, timeout=query._cache_timeout)
+        return iter(rows)
+
+    def invalidate(self, binding_key, *table_names):
+        backend = self._get_backend()
+        if backend is not None:
+            for table_name in table_names:
+                backend.set(self._make_generation_key(binding_key, table_name), uuid.uuid4().hex, timeout=0)
+
+    def get_written_table_names(self, clause):
+        if isinstance(clause, UpdateBase):
+            return [clause.table.name]
+
+        if isinstance(clause, TextClause):
+            clause = clause.text
+        if isinstance(clause, basestring):
+            match = self.WRITE_STATEMENT_PATTERN.match(clause)
+            if match:
+                return [match.group(1)]
+
+        return []
+
+    def watch_engine(self, app, bind_key, engine):
+        # ORM flush, 벌크 갱신, 인제스트, write-behind 모두 엔진을 지나므로 여기서 쓰기를 잡는다
+        # 실행할 때 한 번, 커밋한 뒤 한 번 더 세대를 바꿔 그 사이 읽은 옛 결과도 버린다
+        def after_execute(connection, clause, multiparams, params, result):
+            table_names = self.get_written_table_names(clause)
+            if table_names:
+                self.invalidate(bind_key, *table_names)
+                if not connection.closed and connection.in_transaction(): # 자동 커밋이면 이미 커밋했다
+                    connection.info.setdefault('query_cache_written_tables', set()).update(table_names)
+
+        def on_commit(connection):
+            table_names = connection.info.pop('query_cache_written_tables', None)
+            if table_names:
+                self.invalidate(bind_key, *table_names)
+
+        def on_rollback(connection):
+            connection.info.pop('query_cache_written_tables', None)
+
+        def on_commit_twophase(connection, xid, is_prepared): # 2단계 커밋은 commit 이벤트가 없다
+            on_commit(connection)
+
+        def on_rollback_twophase(connection, xid, is_prepared):
+            on_rollback(connection)
+
+        event.listen(engine, 'after_execute', after_execute)
+        event.listen(engine, 'commit', on_commit)
+        event.listen(engine, 'rollback', on_rollback)
+        event.listen(engine, 'commit_twophase', on_commit_twophase)
+        event.listen(engine, 'rollback_twophase', on_rollback_twophase)
+
+    def get_stats(self):
+        backend = self._get_backend()
+        return backend.get_stats() if hasattr(backend, 'get_stats') else {}
+
+    def _get_backend(self):
+        if self.backend is None:
+            config = self.db.get_app().config
+            if not config.get(self.config_prefix + '_ENABLE', False):
+                return None
+
+            with self._lock:
+                if self.backend is None:
+                    self.backend = make_cache_backend(config, self.config_prefix)
+
+        return self.backend
+
+    def _make_generation_key(self, binding_key, table_name):
+        return '%s%s:%s' % (self.GENERATION_KEY_PREFIX, binding_key or 'default', table_name)
+
+    def _make_key(self, backend, binding_key, statement, dialect):
+        generations = []
+        for table_name in sorted(set(table.name for table in find_tables(statement))):
+            generation_key = self._make_generation_key(binding_key, table_name)
+            generation = backend.get(generation_key)
+            if generation is None: # 세대 값이 없어지면 새로 만들어 옛 항목을 다시 쓰지 않는다
+                generation = uuid.uuid4().hex
+                backend.set(generation_key, generation, timeout=0)
+            generations.append(generation)
+
+        compiled = statement.compile(dialect=dialect)
+        params = sorted(compiled.params.iteritems())
+        return 'query:%s' % md5('%s\0%s\0%r\0%s' % (binding_key or 'default', unicode(compiled).encode('utf8'), params, ':'.join(generations))).hexdigest()
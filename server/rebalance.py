@@ -0,0 +1,209 @@
+# -*- coding:utf8 -*-
+import os
+import json
+import time
+
+from hashlib import md5
+
+from sqlalchemy import select, func, and_
+
+
+class RebalanceResult(object):
+    def __init__(self):
+        self.scanned_count = 0
+        self.moved_count = 0
+        self.changed_count = 0 # 복사하는 동안 바뀌어 다음 패스로 넘긴 행
+        self.moves = {} # (원본, 대상): 행 수
+        self.elapsed = 0.0
+
+    def __repr__(self):
+        return "%s<scanned=%d moved=%d changed=%d>" % (self.__class__.__name__, self.scanned_count, self.moved_count, self.changed_count)
+
+
+class ShardRebalancer(object):
+    "지금 링에서 다른 샤드에 속하는 행을 기본 키 순서 배치로 옮긴다"
+
+    def __init__(self, db, model, shard_column, batch_size=500, throttle=0.0, checkpoint_path=None):
+        self.db = db
+        self.model = model
+        self.table = model.__table__
+        self.binding_key_pattern = self.table.info.get('bind_key')
+        if not hasattr(self.binding_key_pattern, 'get_shard_keys'):
+            raise Exception('NOT_SHARDED_MODEL:%s' % model.__name__)
+
+        primary_key_columns = list(self.table.primary_key.columns)
+        if len(primary_key_columns) != 1:
+            raise Exception('NOT_SUPPORTED_COMPOSITE_PRIMARY_KEY:%s' % model.__name__)
+
+        self.primary_key_column = primary_key_columns[0]
+        self.shard_column = self.table.columns[shard_column]
+        self.batch_size = batch_size
+        self.throttle = throttle
+        self.checkpoint_path = checkpoint_path
+
+    def __repr__(self):
+        return "%s<%s %s>" % (self.__class__.__name__, self.model.__name__, self.shard_column.key)
+
+    def get_source_keys(self, app):
+        "지금 링의 샤드와 이전 링에만 남은 샤드"
+        source_keys = set(self.binding_key_pattern.get_shard_keys())
+        previous_hash_ring = self.binding_key_pattern.get_previous_hash_ring()
+        if previous_hash_ring is not None:
+            source_keys.update(key for key in previous_hash_ring.nodes if key in app.config['SQLALCHEMY_BINDS'])
+
+        return sorted(source_keys)
+
+    def get_layout_digest(self, app):
+        hash_ring = self.binding_key_pattern.get_hash_ring()
+        return md5(json.dumps([self.table.name, self.shard_column.key, sorted(hash_ring.weights.items()), hash_ring.virtual_node_count])).hexdigest()
+
+    def count(self, app=None):
+        "샤드 별 (행 수, 잘못 놓인 행 수)"
+        app = self.db.get_app(app)
+        counts = {}
+        for source_key in self.get_source_keys(app):
+            engine = self.db.get_engine(app, bind=source_key)
+            row_count = engine.execute(select([func.count()]).select_from(self.table)).scalar()
+            misplaced_count = 0
+            for shard_value, in engine.execute(select([self.shard_column])):
+                if self.binding_key_pattern.get_shard_key(shard_value) != source_key:
+                    misplaced_count += 1
+
+            counts[source_key] = (row_count, misplaced_count)
+
+        return counts
+
+    def plan(self, app=None):
+        "옮길 (원본, 대상): 행 수, 대상에 기본 키가 같은 다른 행이 있으면 CONFLICT_SHARD_PRIMARY_KEY"
+        app = self.db.get_app(app)
+        moving_rows = {} # 대상: [(기본 키, 샤드 값), ...]
+        moves = {}
+        for source_key in self.get_source_keys(app):
+            engine = self.db.get_engine(app, bind=source_key)
+            for primary_key, shard_value in engine.execute(select([self.primary_key_column, self.shard_column])):
+                target_key = self.binding_key_pattern.get_shard_key(shard_value)
+                if target_key != source_key:
+                    moves[(source_key, target_key)] = moves.get((source_key, target_key), 0) + 1
+                    moving_rows.setdefault(target_key, []).append((primary_key, shard_value))
+
+        for target_key, rows in sorted(moving_rows.iteritems()):
+            self._check_conflicts(app, target_key, rows)
+
+        return moves
+
+    def run(self, app=None, max_passes=3, report=None):
+        app = self.db.get_app(app)
+        result = RebalanceResult()
+        start_time = time.time()
+        self.plan(app) # 기본 키가 겹치면 아무것도 옮기기 전에 멈춘다
+        checkpoint = self._load_checkpoint(app)
+        while checkpoint['pass'] < max_passes:
+            changed_count = result.changed_count
+            for source_key in self.get_source_keys(app):
+                self._move_source(app, source_key, checkpoint, result, report)
+
+            checkpoint['pass'] += 1
+            checkpoint['sources'] = {}
+            self._save_checkpoint(checkpoint)
+            if result.changed_count == changed_count: # 이번 패스에 바뀐 행이 없으면 끝
+                break
+
+        if self.checkpoint_path and os.access(self.checkpoint_path, os.R_OK): # 다 옮겼으면 다음 실행은 처음부터
+            os.remove(self.checkpoint_path)
+
+        result.elapsed = time.time() - start_time
+        return result
+
+    def _move_source(self, app, source_key, checkpoint, result, report):
+        source_engine = self.db.get_engine(app, bind=source_key)
+        last_primary_key = checkpoint['sources'].get(source_key)
+        while True:
+            query = select([self.table]).order_by(self.primary_key_column).limit(self.batch_size)
+            if last_primary_key is not None:
+                query = query.where(self.primary_key_column > last_primary_key)
+
+            rows = [dict(row) for row in source_engine.execute(query)]
+            if not rows:
+                break
+
+            result.scanned_count += len(rows)
+            target_rows = {}
+            for row in rows:
+                target_key = self.binding_key_pattern.get_shard_key(row[self.shard_column.key])
+                if target_key != source_key:
+                    target_rows.setdefault(target_key, []).append(row)
+
+            for target_key, moving_rows in sorted(target_rows.iteritems()):
+                self._copy_rows(app, target_key, moving_rows)
+                moved_count = self._delete_unchanged_rows(source_engine, moving_rows)
+                result.moved_count += moved_count
+                result.changed_count += len(moving_rows) - moved_count
+                result.moves[(source_key, target_key)] = result.moves.get((source_key, target_key), 0) + moved_count
+                if report:
+                    report(source_key, target_key, moved_count)
+
+            last_primary_key = rows[-1][self.primary_key_column.key]
+            checkpoint['sources'][source_key] = last_primary_key
+            self._save_checkpoint(checkpoint)
+
+            if self.throttle:
+                time.sleep(self.throttle)
+
+    def _check_conflicts(self, app, target_key, rows):
+        # 이미 복사한 행은 샤드 값이 같으므로 다시 옮겨도 된다
+        engine = self.db.get_engine(app, bind=target_key)
+        for index in xrange(0, len(rows), self.batch_size):
+            shard_values = dict(rows[index:index + self.batch_size])
+            for primary_key, shard_value in engine.execute(
+                    select([self.primary_key_column, self.shard_column]).where(self.primary_key_column.in_(shard_values.keys()))):
+                if shard_values[primary_key] != shard_value:
+                    raise Exception('CONFLICT_SHARD_PRIMARY_KEY:%s=%s TARGET:%s' % (self.table.name, primary_key, target_key))
+
+    def _copy_rows(self, app, target_key, rows):
+        # 다시 실행해도 되도록 이미 복사한 행은 원본 값으로 덮어쓴다
+        primary_key_name = self.primary_key_column.key
+        with self.db.get_engine(app, bind=target_key).begin() as connection:
+            existing_rows = dict((row[primary_key_name], row[self.shard_column.key]) for row in connection.execute(
+                select([self.primary_key_column, self.shard_column]).where(self.primary_key_column.in_([row[primary_key_name] for row in rows]))))
+
+            insert_rows = []
+            for row in rows:
+                if row[primary_key_name] not in existing_rows:
+                    insert_rows.append(row)
+                elif existing_rows[row[primary_key_name]] == row[self.shard_column.key]:
+                    connection.execute(self.table.update().where(self.primary_key_column == row[primary_key_name]).values(row))
+                else: # 샤드끼리 기본 키가 겹치면 옮길 수 없다
+                    raise Exception('CONFLICT_SHARD_PRIMARY_KEY:%s=%s TARGET:%s' % (self.table.name, row[primary_key_name], target_key))
+
+            if insert_rows:
+                connection.execute(self.table.insert(), insert_rows)
+
+    def _delete_unchanged_rows(self, source_engine, rows):
+        # 복사하는 동안 원본에서 바뀐 행은 지우지 않고 다음 패스에서 다시 옮긴다
+        # 복사한 값을 DELETE 조건에 넣어 비교와 삭제 사이에 바뀐 행을 지우지 않는다 (None 은 IS NULL)
+        deleted_count = 0
+        with source_engine.begin() as connection:
+            for row in rows:
+                deleted_count += connection.execute(self.table.delete().where(
+                    and_(*[column == row[column.key] for column in self.table.columns]))).rowcount
+
+        return deleted_count
+
+    def _load_checkpoint(self, app):
+        layout_digest = self.get_layout_digest(app)
+        if self.checkpoint_path and os.access(self.checkpoint_path, os.R_OK):
+            with open(self.checkpoint_path) as checkpoint_file:
+                checkpoint = json.load(checkpoint_file)
+            if checkpoint.get('layout') == layout_digest: # 같은 배치에서 이어서 한다
+                return checkpoint
+
+        return {'layout': layout_digest, 'table': self.table.name, 'sources': {}, 'pass': 0}
+
+    def _save_checkpoint(self, checkpoint):
+        if not self.checkpoint_path:
+            return
+
+        temp_file_path = '%s.%d' % (self.checkpoint_path, os.getpid())
+        with open(temp_file_path, 'w') as checkpoint_file:
+            json.dump(checkpoint, checkpoint_file, indent=2, sort_keys=True)
+        os.rename(temp_file_path, self.checkpoint_path)
@@ -0,0 +1,164 @@
+# -*- coding:utf8 -*-
+import os
+import time
+import logging
+import itertools
+import threading
+
+from sqlalchemy import event
+
+
+def _get_sqlite_mtime(path):
+    # WAL 모드면 체크포인트 전까지 쓰기는 -wal 파일만 바꾼다
+    mtime = os.path.getmtime(path)
+    if os.access(path + '-wal', os.F_OK):
+        mtime = max(mtime, os.path.getmtime(path + '-wal'))
+    return mtime
+
+def _measure_sqlite_lag(master_engine, replica_engine):
+    # 복제본 파일이 마스터 파일보다 오래된 만큼을 지연으로 본다
+    master_path = master_engine.url.database
+    replica_path = replica_engine.url.database
+    if not master_path or master_path == ':memory:':
+        return 0.0
+
+    return max(0.0, _get_sqlite_mtime(master_path) - _get_sqlite_mtime(replica_path))
+
+def _measure_mysql_lag(master_engine, replica_engine):
+    row = replica_engine.execute('SHOW SLAVE STATUS').first()
+    if row is None:
+        return 0.0
+
+    seconds_behind_master = row['Seconds_Behind_Master']
+    if seconds_behind_master is None: # 복제가 멈춤
+        return float('inf')
+
+    return float(seconds_behind_master)
+
+def _measure_postgresql_lag(master_engine, replica_engine):
+    lag = replica_engine.execute('SELECT EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())').scalar()
+    return float(lag or 0.0)
+
+def _measure_default_lag(master_engine, replica_engine):
+    replica_engine.execute('SELECT 1')
+    return 0.0
+
+
+class ReplicaGroup(object):
+    POLICY_ROUND_ROBIN = 'round_robin'
+    POLICY_LEAST_LOADED = 'least_loaded'
+
+    LAG_MEASURES = {
+        'sqlite': _measure_sqlite_lag,
+        'mysql': _measure_mysql_lag,
+        'postgresql': _measure_postgresql_lag,
+    }
+
+    def __init__(self, master_key, replica_keys, policy=POLICY_ROUND_ROBIN, max_lag=None):
+        self.master_key = master_key
+        self.replica_keys = list(replica_keys)
+        self.policy = policy
+        self.max_lag = max_lag
+        self.lags = dict((replica_key, 0.0) for replica_key in self.replica_keys)
+        self.healthy_replica_keys = list(self.replica_keys)
+        self.loads = dict((replica_key, 0) for replica_key in self.replica_keys)
+        self._round_robin_counter = itertools.count()
+        self._load_engines = set()
+
+    def __repr__(self):
+        return "%s<%s:%s>" % (self.__class__.__name__, self.master_key, ','.join(self.healthy_replica_keys))
+
+    def pick_replica_key(self):
+        healthy_replica_keys = self.healthy_replica_keys
+        if not healthy_replica_keys: # 살아있는 복제본이 없으면 마스터
+            return self.master_key
+
+        if self.policy == self.POLICY_LEAST_LOADED:
+            return min(healthy_replica_keys, key=self.loads.get)
+        else:
+            return healthy_replica_keys[next(self._round_robin_counter) % len(healthy_replica_keys)]
+
+    def watch_load(self, replica_key, engine):
+        "커넥션 체크아웃 수로 복제본 부하를 추적한다"
+        if engine in self._load_engines:
+            return
+
+        self._load_engines.add(engine)
+
+        def on_checkout(dbapi_connection, connection_record, connection_proxy):
+            self.loads[replica_key] += 1
+
+        def on_checkin(dbapi_connection, connection_record):
+            self.loads[replica_key] -= 1
+
+        event.listen(engine, 'checkout', on_checkout)
+        event.listen(engine, 'checkin', on_checkin)
+
+    def check(self, get_engine):
+        "복제 지연을 측정해 오래된 복제본을 순환에서 뺀다"
+        master_engine = get_engine(self.master_key)
+        healthy_replica_keys = []
+        for replica_key in self.replica_keys:
+            replica_engine = get_engine(replica_key)
+            measure_lag = self.LAG_MEASURES.get(replica_engine.dialect.name, _measure_default_lag)
+            try:
+                lag = measure_lag(master_engine, replica_engine)
+            except Exception as e:
+                logging.getLogger(__name__).warning('REPLICA_CHECK_FAILED:%s ERROR:%s', replica_key, e)
+                lag = float('inf')
+
+            self.lags[replica_key] = lag
+            if self.max_lag is None or lag <= self.max_lag:
+                healthy_replica_keys.append(replica_key)
+
+        self.healthy_replica_keys = healthy_replica_keys
+
+
+class ReplicaRouter(object):
+    def __init__(self, db):
+        self.db = db
+        self.groups = {}
+        self._config_snapshot = None
+        self._monitor_thread = None
+        self._lock = threading.Lock()
+
+    def get_group(self, app, binding_key):
+        config = app.config
+        replicas, binds = config.get('SQLALCHEMY_REPLICAS'), config['SQLALCHEMY_BINDS']
+        config_snapshot = (replicas, len(replicas or ()), binds, len(binds or ()), self.db.config_version)
+        if config_snapshot != self._config_snapshot:
+            self._build_groups(config)
+            self._config_snapshot = config_snapshot
+
+        return self.groups.get(binding_key)
+
+    def check_all(self, app):
+        get_engine = lambda bind_key: self.db.get_engine(app, bind=bind_key)
+        for group in self.groups.values():
+            group.check(get_engine)
+
+    def start_monitor(self, app):
+        "복제 지연을 주기적으로 검사하는 스레드를 시작한다"
+        with self._lock:
+            if self._monitor_thread and self._monitor_thread.is_alive():
+                return
+
+            self._monitor_thread = threading.Thread(target=self._run_monitor, args=(app,), name='replica-monitor')
+            self._monitor_thread.daemon = True
+            self._monitor_thread.start()
+
+    def _run_monitor(self, app):
+        while True:
+            self.get_group(app, None)
+            self.check_all(app)
+            time.sleep(app.config.get('SQLALCHEMY_REPLICA_CHECK_INTERVAL') or 5)
+
+    def _build_groups(self, config):
+        groups = {}
+        for master_key, replica_keys in (config.get('SQLALCHEMY_REPLICAS') or {}).iteritems():
+            groups[master_key] = ReplicaGroup(
+                master_key, replica_keys,
+                policy=config.get('SQLALCHEMY_REPLICA_POLICY') or ReplicaGroup.POLICY_ROUND_ROBIN,
+                max_lag=config.get('SQLALCHEMY_REPLICA_MAX_LAG'))
+
+        self.groups = groups
@@ -0,0 +1,34 @@
+# -*- coding:utf8 -*-
+from gunicorn.app.base import Application
+from gunicorn.config import Config
+
+
+class GunicornServer(Application):
+    "설정이 끝난 앱을 gunicorn 워커에서 띄운다"
+
+    def __init__(self, flask_app, db, options):
+        self.flask_app = flask_app
+        self.db = db
+        self.options = options
+        Application.__init__(self)
+
+    def load_config(self):
+        # gunicorn 설정을 sys.argv 대신 옵션 사전에서 채운다
+        self.cfg = Config(self.usage, prog=self.prog)
+        for key, value in self.options.iteritems():
+            self.cfg.set(key, value)
+
+        flask_app = self.flask_app
+        db = self.db
+
+        def post_fork(server, worker):
+            # 부모 프로세스에서 연 커넥션을 워커끼리 나눠 쓰지 않도록 버린다
+            db.dispose_engines(flask_app)
+            if flask_app.config.get('SQLALCHEMY_POOL_WARMUP'):
+                db.prepare_pools(flask_app)
+            db.start_replica_monitor(flask_app)
+
+        self.cfg.set('post_fork', post_fork)
+
+    def load(self):
+        return self.flask_app
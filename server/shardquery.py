@@ -0,0 +1,154 @@
+# -*- coding:utf8 -*-
+import heapq
+import itertools
+
+from sqlalchemy import func
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.expression import UnaryExpression
+
+
+class _Descending(object):
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __lt__(self, other):
+        return self.value > other.value
+
+    def __gt__(self, other):
+        return self.value < other.value
+
+
+def _get_sort_spec(order_by_clause):
+    "(속성 이름, 내림차순 여부)"
+    descending = False
+    if isinstance(order_by_clause, UnaryExpression) and order_by_clause.modifier in (operators.desc_op, operators.asc_op):
+        descending = order_by_clause.modifier is operators.desc_op
+        order_by_clause = order_by_clause.element
+
+    key = getattr(order_by_clause, 'key', None)
+    if key is None:
+        raise Exception('NOT_SUPPORTED_SHARD_ORDER_BY:%s' % repr(order_by_clause))
+
+    return key, descending
+
+
+class ShardQuery(object):
+    "BindingKeyPattern 의 모든 샤드에 같은 질의를 동시에 보내고 결과를 합친다"
+
+    def __init__(self, db, model):
+        bind_key = model.__table__.info.get('bind_key')
+        if not hasattr(bind_key, 'get_shard_keys'):
+            raise Exception('NOT_SHARDED_MODEL:%s' % model.__name__)
+
+        self.db = db
+        self.model = model
+        self.binding_key_pattern = bind_key
+        self._entities = (model,)
+        self._criterion = ()
+        self._order_by = ()
+        self._limit = None
+        self._offset = 0
+
+    def __repr__(self):
+        return "%s<%s>" % (self.__class__.__name__, self.model.__name__)
+
+    def __iter__(self):
+        app = self.db.get_app()
+        shard_keys = self.binding_key_pattern.get_shard_keys()
+        worker_pool = self.db.get_worker_pool(app)
+
+        fetch_limit = self._offset + self._limit if self._limit is not None else None
+        fetch = lambda query: (query.limit(fetch_limit) if fetch_limit is not None else query).all()
+        tasks = [(app, shard_key, fetch) for shard_key in shard_keys]
+
+        if self._order_by:
+            shard_results = worker_pool.map(self._execute_task, tasks)
+            rows = self._merge_sorted(shard_results)
+        else: # 정렬이 없으면 먼저 끝난 샤드부터 흘려보낸다
+            rows = itertools.chain.from_iterable(worker_pool.imap_unordered(self._execute_task, tasks))
+
+        stop = self._offset + self._limit if self._limit is not None else None
+        return itertools.islice(rows, self._offset, stop)
+
+    def all(self):
+        return list(self)
+
+    def first(self):
+        for row in self.limit(1):
+            return row
+
+        return None
+
+    def count(self):
+        "limit, offset 은 합친 결과에 islice 하듯 적용한다"
+        count = max(0, sum(self._clone(_order_by=(), _limit=None, _offset=0)._scatter(lambda query: query.count())) - self._offset)
+        return min(count, self._limit) if self._limit is not None else count
+
+    def sum(self, column):
+        if self._limit is not None or self._offset:
+            raise Exception('NOT_SUPPORTED_SUM_WITH_LIMIT:%s' % self.model.__name__)
+
+        return sum(value for value in self._clone(_order_by=())._scatter(lambda query: query.with_entities(func.sum(column)).scalar()) if value is not None)
+
+    def filter(self, *criterion):
+        return self._clone(_criterion=self._criterion + criterion)
+
+    def filter_by(self, **kwargs):
+        return self.filter(*[getattr(self.model, key) == value for key, value in kwargs.iteritems()])
+
+    def order_by(self, *clauses):
+        return self._clone(_order_by=self._order_by + clauses)
+
+    def limit(self, limit):
+        return self._clone(_limit=limit)
+
+    def offset(self, offset):
+        return self._clone(_offset=offset or 0)
+
+    def with_entities(self, *entities):
+        return self._clone(_entities=entities)
+
+    def _clone(self, **kwargs):
+        shard_query = self.__class__.__new__(self.__class__)
+        shard_query.__dict__.update(self.__dict__)
+        shard_query.__dict__.update(kwargs)
+        return shard_query
+
+    def _scatter(self, fetch):
+        app = self.db.get_app()
+        tasks = [(app, shard_key, fetch) for shard_key in self.binding_key_pattern.get_shard_keys()]
+        return self.db.get_worker_pool(app).map(self._execute_task, tasks)
+
+    def _execute_task(self, task):
+        app, shard_key, fetch = task
+        with app.app_context():
+            session = self.db.create_session()
+            try:
+                session.push_binding(shard_key)
+                query = session.query(*self._entities)
+                if self._criterion:
+                    query = query.filter(*self._criterion)
+                if self._order_by:
+                    query = query.order_by(*self._order_by)
+
+                result = fetch(query)
+                session.expunge_all()
+                return result
+            finally:
+                session.close()
+
+    def _merge_sorted(self, shard_results):
+        sort_specs = [_get_sort_spec(order_by_clause) for order_by_clause in self._order_by]
+
+        def decorate(shard_index, rows):
+            for row_index, row in enumerate(rows):
+                sort_key = tuple(_Descending(getattr(row, key)) if descending else getattr(row, key) for key, descending in sort_specs)
+                yield sort_key, shard_index, row_index, row
+
+        decorated_results = [decorate(shard_index, rows) for shard_index, rows in enumerate(shard_results)]
+        return (row for sort_key, shard_index, row_index, row in heapq.merge(*decorated_results))
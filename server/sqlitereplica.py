@@ -0,0 +1,245 @@
+# -*- coding:utf8 -*-
+import os
+import time
+import fcntl
+import logging
+import sqlite3
+import threading
+
+from sqlalchemy import event, exc
+
+from pooling import is_memory_database
+
+
+class ReplicaRefreshResult(object):
+    def __init__(self, master_key, replica_key):
+        self.master_key = master_key
+        self.replica_key = replica_key
+        self.step_count = 0
+        self.row_count = 0
+        self.snapshot_time = None
+        self.elapsed = 0.0
+
+    def __repr__(self):
+        return "%s<%s->%s steps=%d rows=%d elapsed=%.3f>" % (
+            self.__class__.__name__, self.master_key, self.replica_key, self.step_count, self.row_count, self.elapsed)
+
+
+class SQLiteReplicaRefresher(object):
+    "SQLALCHEMY_REPLICAS 의 sqlite 복제본을 조금씩 복사한 스냅샷으로 바꿔 끼운다"
+
+    HOST_LOCK_FILE_NAME = 'replica_refresh.lock'
+
+    def __init__(self, db):
+        self.db = db
+        self.snapshot_times = {} # 복제본 바인딩 키: 스냅샷을 뜬 시각
+        self._refresh_thread = None
+        self._host_lock_file = None
+        self._host_lock_pid = None
+        self._lock = threading.Lock()
+
+        db.engine_listeners.append(self.watch_engine)
+
+    def is_replica(self, app, bind_key):
+        return any(bind_key in replica_keys for replica_keys in (app.config.get('SQLALCHEMY_REPLICAS') or {}).itervalues())
+
+    def get_refresh_config(self, app):
+        refresh_config = dict(step=1000, sleep=0.01, interval=0)
+        refresh_config.update(app.config.get('SQLALCHEMY_REPLICA_REFRESH') or {})
+        return refresh_config
+
+    def get_pairs(self, app):
+        "파일 sqlite 끼리인 (마스터, 복제본) 바인딩 키 목록"
+        pairs = []
+        for master_key, replica_keys in sorted((app.config.get('SQLALCHEMY_REPLICAS') or {}).iteritems()):
+            master_url = self.db.get_engine(app, bind=master_key).url
+            if master_url.drivername != 'sqlite' or is_memory_database(master_url):
+                continue
+
+            for replica_key in replica_keys:
+                replica_url = self.db.get_engine(app, bind=replica_key).url
+                if replica_url.drivername == 'sqlite' and not is_memory_database(replica_url):
+                    pairs.append((master_key, replica_key))
+
+        return pairs
+
+    def watch_engine(self, app, bind_key, engine):
+        # 다른 프로세스가 파일을 바꿔 끼웠으면 풀에 남은 옛 파일 커넥션을 버리고 다시 연다
+        if engine.url.drivername != 'sqlite' or is_memory_database(engine.url) or not self.is_replica(app, bind_key):
+            return
+
+        database_path = engine.url.database
+
+        def get_inode():
+            try:
+                return os.stat(database_path).st_ino
+            except OSError:
+                return None
+
+        def on_connect(dbapi_connection, connection_record):
+            connection_record.info['replica_inode'] = get_inode()
+
+        def on_checkout(dbapi_connection, connection_record, connection_proxy):
+            if connection_record.info.get('replica_inode') != get_inode():
+                raise exc.DisconnectionError()
+
+        event.listen(engine, 'connect', on_connect)
+        event.listen(engine, 'checkout', on_checkout)
+
+    def get_ages(self):
+        "복제본 별 마지막 스냅샷 이후 지난 초"
+        now = time.time()
+        return dict((replica_key, now - snapshot_time) for replica_key, snapshot_time in self.snapshot_times.items())
+
+    def refresh(self, app, master_key, replica_key):
+        refresh_config = self.get_refresh_config(app)
+        pragma_statements = self.db.sqlite_tuner.get_pragma_statements(self.db.sqlite_tuner.get_profile(app, replica_key))
+        result = ReplicaRefreshResult(master_key, replica_key)
+        start_time = time.time()
+        master_path = self.db.get_engine(app, bind=master_key).url.database
+        replica_engine = self.db.get_engine(app, bind=replica_key)
+        replica_path = replica_engine.url.database
+        temp_file_path = '%s.refresh.%d' % (replica_path, os.getpid())
+        if os.access(temp_file_path, os.F_OK):
+            os.remove(temp_file_path)
+
+        try:
+            if hasattr(sqlite3.Connection, 'backup'):
+                self._copy_by_backup(master_path, temp_file_path, refresh_config, result)
+            else:
+                self._copy_by_rows(master_path, temp_file_path, refresh_config, result)
+
+            # 복제본 프로파일의 journal_mode 로 미리 바꿔 두면 읽는 커넥션이 새 파일에 쓰지 않는다
+            temp_connection = sqlite3.connect(temp_file_path)
+            for statement in pragma_statements:
+                temp_connection.execute(statement)
+            temp_connection.close()
+        except Exception:
+            if os.access(temp_file_path, os.F_OK):
+                os.remove(temp_file_path)
+            raise
+
+        if os.access(replica_path + '-wal', os.F_OK): # 남은 WAL 프레임이 새 파일에 적용되지 않도록 비운다
+            replica_connection = sqlite3.connect(replica_path)
+            replica_connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            replica_connection.close()
+
+        # 풀을 먼저 비우고 파일을 한 번에 바꿔 새 커넥션부터 새 스냅샷을 읽게 한다
+        # 복제본은 journal_mode=DELETE 라 읽고 있던 커넥션은 -wal, -shm 없이 옛 파일을 끝까지 읽는다
+        # 복제 지연 검사가 mtime 을 보므로 스냅샷 시각으로 맞춘다
+        os.utime(temp_file_path, (result.snapshot_time, result.snapshot_time))
+        replica_engine.dispose()
+        os.rename(temp_file_path, replica_path)
+
+        self.snapshot_times[replica_key] = result.snapshot_time
+        result.elapsed = time.time() - start_time
+        return result
+
+    def refresh_all(self, app):
+        results = []
+        for master_key, replica_key in self.get_pairs(app):
+            try:
+                results.append(self.refresh(app, master_key, replica_key))
+            except Exception as e:
+                logging.getLogger(__name__).warning('REPLICA_REFRESH_FAILED:%s ERROR:%s', replica_key, e)
+
+        return results
+
+    def start(self, app):
+        "SQLALCHEMY_REPLICA_REFRESH 의 interval 마다 복제본을 새로 뜨는 스레드를 시작한다"
+        if not self.get_refresh_config(app)['interval']:
+            return
+
+        with self._lock:
+            if self._refresh_thread and self._refresh_thread.is_alive():
+                return
+
+            self._refresh_thread = threading.Thread(target=self._run_refresh, args=(app,), name='replica-refresh')
+            self._refresh_thread.daemon = True
+            self._refresh_thread.start()
+
+    def _run_refresh(self, app):
+        while True:
+            if self._acquire_host_lock(app): # 워커마다 스레드가 있어도 호스트에서 하나만 새로 뜬다
+                self.refresh_all(app)
+            time.sleep(self.get_refresh_config(app)['interval'])
+
+    def _acquire_host_lock(self, app):
+        "잠금 파일을 잡은 프로세스가 죽으면 다음 시도에서 다른 프로세스가 잡는다"
+        if self._host_lock_pid == os.getpid():
+            return True
+
+        if self._host_lock_file is not None: # fork 로 물려받은 파일은 부모의 잠금이다
+            self._host_lock_file.close()
+            self._host_lock_file = None
+
+        temp_dir_path = app.config['TEMP_DIR_PATH']
+        if not os.access(temp_dir_path, os.F_OK):
+            os.makedirs(temp_dir_path)
+
+        lock_file = open(os.path.join(temp_dir_path, self.HOST_LOCK_FILE_NAME), 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lock_file.close()
+            return False
+
+        self._host_lock_file = lock_file
+        self._host_lock_pid = os.getpid()
+        return True
+
+    def _copy_by_backup(self, master_path, temp_file_path, refresh_config, result):
+        # 온라인 백업 API 가 있으면 step 페이지씩 복사한다
+        def progress(status, remaining, total):
+            result.step_count += 1
+
+        master_connection = sqlite3.connect(master_path)
+        temp_connection = sqlite3.connect(temp_file_path)
+        try:
+            result.snapshot_time = time.time()
+            master_connection.backup(temp_connection, pages=refresh_config['step'], progress=progress, sleep=refresh_config['sleep'])
+        finally:
+            temp_connection.close()
+            master_connection.close()
+
+    def _copy_by_rows(self, master_path, temp_file_path, refresh_config, result):
+        # 백업 API 가 없으면 읽기 트랜잭션 하나로 같은 스냅샷을 step 행씩 나눠 옮긴다
+        # WAL 마스터면 읽는 동안에도 쓰기가 막히지 않는다
+        master_connection = sqlite3.connect(master_path, isolation_level=None)
+        temp_connection = sqlite3.connect(temp_file_path)
+        try:
+            master_cursor = master_connection.cursor()
+            master_cursor.execute('BEGIN')
+            result.snapshot_time = time.time()
+            schema_rows = master_cursor.execute(
+                "SELECT type, name, sql FROM sqlite_master WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%' ORDER BY rowid").fetchall()
+
+            table_names = [name for type, name, sql in schema_rows if type == 'table']
+            for type, name, sql in schema_rows:
+                if type == 'table':
+                    temp_connection.execute(sql)
+
+            for table_name in table_names:
+                master_cursor.execute('SELECT * FROM "%s"' % table_name.replace('"', '""'))
+                while True:
+                    rows = master_cursor.fetchmany(refresh_config['step'])
+                    if not rows:
+                        break
+
+                    temp_connection.executemany('INSERT INTO "%s" VALUES (%s)' % (
+                        table_name.replace('"', '""'), ','.join('?' * len(rows[0]))), rows)
+                    temp_connection.commit()
+                    result.step_count += 1
+                    result.row_count += len(rows)
+                    if refresh_config['sleep']:
+                        time.sleep(refresh_config['sleep'])
+
+            for type, name, sql in schema_rows: # 인덱스는 행을 다 넣은 뒤에 만든다
+                if type != 'table':
+                    temp_connection.execute(sql)
+
+            temp_connection.commit()
+            master_cursor.execute('COMMIT')
+        finally:
+            temp_connection.close()
+            master_connection.close()
@@ -0,0 +1,67 @@
+# -*- coding:utf8 -*-
+import re
+
+from sqlalchemy import event
+from sqlalchemy.pool import StaticPool
+
+
+class SQLiteTuner(object):
+    "sqlite 바인딩의 새 커넥션마다 PRAGMA 프로파일을 적용한다"
+
+    PRAGMA_NAMES = ('journal_mode', 'synchronous', 'mmap_size', 'cache_size', 'busy_timeout', 'temp_store')
+    PRAGMA_VALUE_PATTERN = re.compile(r'^-?\w+$')
+
+    def __init__(self, db):
+        self.db = db
+
+        db.engine_listeners.append(self.watch_engine)
+
+    def get_profile(self, app, bind_key):
+        "SQLALCHEMY_SQLITE_PROFILE 위에 바인딩 별 SQLALCHEMY_SQLITE_PROFILES 를 덮는다"
+        profile = dict(app.config.get('SQLALCHEMY_SQLITE_PROFILE') or {})
+        profile.update((app.config.get('SQLALCHEMY_SQLITE_PROFILES') or {}).get(bind_key or 'default') or {})
+        if self.db.replica_refresher.is_replica(app, bind_key): # 파일을 통째로 바꿔 끼우는 복제본에 -wal, -shm 이 남으면 새 파일과 섞인다
+            profile['journal_mode'] = 'DELETE'
+        return profile
+
+    def get_pragma_statements(self, profile):
+        statements = []
+        for pragma_name in self.PRAGMA_NAMES:
+            pragma_value = profile.get(pragma_name)
+            if pragma_value is None:
+                continue
+
+            if not self.PRAGMA_VALUE_PATTERN.match(str(pragma_value)):
+                raise Exception('WRONG_SQLITE_PRAGMA:%s=%s' % (pragma_name, pragma_value))
+
+            statements.append('PRAGMA %s=%s' % (pragma_name, pragma_value))
+
+        return statements
+
+    def apply_options(self, app, bind_key, info, options):
+        "shared_memory 면 모든 스레드가 메모리 DB 커넥션 하나를 같이 쓴다"
+        if info.drivername != 'sqlite' or info.database not in (None, '', ':memory:'):
+            return
+
+        if self.get_profile(app, bind_key).get('shared_memory'):
+            for option_name in ('pool_size', 'max_overflow', 'pool_timeout'):
+                options.pop(option_name, None)
+
+            options['poolclass'] = StaticPool
+            options['connect_args'] = dict(options.get('connect_args') or {}, check_same_thread=False)
+
+    def watch_engine(self, app, bind_key, engine):
+        if engine.url.drivername != 'sqlite':
+            return
+
+        statements = self.get_pragma_statements(self.get_profile(app, bind_key))
+        if not statements:
+            return
+
+        def set_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for statement in statements:
+                cursor.execute(statement)
+            cursor.close()
+
+        event.listen(engine, 'connect', set_pragmas)
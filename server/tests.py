@@ -0,0 +1,976 @@
+import os
+import sys
+import json
+import shutil
+import logging
+import logging.handlers
+import tempfile
+import unittest
+import subprocess
+
+import server
+
+from server import app, db
+
+from flask import Flask
+from sqlalchemy import event
+
+from server.environments import Environments
+from server.broadcast import BroadcastHub
+from server.hashring import HashRing
+from server.ingest import BulkIngester
+from server.rebalance import ShardRebalancer
+from server.replication import _measure_sqlite_lag
+
+class HashRingTestCase(unittest.TestCase):
+    def test_stable_routing(self):
+        ring = HashRing(['master_user_01', 'master_user_02'])
+        other_ring = HashRing(['master_user_02', 'master_user_01'])
+        for index in xrange(100):
+            nickname = 'user%d' % index
+            assert ring.get_node(nickname) == other_ring.get_node(nickname)
+
+    def test_add_node_moves_few_keys(self):
+        shard_keys = ['master_user_%02d' % index for index in xrange(1, 16)]
+        ring = HashRing(shard_keys)
+        new_ring = ring.copy()
+        new_ring.add_node('master_user_16')
+
+        plan = ring.plan(new_ring)
+        assert 0.02 < plan.moved_ratio < 0.12
+        assert all(dst_node == 'master_user_16' for src_node, dst_node in plan.get_transfers())
+
+        for index in xrange(1000):
+            nickname = 'user%d' % index
+            assert plan.is_moved(nickname) == (ring.get_node(nickname) != new_ring.get_node(nickname))
+
+    def test_weights(self):
+        ring = HashRing(['master_user_01', 'master_user_02'], weights={'master_user_02': 3})
+        counts = {}
+        for index in xrange(4000):
+            node = ring.get_node(index)
+            counts[node] = counts.get(node, 0) + 1
+        assert counts['master_user_02'] > counts['master_user_01'] * 2
+
+class ShardUser(db.Model):
+    __bind_key__ = db.BindingKeyPattern('test_user_\d\d')
+
+    id = db.Column(db.Integer, primary_key=True)
+    nickname = db.Column(db.String(64), unique=True)
+
+class TempBindsTestCase(unittest.TestCase):
+    "swaps SQLALCHEMY_BINDS for sqlite test_user_NN files in a temp directory"
+
+    shard_count = 2
+    extra_binds = {}
+    config = {}
+    create_tables = True
+
+    def setUp(self):
+        self.saved_config = dict((key, app.config.get(key)) for key in ['SQLALCHEMY_BINDS'] + list(self.config))
+        self.temp_dir_path = tempfile.mkdtemp()
+        binds = dict(('test_user_%02d' % index, self.make_bind_uri('test_user_%02d' % index)) for index in xrange(1, self.shard_count + 1))
+        binds.update(self.extra_binds)
+        app.config['SQLALCHEMY_BINDS'] = binds
+        app.config.update(self.config)
+        if self.create_tables:
+            db.create_all(bind=sorted(binds))
+
+    def tearDown(self):
+        db.session.remove()
+        app.config.update(self.saved_config)
+        # a worker thread may still be closing a WAL connection, which deletes its -shm file under rmtree
+        shutil.rmtree(self.temp_dir_path, ignore_errors=True)
+
+    def make_bind_uri(self, bind_key):
+        return 'sqlite:///' + os.path.join(self.temp_dir_path, bind_key + '.db')
+
+    def count(self, bind_key):
+        return db.get_engine(app, bind=bind_key).execute('SELECT COUNT(*) FROM %s' % ShardUser.__tablename__).scalar()
+
+class FakeTwoPhaseDialect(object):
+    "lets a sqlite engine run the two-phase protocol for tests, optionally failing prepare"
+
+    METHOD_NAMES = ['do_begin_twophase', 'do_prepare_twophase', 'do_commit_twophase', 'do_rollback_twophase']
+
+    def __init__(self, engine, fail_prepare=False):
+        self.dialect = engine.dialect
+        self.fail_prepare = fail_prepare
+
+    def __enter__(self):
+        self.dialect.do_begin_twophase = lambda connection, xid: None
+        self.dialect.do_prepare_twophase = self.prepare
+        self.dialect.do_commit_twophase = lambda connection, xid, is_prepared=True, recover=False: connection.connection.commit()
+        self.dialect.do_rollback_twophase = lambda connection, xid, is_prepared=True, recover=False: connection.connection.rollback()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        for method_name in self.METHOD_NAMES:
+            del self.dialect.__dict__[method_name]
+
+    def prepare(self, connection, xid):
+        if self.fail_prepare:
+            raise ValueError('prepare failed')
+
+class BindingKeyPatternTestCase(unittest.TestCase):
+    def setUp(self):
+        self.binds = app.config['SQLALCHEMY_BINDS']
+        app.config['SQLALCHEMY_BINDS'] = {
+            'master_user_01': 'sqlite:///:memory:',
+            'master_user_02': 'sqlite:///:memory:',
+            'master_log': 'sqlite:///:memory:',
+            'test_user_01': 'sqlite:///:memory:',
+            'test_user_02': 'sqlite:///:memory:',
+        }
+
+    def tearDown(self):
+        db.session.remove()
+        app.config['SQLALCHEMY_BINDS'] = self.binds
+
+    def test_get_shard_key(self):
+        pattern = db.BindingKeyPattern('master_user_\d\d')
+        assert pattern.get_shard_keys() == ['master_user_01', 'master_user_02']
+        assert pattern.get_shard_key('jaru') in ('master_user_01', 'master_user_02')
+
+        app.config['SQLALCHEMY_BINDS'] = dict(app.config['SQLALCHEMY_BINDS'], master_user_03='sqlite:///:memory:')
+        assert pattern.get_shard_keys() == ['master_user_01', 'master_user_02', 'master_user_03']
+
+        app.config['SQLALCHEMY_BINDS']['master_user_04'] = 'sqlite:///:memory:'
+        assert pattern.get_shard_keys() == ['master_user_01', 'master_user_02', 'master_user_03', 'master_user_04']
+
+    def test_bind_cache(self):
+        mapper = db.class_mapper(ShardUser)
+        with db.binding('test_user_01'):
+            engine_01 = db.session.get_bind(mapper)
+            hit_count = db.get_bind_cache_stats()['hit_count']
+            assert db.session.get_bind(mapper) is engine_01
+            assert db.get_bind_cache_stats()['hit_count'] == hit_count + 1
+
+        with db.binding('test_user_02'):
+            engine_02 = db.session.get_bind(mapper)
+            assert engine_02 is not engine_01
+            assert engine_02 is db.get_engine(app, 'test_user_02')
+
+            # replacing a value in place is signalled explicitly
+            app.config['SQLALCHEMY_BINDS']['test_user_02'] = 'sqlite://'
+            db.invalidate_bind_cache()
+            assert db.session.get_bind(mapper) is not engine_02
+
+    def test_replica_routing(self):
+        app.config['SQLALCHEMY_REPLICAS'] = {'test_user_01': ['test_user_02']}
+        try:
+            mapper = db.class_mapper(ShardUser)
+            with db.binding('test_user_01'):
+                select_clause = db.session.query(ShardUser).statement
+                assert db.session.get_bind(mapper, select_clause) is db.get_engine(app, 'test_user_02')
+
+                # a locking read needs the master
+                locking_clause = db.session.query(ShardUser).with_for_update().statement
+                assert db.session.get_bind(mapper, locking_clause) is db.get_engine(app, 'test_user_01')
+
+                db.session.add(ShardUser(nickname='jaru'))
+                assert db.session.get_bind(mapper, select_clause) is db.get_engine(app, 'test_user_01')
+
+                db.session.expunge_all()
+                assert db.session.get_bind(mapper, select_clause) is db.get_engine(app, 'test_user_01')
+        finally:
+            app.config['SQLALCHEMY_REPLICAS'] = {}
+
+    def test_binding_keeps_session(self):
+        db.create_all(bind=['test_user_01', 'test_user_02'])
+        try:
+            with db.binding('test_user_01'):
+                db.session.add(ShardUser(id=1, nickname='keep01'))
+                db.session.commit()
+                user = ShardUser.query.get(1)
+
+            with db.binding('test_user_02'):
+                db.session.add(ShardUser(id=1, nickname='keep02'))
+                db.session.commit()
+                assert ShardUser.query.get(1).nickname == 'keep02'
+
+            with db.binding('test_user_01'):
+                assert ShardUser.query.get(1) is user
+                assert user.nickname == 'keep01'
+
+            with db.binding('test_user_01', close=True):
+                assert ShardUser.query.get(1) is user
+            assert user not in db.session
+        finally:
+            db.session.remove()
+            db.drop_all(bind=['test_user_01', 'test_user_02'])
+
+class ReplicaLagTestCase(TempBindsTestCase):
+    config = dict(SQLALCHEMY_SQLITE_PROFILES=dict(test_user_01=dict(journal_mode='WAL')))
+
+    def test_sqlite_lag_includes_wal(self):
+        master_engine = db.get_engine(app, bind='test_user_01')
+        replica_engine = db.get_engine(app, bind='test_user_02')
+        connection = master_engine.connect() # keeps the -wal file from being checkpointed away
+        connection.execute(ShardUser.__table__.insert(), dict(id=1, nickname='lag'))
+
+        master_path = master_engine.url.database
+        assert os.access(master_path + '-wal', os.F_OK)
+        os.utime(master_path, (1000, 1000))
+        os.utime(replica_engine.url.database, (1000, 1000))
+        os.utime(master_path + '-wal', (1060, 1060))
+        assert _measure_sqlite_lag(master_engine, replica_engine) == 60
+        connection.close()
+
+class ShardQueryTestCase(TempBindsTestCase):
+    shard_count = 3
+
+    def setUp(self):
+        TempBindsTestCase.setUp(self)
+        for index in xrange(30):
+            nickname = 'user%02d' % index
+            with db.binding(ShardUser.__bind_key__.get_shard_key(nickname)):
+                db.session.add(ShardUser(nickname=nickname))
+                db.session.commit()
+
+    def test_across_shards(self):
+        shard_query = db.across_shards(ShardUser)
+        assert shard_query.count() == 30
+        assert shard_query.filter(ShardUser.nickname < 'user10').count() == 10
+        assert shard_query.offset(25).count() == 5
+        assert shard_query.offset(5).limit(10).count() == 10
+        assert shard_query.offset(40).limit(10).count() == 0
+        self.assertRaises(Exception, shard_query.limit(3).sum, ShardUser.id)
+
+        nicknames = [user.nickname for user in shard_query.order_by(ShardUser.nickname.desc()).offset(5).limit(10)]
+        assert nicknames == ['user%02d' % index for index in xrange(24, 14, -1)]
+
+        assert sorted(row.nickname for row in shard_query.with_entities(ShardUser.nickname)) == ['user%02d' % index for index in xrange(30)]
+        assert shard_query.filter_by(nickname='user07').first().nickname == 'user07'
+
+class BulkIngesterTestCase(TempBindsTestCase):
+    shard_count = 3
+
+    def test_ingest_by_shard_column(self):
+        ingester = BulkIngester(db, ShardUser, batch_size=7, shard_column='nickname')
+        result = ingester.ingest(dict(nickname='user%03d' % index) for index in xrange(100))
+        assert result.row_count == 100
+        assert sum(result.bind_row_counts.itervalues()) == 100
+        assert len(result.bind_row_counts) == 3
+
+        assert db.across_shards(ShardUser).count() == 100
+        for shard_key, row_count in result.bind_row_counts.iteritems():
+            with db.binding(shard_key):
+                nicknames = [user.nickname for user in ShardUser.query]
+            assert len(nicknames) == row_count
+            assert all(ShardUser.__bind_key__.get_shard_key(nickname) == shard_key for nickname in nicknames)
+
+    def test_ingest_needs_binding(self):
+        self.assertRaises(Exception, BulkIngester(db, ShardUser).ingest, [dict(nickname='user')])
+
+    def test_ingest_missing_shard_column(self):
+        ingester = BulkIngester(db, ShardUser, shard_column='nickname')
+        try:
+            ingester.ingest([dict(id=1)])
+        except Exception as e:
+            assert str(e).startswith('MISSING_SHARD_COLUMN:nickname')
+        else:
+            assert False
+
+    def test_ingest_mixed_keys(self):
+        rows = [dict(nickname='user1'), dict(id=10, nickname='user2'), dict(id=11, nickname='user3'), dict(nickname='user4')]
+        BulkIngester(db, ShardUser, binding_key='test_user_01').ingest(rows)
+        with db.binding('test_user_01'):
+            users = dict((user.nickname, user.id) for user in ShardUser.query)
+        assert sorted(users) == ['user1', 'user2', 'user3', 'user4']
+        assert users['user2'] == 10 and users['user3'] == 11
+
+class MemoryBulkIngesterTestCase(TempBindsTestCase):
+    shard_count = 0
+    extra_binds = dict(test_user_01='sqlite:///:memory:')
+
+    def test_ingest_memory_database_inline(self):
+        result = BulkIngester(db, ShardUser, batch_size=10, binding_key='test_user_01').ingest(dict(nickname='user%03d' % index) for index in xrange(25))
+        assert result.batch_count == 3
+        assert self.count('test_user_01') == 25
+
+class PoolManagerTestCase(TempBindsTestCase):
+    config = dict(
+        SQLALCHEMY_POOLS=dict(test_user_01=dict(size=3, max_overflow=1, pre_ping=True, warmup=2)),
+        SQLALCHEMY_DATABASE_URI='sqlite:///:memory:')
+    create_tables = False
+
+    def test_prepare_pools(self):
+        warmed = dict((bind_key, connection_count) for bind_key, connection_count, elapsed in db.prepare_pools())
+        assert warmed == {None: 0, 'test_user_01': 2, 'test_user_02': 1}
+
+        stats = db.get_pool_stats()
+        assert stats['test_user_01']['pool_class'] == '_TimedQueuePool'
+        assert stats['test_user_01']['idle'] == 2
+        assert stats['test_user_01']['checked_out'] == 0
+        assert stats['test_user_02']['pool_class'] == 'NullPool'
+
+        engine = db.get_engine(app, bind='test_user_01')
+        connection = engine.connect()
+        assert connection.execute('SELECT 1').scalar() == 1
+        stats = db.get_pool_stats()['test_user_01']
+        assert stats['checked_out'] == 1
+        assert stats['checkout_count'] == 3
+        connection.close()
+
+    def test_gunicorn_post_fork(self):
+        from server.serving import GunicornServer
+
+        app.config['SERVER_WORKERS'] = 2
+        try:
+            server.env._prepare_sqlalchemy_pools()
+        finally:
+            app.config['SERVER_WORKERS'] = 0
+        db.get_engine(app, bind='test_user_01')
+        assert db.get_pool_stats()['test_user_01']['idle'] == 0 # not warmed before fork
+
+        gunicorn_server = GunicornServer(app, db, dict(workers=2, preload_app=True, backlog=64))
+        assert gunicorn_server.cfg.workers == 2
+        assert gunicorn_server.cfg.preload_app
+        assert gunicorn_server.cfg.backlog == 64
+
+        parent_pool = db.get_engine(app, bind='test_user_01').pool
+        gunicorn_server.cfg.post_fork(None, None)
+        assert db.get_engine(app, bind='test_user_01').pool is not parent_pool
+        assert db.get_pool_stats()['test_user_01']['idle'] == 2
+
+class SQLiteTunerTestCase(TempBindsTestCase):
+    shard_count = 1
+    extra_binds = dict(test_memory='sqlite:///:memory:')
+    config = dict(
+        SQLALCHEMY_SQLITE_PROFILE=dict(journal_mode='WAL', synchronous='NORMAL', busy_timeout=3000, temp_store='MEMORY'),
+        SQLALCHEMY_SQLITE_PROFILES=dict(test_memory=dict(shared_memory=True)))
+    create_tables = False
+
+    def test_pragmas(self):
+        connection = db.get_engine(app, bind='test_user_01').connect()
+        assert connection.execute('PRAGMA journal_mode').scalar() == 'wal'
+        assert connection.execute('PRAGMA synchronous').scalar() == 1
+        assert connection.execute('PRAGMA busy_timeout').scalar() == 3000
+        assert connection.execute('PRAGMA temp_store').scalar() == 2
+        connection.close()
+
+        app.config['SQLALCHEMY_SQLITE_PROFILES'] = dict(test_user_01=dict(synchronous='1; DROP TABLE x'))
+        self.assertRaises(Exception, db.sqlite_tuner.get_pragma_statements, db.sqlite_tuner.get_profile(app, 'test_user_01'))
+
+    def test_shared_memory(self):
+        engine = db.get_engine(app, bind='test_memory')
+        engine.execute('CREATE TABLE shared (id INTEGER)')
+        engine.execute('INSERT INTO shared VALUES (1)')
+        assert db.get_worker_pool().apply(lambda: engine.execute('SELECT COUNT(*) FROM shared').scalar()) == 1
+
+class EnvironmentsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.project_dir_path = tempfile.mkdtemp()
+        self.config_file_path = os.path.join(self.project_dir_path, 'test.yml')
+        with open(self.config_file_path, 'w') as config_file:
+            config_file.write("SQLALCHEMY_DATABASE_URI: 'sqlite:///./temp/test.db'\nSQLALCHEMY_BINDS: {log: 'sqlite:///./temp/log.db'}\nSQLALCHEMY_ECHO: off\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.project_dir_path)
+
+    def make_environments(self):
+        return Environments(Flask(__name__), os.path.join(self.project_dir_path, 'server'))
+
+    def test_config_snapshot(self):
+        env = self.make_environments()
+        env.load_config_file('test.yml')
+        assert not env.loaded_config_snapshot
+        assert env.app.config['SQLALCHEMY_BINDS']['log'] == 'sqlite:///' + os.path.join(self.project_dir_path, 'temp', 'log.db')
+        assert env.app.config['SQLALCHEMY_ECHO'] is False
+
+        env = self.make_environments()
+        env.load_config_file('test.yml')
+        assert env.loaded_config_snapshot
+        assert env.app.config['SQLALCHEMY_DATABASE_URI'] == 'sqlite:///' + os.path.join(self.project_dir_path, 'temp', 'test.db')
+
+        os.utime(self.config_file_path, (0, 0))
+        env = self.make_environments()
+        env.load_config_file('test.yml')
+        assert env.loaded_config_snapshot
+
+        with open(self.config_file_path, 'a') as config_file:
+            config_file.write("SQLALCHEMY_WORKER_POOL_SIZE: 4\n")
+        env = self.make_environments()
+        env.load_config_file('test.yml')
+        assert not env.loaded_config_snapshot
+        assert env.app.config['SQLALCHEMY_WORKER_POOL_SIZE'] == 4
+
+        # same size and mtime, different content
+        config_stat = os.stat(self.config_file_path)
+        with open(self.config_file_path, 'r+') as config_file:
+            config_file.seek(-2, os.SEEK_END)
+            config_file.write('8\n')
+        os.utime(self.config_file_path, (config_stat.st_atime, config_stat.st_mtime))
+        env = self.make_environments()
+        env.load_config_file('test.yml')
+        assert not env.loaded_config_snapshot
+        assert env.app.config['SQLALCHEMY_WORKER_POOL_SIZE'] == 8
+
+    def test_memory_cache_with_workers(self):
+        from server.cache import make_cache_backend
+        env = self.make_environments()
+        env.load_config_dict(dict(USER_CACHE_ENABLE=True, USER_CACHE_TYPE='memory', PAGE_CACHE_ENABLE=False, SERVER_WORKERS=1))
+        env._validate_cache_backends()
+        assert make_cache_backend(env.app.config, 'USER_CACHE').max_size == env.app.config['USER_CACHE_SIZE']
+
+        # several workers turn the memory cache off instead of refusing to start
+        env.app.config['SERVER_WORKERS'] = 4
+        self.assertRaises(Exception, make_cache_backend, env.app.config, 'USER_CACHE')
+        env._validate_cache_backends()
+        assert not env.app.config['USER_CACHE_ENABLE']
+
+        env.app.config.update(USER_CACHE_ENABLE=True, USER_CACHE_TYPE='redis')
+        env._validate_cache_backends()
+        assert env.app.config['USER_CACHE_ENABLE']
+
+    def test_validate_config(self):
+        env = self.make_environments()
+        self.assertRaises(Exception, env.load_config_dict, dict(SQLALCHEMY_BINDS=['log']))
+        self.assertRaises(Exception, env.load_config_dict, dict(SQLALCHEMY_WORKER_POOL_SIZE=True))
+        self.assertRaises(Exception, env.load_config_dict, ['SQLALCHEMY_ECHO'])
+        env.load_config_dict(dict(SQLALCHEMY_REPLICA_MAX_LAG=0.5, SECRET_KEY='key'))
+
+class QueueLogHandlerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir_path = tempfile.mkdtemp()
+        self.log_file_path = os.path.join(self.temp_dir_path, 'queue.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir_path)
+
+    def make_record(self, msg):
+        return logging.makeLogRecord(dict(name=__name__, levelno=logging.INFO, levelname='INFO', msg=msg))
+
+    def test_writer_restarts_after_fork(self):
+        from server.logqueue import QueueLogHandler
+
+        file_handler = logging.handlers.RotatingFileHandler(self.log_file_path)
+        handler = QueueLogHandler([file_handler], max_size=100, batch_size=10)
+        handler.emit(self.make_record('parent before fork'))
+
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 1
+            try:
+                handler.emit(self.make_record('child'))
+                handler.close()
+                exit_code = 0
+            finally:
+                os._exit(exit_code)
+
+        assert os.waitpid(pid, 0)[1] == 0
+        handler.emit(self.make_record('parent after fork'))
+        handler.close()
+
+        with open(self.log_file_path) as log_file:
+            assert sorted(log_file.read().splitlines()) == ['child', 'parent after fork', 'parent before fork']
+
+    def test_unicode_record(self):
+        from server.logqueue import QueueLogHandler
+
+        file_handler = logging.handlers.RotatingFileHandler(self.log_file_path)
+        handler = QueueLogHandler([file_handler], max_size=100, batch_size=10)
+        handler.emit(logging.makeLogRecord(dict(name=__name__, levelno=logging.INFO, levelname='INFO', msg=u'\uc0ac\uc6a9\uc790 %s', args=(u'\uc790\ub8e8',))))
+        handler.close()
+
+        with open(self.log_file_path) as log_file:
+            assert log_file.read().decode('utf8') == u'\uc0ac\uc6a9\uc790 \uc790\ub8e8\n'
+
+class ParallelDDLTestCase(TempBindsTestCase):
+    shard_count = 3
+    create_tables = False
+
+    def test_create_and_create_missing(self):
+        bind_keys = sorted(app.config['SQLALCHEMY_BINDS'])
+        results = db.create_all(bind=bind_keys)
+        assert sorted(bind_key for bind_key, table_count, elapsed, created_names in results) == bind_keys
+        assert all(table_count == len(db.get_tables_for_bind(bind_key)) for bind_key, table_count, elapsed, created_names in results)
+
+        engine = db.get_engine(app, bind='test_user_02')
+        engine.execute('DROP TABLE shard_user')
+        results = dict((bind_key, created_names) for bind_key, table_count, elapsed, created_names in db.create_missing(bind=bind_keys))
+        assert results == dict(test_user_01=[], test_user_02=['shard_user'], test_user_03=[])
+        assert db.create_missing(bind='test_user_02')[0][3] == []
+
+    def test_tables_for_bind_index(self):
+        tables = db.get_tables_for_bind('test_user_01')
+        assert ShardUser.__table__ in tables
+        tables.remove(ShardUser.__table__)
+        assert ShardUser.__table__ in db.get_tables_for_bind('test_user_01')
+
+        table = db.Table('ddl_test_table', db.Column('id', db.Integer, primary_key=True), info=dict(bind_key=ShardUser.__bind_key__))
+        assert table in db.get_tables_for_bind('test_user_01')
+        assert table not in db.get_tables_for_bind(None)
+        db.Model.metadata.remove(table)
+
+        # same table count, different table
+        other_table = db.Table('ddl_other_table', db.Column('id', db.Integer, primary_key=True), info=dict(bind_key=ShardUser.__bind_key__))
+        assert table not in db.get_tables_for_bind('test_user_01')
+        assert other_table in db.get_tables_for_bind('test_user_01')
+        db.Model.metadata.remove(other_table)
+
+class SQLiteReplicaRefresherTestCase(TempBindsTestCase):
+    config = dict(
+        SQLALCHEMY_REPLICAS={'test_user_01': ['test_user_02']},
+        SQLALCHEMY_REPLICA_REFRESH=dict(step=16, sleep=0),
+        SQLALCHEMY_SQLITE_PROFILES={},
+        SQLALCHEMY_POOLS=dict(test_user_02=dict(size=2, max_overflow=2)))
+
+    def test_refresh(self):
+        master_engine = db.get_engine(app, bind='test_user_01')
+        replica_engine = db.get_engine(app, bind='test_user_02')
+        master_engine.execute(ShardUser.__table__.insert(), [dict(id=index + 1, nickname='user%03d' % index) for index in xrange(100)])
+        assert replica_engine.execute('SELECT COUNT(*) FROM %s' % ShardUser.__tablename__).scalar() == 0
+
+        results = db.refresh_replicas()
+        assert [(result.master_key, result.replica_key, result.row_count) for result in results] == [('test_user_01', 'test_user_02', 100)]
+        assert replica_engine.execute('SELECT COUNT(*) FROM %s' % ShardUser.__tablename__).scalar() == 100
+        assert 0 <= db.get_replica_ages()['test_user_02'] < 10
+        assert db.check_replicas()['test_user_01']['test_user_02'] < 10
+        assert not [name for name in os.listdir(self.temp_dir_path) if '.refresh.' in name]
+
+        app.config['SQLALCHEMY_SQLITE_PROFILES'] = dict(test_user_02=dict(journal_mode='WAL'))
+        connection = replica_engine.connect()
+        master_engine.execute(ShardUser.__table__.delete().where(ShardUser.id > 50))
+        assert db.refresh_replicas()[0].row_count == 50
+        assert connection.execute('SELECT COUNT(*) FROM %s' % ShardUser.__tablename__).scalar() == 100
+        connection.close()
+
+        assert replica_engine.execute('PRAGMA journal_mode').scalar() == 'delete'
+        assert not os.access(self.make_bind_uri('test_user_02')[len('sqlite:///'):] + '-wal', os.F_OK)
+        assert self.count('test_user_02') == 50
+
+    def test_reconnect_after_swap_by_other_process(self):
+        replica_engine = db.get_engine(app, bind='test_user_02')
+        assert replica_engine.execute('SELECT COUNT(*) FROM %s' % ShardUser.__tablename__).scalar() == 0
+        assert replica_engine.pool.checkedin() == 1
+
+        # swap the file behind the pooled connection, as a refresher in another worker would
+        db.get_engine(app, bind='test_user_01').execute(ShardUser.__table__.insert(), dict(id=1, nickname='user'))
+        replica_path = self.make_bind_uri('test_user_02')[len('sqlite:///'):]
+        shutil.copy(self.make_bind_uri('test_user_01')[len('sqlite:///'):], replica_path + '.swap')
+        os.rename(replica_path + '.swap', replica_path)
+        assert replica_engine.execute('SELECT COUNT(*) FROM %s' % ShardUser.__tablename__).scalar() == 1
+
+    def test_host_lock(self):
+        from server.sqlitereplica import SQLiteReplicaRefresher
+        saved_temp_dir_path = app.config['TEMP_DIR_PATH']
+        app.config['TEMP_DIR_PATH'] = self.temp_dir_path
+        try:
+            refresher = SQLiteReplicaRefresher(db)
+            other_refresher = SQLiteReplicaRefresher(db)
+            assert refresher._acquire_host_lock(app)
+            assert refresher._acquire_host_lock(app)
+            assert not other_refresher._acquire_host_lock(app)
+
+            refresher._host_lock_file.close()
+            assert other_refresher._acquire_host_lock(app)
+            other_refresher._host_lock_file.close()
+        finally:
+            app.config['TEMP_DIR_PATH'] = saved_temp_dir_path
+            db.engine_listeners.remove(refresher.watch_engine)
+            db.engine_listeners.remove(other_refresher.watch_engine)
+
+class QueryCacheTestCase(TempBindsTestCase):
+    config = dict(QUERY_CACHE_ENABLE=True, QUERY_CACHE_TYPE='memory', SERVER_WORKERS=0)
+
+    def setUp(self):
+        TempBindsTestCase.setUp(self)
+        for binding_key in sorted(app.config['SQLALCHEMY_BINDS']):
+            db.get_engine(app, bind=binding_key).execute(ShardUser.__table__.insert(), dict(id=1, nickname='cache_' + binding_key))
+
+    def get_nickname(self, binding_key):
+        with db.binding(binding_key):
+            return ShardUser.query.filter_by(id=1).cache().first().nickname
+
+    def test_cache_per_binding(self):
+        assert self.get_nickname('test_user_01') == 'cache_test_user_01'
+        hit_count = db.get_query_cache_stats()['hit_count']
+        assert self.get_nickname('test_user_01') == 'cache_test_user_01'
+        assert db.get_query_cache_stats()['hit_count'] > hit_count
+        assert self.get_nickname('test_user_02') == 'cache_test_user_02'
+
+    def test_invalidate_on_write(self):
+        assert self.get_nickname('test_user_01') == 'cache_test_user_01'
+        db.get_engine(app, bind='test_user_01').execute(ShardUser.__table__.update().values(nickname='engine'))
+        assert self.get_nickname('test_user_01') == 'engine'
+
+        with db.binding('test_user_01'):
+            user = ShardUser.query.get(1)
+            user.nickname = 'session'
+            db.session.commit()
+        assert self.get_nickname('test_user_01') == 'session'
+        assert self.get_nickname('test_user_02') == 'cache_test_user_02'
+
+    def test_invalidate_on_two_phase_commit(self):
+        assert self.get_nickname('test_user_01') == 'cache_test_user_01'
+        assert self.get_nickname('test_user_02') == 'cache_test_user_02'
+        db.session.remove()
+        with FakeTwoPhaseDialect(db.get_engine(app, bind='test_user_01')):
+            with FakeTwoPhaseDialect(db.get_engine(app, bind='test_user_02')):
+                with db.unit_of_work(two_phase=True):
+                    for binding_key in ['test_user_01', 'test_user_02']:
+                        with db.binding(binding_key):
+                            ShardUser.query.get(1).nickname = 'two_phase'
+                            db.session.commit()
+
+                    # another session caches the old row between the write and the commit
+                    session = db.create_session()
+                    session.push_binding('test_user_01')
+                    assert session.query(ShardUser).filter_by(id=1).cache().first().nickname == 'cache_test_user_01'
+                    session.close()
+
+        assert self.get_nickname('test_user_01') == 'two_phase'
+        assert self.get_nickname('test_user_02') == 'two_phase'
+
+    def test_memory_backend_with_workers(self):
+        backend, db.query_cache.backend = db.query_cache.backend, None
+        try:
+            # prepare_all turns the memory cache off and queries run uncached
+            app.config['SERVER_WORKERS'] = 2
+            server.env._validate_cache_backends()
+            assert not app.config['QUERY_CACHE_ENABLE']
+            assert self.get_nickname('test_user_01') == 'cache_test_user_01'
+            assert db.query_cache.backend is None
+        finally:
+            db.query_cache.backend = backend
+
+class UnitOfWorkTestCase(TempBindsTestCase):
+    config = dict(SQLALCHEMY_POOLS=dict(test_user_01=dict(size=2)))
+
+    def setUp(self):
+        TempBindsTestCase.setUp(self)
+        self.commits = []
+        db.commit_listeners.append(self.on_commit)
+
+    def tearDown(self):
+        db.commit_listeners.remove(self.on_commit)
+        TempBindsTestCase.tearDown(self)
+
+    def on_commit(self, session, changes):
+        self.commits.append(len(changes))
+
+    def add_users(self):
+        for index, binding_key in enumerate(sorted(app.config['SQLALCHEMY_BINDS'])):
+            with db.binding(binding_key):
+                db.session.add(ShardUser(id=index + 1, nickname='uow%02d' % index))
+                db.session.commit()
+
+    def test_grouped_commit(self):
+        with db.unit_of_work():
+            self.add_users()
+            assert self.count('test_user_01') == 0
+            assert self.count('test_user_02') == 0
+
+        assert self.count('test_user_01') == 1
+        assert self.count('test_user_02') == 1
+        assert self.commits == [2]
+
+    def test_rollback(self):
+        def fail():
+            with db.unit_of_work():
+                self.add_users()
+                raise ValueError()
+
+        self.assertRaises(ValueError, fail)
+        assert self.count('test_user_01') == 0
+        assert self.count('test_user_02') == 0
+        assert self.commits == []
+
+        with db.unit_of_work(two_phase=True):
+            pass
+        assert not db.session().twophase
+
+    def test_partial_commit(self):
+        def fail_commit(connection):
+            raise ValueError('commit failed')
+
+        engine = db.get_engine(app, bind='test_user_02')
+        event.listen(engine, 'commit', fail_commit)
+        try:
+            def commit():
+                with db.unit_of_work(parallel=False):
+                    self.add_users()
+            self.assertRaises(Exception, commit)
+        finally:
+            event.remove(engine, 'commit', fail_commit)
+
+        assert self.count('test_user_01') == 1
+        assert self.count('test_user_02') == 0
+        assert self.commits == [1] # only the committed bind's change
+
+    def test_failed_prepare(self):
+        def commit():
+            with db.unit_of_work(two_phase=True):
+                self.add_users()
+
+        with FakeTwoPhaseDialect(db.get_engine(app, bind='test_user_01')):
+            with FakeTwoPhaseDialect(db.get_engine(app, bind='test_user_02'), fail_prepare=True):
+                self.assertRaises(ValueError, commit)
+
+        assert self.count('test_user_01') == 0
+        assert self.count('test_user_02') == 0
+        assert self.commits == []
+
+    def test_binding_close_in_unit_of_work(self):
+        def close_binding():
+            with db.binding('test_user_01', close=True):
+                pass
+
+        def fail_in_binding():
+            with db.binding('test_user_02'):
+                db.session.add(ShardUser(id=2, nickname='uow01'))
+                raise ValueError()
+
+        with db.unit_of_work():
+            self.assertRaises(Exception, close_binding)
+            with db.binding('test_user_01'):
+                db.session.add(ShardUser(id=3, nickname='uow03'))
+                db.session.commit()
+            self.assertRaises(ValueError, fail_in_binding) # rolls back the unit so far, like closing did
+            with db.binding('test_user_01'):
+                db.session.add(ShardUser(id=1, nickname='uow00'))
+                db.session.commit()
+
+        assert [user.id for user in db.across_shards(ShardUser).all()] == [1]
+
+    def test_switch_skips_static_sessions(self):
+        self.add_users()
+        session = db.session()
+        session.close()
+        assert not session._has_dynamic_instances
+        with db.binding('test_user_01'):
+            user = ShardUser.query.get(1)
+        assert session._has_dynamic_instances
+        with db.binding('test_user_02'):
+            assert ShardUser.query.get(1) is None
+        with db.binding('test_user_01'):
+            assert ShardUser.query.get(1) is user
+        session.close()
+        with db.binding('test_user_01'):
+            pass
+        assert not session._has_dynamic_instances
+
+class ShardRebalancerTestCase(TempBindsTestCase):
+    config = dict(SQLALCHEMY_SHARD_PREVIOUS_WEIGHTS={})
+
+    def setUp(self):
+        TempBindsTestCase.setUp(self)
+        BulkIngester(db, ShardUser, shard_column='nickname').ingest(dict(id=index + 1, nickname='user%03d' % index) for index in xrange(200))
+
+    def add_third_shard(self, checkpoint_path=None):
+        app.config['SQLALCHEMY_SHARD_PREVIOUS_WEIGHTS'] = dict(test_user_01=1, test_user_02=1)
+        app.config['SQLALCHEMY_BINDS'] = dict(app.config['SQLALCHEMY_BINDS'], test_user_03=self.make_bind_uri('test_user_03'))
+        db.create_all(bind='test_user_03')
+        return ShardRebalancer(db, ShardUser, 'nickname', batch_size=16, checkpoint_path=checkpoint_path)
+
+    def test_add_shard(self):
+        checkpoint_path = os.path.join(self.temp_dir_path, 'rebalance.json')
+        rebalancer = self.add_third_shard(checkpoint_path)
+        moving_nickname = next(nickname for nickname in ('user%03d' % index for index in xrange(200)) if ShardUser.__bind_key__.get_shard_key(nickname) == 'test_user_03')
+        assert db.dual_read(ShardUser, moving_nickname, lambda: ShardUser.query.filter_by(nickname=moving_nickname).first()).nickname == moving_nickname
+
+        planned_count = sum(rebalancer.plan().itervalues())
+        assert planned_count > 0
+        assert all(target_key == 'test_user_03' for source_key, target_key in rebalancer.plan())
+
+        result = rebalancer.run()
+        assert result.moved_count == planned_count
+        assert result.scanned_count == 200 + planned_count
+        assert not os.access(checkpoint_path, os.R_OK)
+
+        counts = rebalancer.count()
+        assert sum(row_count for row_count, misplaced_count in counts.itervalues()) == 200
+        assert all(misplaced_count == 0 for row_count, misplaced_count in counts.itervalues())
+        assert db.dual_read(ShardUser, moving_nickname, lambda: ShardUser.query.filter_by(nickname=moving_nickname).first()).nickname == moving_nickname
+        assert rebalancer.run().moved_count == 0
+
+    def test_conflict_before_moving(self):
+        rebalancer = self.add_third_shard()
+        source_key, moving_row = next((source_key, dict(row)) for source_key in ['test_user_01', 'test_user_02']
+            for row in db.get_engine(app, bind=source_key).execute(ShardUser.__table__.select())
+            if ShardUser.__bind_key__.get_shard_key(row['nickname']) == 'test_user_03')
+        db.get_engine(app, bind='test_user_03').execute(ShardUser.__table__.insert(), id=moving_row['id'], nickname='other')
+
+        counts = rebalancer.count()
+        self.assertRaises(Exception, rebalancer.plan)
+        self.assertRaises(Exception, rebalancer.run)
+        assert rebalancer.count() == counts
+
+    def test_delete_unchanged_rows(self):
+        rebalancer = ShardRebalancer(db, ShardUser, 'nickname')
+        engine = db.get_engine(app, bind='test_user_01')
+        rows = [dict(row) for row in engine.execute(ShardUser.__table__.select().order_by(ShardUser.id).limit(3))]
+        engine.execute(ShardUser.__table__.update().where(ShardUser.id == rows[0]['id']).values(nickname=None))
+        assert rebalancer._delete_unchanged_rows(engine, rows) == 2
+        assert engine.execute(ShardUser.__table__.select().where(ShardUser.id.in_([row['id'] for row in rows]))).fetchall() == [(rows[0]['id'], None)]
+
+        rows[0]['nickname'] = None
+        assert rebalancer._delete_unchanged_rows(engine, rows[:1]) == 1
+
+class FakeWebSocket(object):
+    def __init__(self, received=()):
+        self.sent = []
+        self.received = list(received)
+        self.closed = False
+
+    def receive(self):
+        return self.received.pop(0) if self.received else None
+
+    def send(self, payload):
+        self.sent.append(payload)
+
+    def close(self):
+        self.closed = True
+
+class SQLProfilerTestCase(TempBindsTestCase):
+    shard_count = 1
+    config = dict(SQLALCHEMY_PROFILE=True, SQLALCHEMY_PROFILE_REPEAT_THRESHOLD=3, SQLALCHEMY_PROFILE_DUMP_INTERVAL=0)
+
+    def setUp(self):
+        TempBindsTestCase.setUp(self)
+        self.saved_config['TEMP_DIR_PATH'] = app.config['TEMP_DIR_PATH']
+        app.config['TEMP_DIR_PATH'] = self.temp_dir_path
+        server.sql_profiler.reports.clear()
+
+    def test_statement_shape(self):
+        from server.profiler import _get_statement_shape
+        assert _get_statement_shape('SELECT *\n  FROM user WHERE id IN (?, ?, ?)') == 'SELECT * FROM user WHERE id IN (?)'
+        assert _get_statement_shape('SELECT * FROM user WHERE id IN (:id_1,:id_2)') == 'SELECT * FROM user WHERE id IN (?)'
+
+    def test_header_and_dump(self):
+        engine = db.get_engine(app, bind='test_user_01')
+        with app.test_request_context('/profiled'):
+            server.sql_profiler._begin_request()
+            for index in xrange(3):
+                engine.execute('SELECT COUNT(*) FROM %s WHERE id IN (%s)' % (ShardUser.__tablename__, ','.join('?' * (index + 1))), *range(index + 1))
+            response = server.sql_profiler._end_request(app.response_class())
+
+        header_value = response.headers[server.sql_profiler.HEADER_NAME]
+        assert header_value.startswith('test_user_01=3q/')
+        assert header_value.endswith('; repeated=1')
+
+        report_file_path = server.sql_profiler.dump(app)
+        assert os.path.basename(report_file_path) == 'sql_profile.%d.json' % os.getpid()
+        report, = server.sql_profiler.load_dumps(self.temp_dir_path)
+        assert report['request_count'] == 1
+        assert report['binds']['test_user_01']['count'] == 3
+        assert report['repeated'].values() == [3]
+
+    def test_failed_execute_pops_start_time(self):
+        connection = db.get_engine(app, bind='test_user_01').connect()
+        try:
+            self.assertRaises(Exception, connection.execute, 'SELECT * FROM missing_table')
+            assert connection.info.get('_sql_profile_start_times') == []
+        finally:
+            connection.close()
+
+class BenchTestCase(unittest.TestCase):
+    def test_bench_result(self):
+        from server.bench import BenchResult
+        result = BenchResult('sample', [0.1] + [0.001] * 99)
+        assert result.iterations == 100
+        assert abs(result.ops_per_sec - 100 / 0.199) < 0.001
+        assert abs(result.p50_us - 1000) < 0.001
+        assert abs(result.p99_us - 100000) < 0.001
+        assert BenchResult('zero', [0.0, 0.0]).ops_per_sec == 0.0
+
+    def test_bench_suite(self):
+        from server.bench import BenchSuite, save_results, load_results
+        reported = []
+        results = BenchSuite(server, iterations=50, batch_size=5).run('get_shard_key', reported.append)
+        assert [result.name for result in results] == ['get_shard_key']
+        assert reported == results
+        assert results[0].iterations == 50
+        assert results[0].ops_per_sec > 0
+
+        temp_dir_path = tempfile.mkdtemp()
+        try:
+            result_file_path = os.path.join(temp_dir_path, 'bench.json')
+            save_results(results, result_file_path)
+            assert load_results(result_file_path) == dict(get_shard_key=results[0].to_dict())
+        finally:
+            shutil.rmtree(temp_dir_path)
+
+    def test_bench_suite_restores_blog_database(self):
+        from server.bench import BenchSuite
+        database_uri = app.config['SQLALCHEMY_DATABASE_URI']
+        results = BenchSuite(server, iterations=20, batch_size=5).run('make_unique_nickname')
+        assert results[0].iterations == 20
+        assert app.config['SQLALCHEMY_DATABASE_URI'] == database_uri
+
+class ManageTestCase(unittest.TestCase):
+    def run_python(self, source):
+        project_dir_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+        process = subprocess.Popen([sys.executable, '-c', source], cwd=project_dir_path, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        assert process.returncode == 0, output
+        return output
+
+    def test_import_profile_without_server(self):
+        output = self.run_python(
+            "import sys, manage\n"
+            "manage.main('manage.py', ['import_profile', '-n', '3', 'xml.dom.minidom'])\n"
+            "assert manage.server is None and 'server' not in sys.modules\n")
+        lines = output.splitlines()
+        assert lines[0] == '#### import profile: xml.dom.minidom'
+        assert lines[1].startswith('* xml.dom.minidom ')
+        assert len(lines) == 5 and lines[-1].startswith('* total: ')
+
+    def test_import_server_on_demand(self):
+        self.run_python(
+            "import sys, manage\n"
+            "assert 'server' not in sys.modules\n"
+            "assert manage.import_server() is sys.modules['server'] is manage.server\n")
+
+class BroadcastHubTestCase(unittest.TestCase):
+    def test_publish_serializes_once(self):
+        import gevent
+        hub = BroadcastHub()
+        first_ws, second_ws = FakeWebSocket(), FakeWebSocket()
+        hub.connect(first_ws, ['notice'])
+        hub.connect(second_ws, ['notice', 'chat'])
+        assert hub.publish('notice', dict(msg='hello')) == 2
+        assert hub.publish('chat', dict(msg='hi')) == 1
+        assert hub.publish('empty', dict(msg='nobody')) == 0
+        gevent.sleep(0)
+        assert first_ws.sent[0] is second_ws.sent[0]
+        assert len(second_ws.sent) == 2
+
+        metrics = hub.get_metrics()
+        assert metrics['connections'] == 2
+        assert metrics['channels'] == dict(notice=2, chat=1)
+        assert metrics['sent_count'] == 3
+
+    def test_slow_subscribers(self):
+        hub = BroadcastHub(queue_size=2, policy=BroadcastHub.POLICY_COALESCE)
+        subscriber = hub.connect(FakeWebSocket(), ['notice', 'chat'])
+        for index in xrange(3):
+            hub.publish('notice', index)
+        hub.publish('chat', 'hi')
+        assert [json.loads(payload) for channel, payload in subscriber.pending] == [dict(channel='notice', data=2), dict(channel='chat', data='hi')]
+        assert hub.get_metrics()['queue_depth_max'] == 2
+        assert hub.get_metrics()['coalesced_count'] == 2
+        hub.disconnect(subscriber)
+        assert hub.get_metrics()['coalesced_count'] == 2
+
+        hub = BroadcastHub(queue_size=2, policy=BroadcastHub.POLICY_DROP)
+        ws = FakeWebSocket()
+        hub.connect(ws, ['notice'])
+        for index in xrange(3):
+            hub.publish('notice', index)
+        assert ws.closed
+        assert hub.get_metrics()['connections'] == 0
+        assert hub.get_metrics()['dropped_subscriber_count'] == 1
+
+    def test_serve_ignores_non_string_channels(self):
+        hub = BroadcastHub()
+        channels = []
+        hub.subscribe = lambda subscriber, channel: channels.append(channel)
+        ws = FakeWebSocket(['{"subscribe": ["notice"]}', '{"subscribe": {"a": 1}}', '{"unsubscribe": ["notice"]}', '{"subscribe": "chat"}'])
+        hub.serve(ws)
+        assert channels == [u'chat']
+        assert hub.get_metrics()['connections'] == 0
+
+if __name__ == '__main__':
+    unittest.main()
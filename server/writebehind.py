@@ -0,0 +1,108 @@
+# -*- coding:utf8 -*-
+import atexit
+import logging
+import threading
+
+from sqlalchemy import bindparam
+
+
+class WriteBehindBuffer(object):
+    "컬럼 하나의 최신 값을 기본 키 별로 모아 두었다가 한 번에 UPDATE 한다"
+
+    DEFAULT_FLUSH_INTERVAL = 10
+    DEFAULT_FLUSH_SIZE = 500
+
+    def __init__(self, db, model, column_name, config_prefix=None):
+        self.db = db
+        self.model = model
+        self.column_name = column_name
+        self.config_prefix = config_prefix
+        self.flush_interval = self.DEFAULT_FLUSH_INTERVAL
+        self.flush_size = self.DEFAULT_FLUSH_SIZE
+        self.flushed_count = 0
+        self.flush_listeners = [] # 쓴 기본 키 목록을 받는다 (커밋 리스너를 지나지 않으므로 캐시는 여기서 지운다)
+
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._wake_event = threading.Event()
+        self._flush_thread = None
+        self._closed = False
+
+    def __repr__(self):
+        return "%s<%s.%s pending=%d>" % (self.__class__.__name__, self.model.__name__, self.column_name, len(self._entries))
+
+    def touch(self, primary_key, value):
+        with self._lock:
+            self._entries[primary_key] = value
+            entry_count = len(self._entries)
+
+        if self._flush_thread is None:
+            self._start()
+
+        if entry_count >= self.flush_size:
+            self._wake_event.set()
+
+    def flush(self):
+        with self._lock:
+            entries, self._entries = self._entries, {}
+
+        if not entries:
+            return 0
+
+        table = self.model.__table__
+        bind_key = table.info.get('bind_key')
+        if hasattr(bind_key, 'get_shard_keys'):
+            raise Exception('NOT_SUPPORTED_SHARDED_WRITE_BEHIND:%s' % self.model.__name__)
+
+        primary_key_column = list(table.primary_key.columns)[0]
+        statement = table.update().where(primary_key_column == bindparam('_primary_key')).values({self.column_name: bindparam('_value')})
+
+        engine = self.db.get_engine(self.db.get_app(), bind=bind_key)
+        try:
+            with engine.begin() as connection:
+                connection.execute(statement, [dict(_primary_key=primary_key, _value=value) for primary_key, value in entries.iteritems()])
+        except Exception:
+            with self._lock: # 실패하면 더 새로운 값이 없는 항목만 되돌린다
+                for primary_key, value in entries.iteritems():
+                    self._entries.setdefault(primary_key, value)
+            raise
+
+        self.flushed_count += len(entries)
+        for flush_listener in self.flush_listeners:
+            flush_listener(entries.keys())
+
+        return len(entries)
+
+    def close(self):
+        "남은 값을 모두 쓰고 스레드를 멈춘다"
+        self._closed = True
+        self._wake_event.set()
+        if self._flush_thread:
+            self._flush_thread.join()
+            self._flush_thread = None
+
+        self.flush()
+
+    def _start(self):
+        with self._lock:
+            if self._flush_thread is not None:
+                return
+
+            if self.config_prefix:
+                config = self.db.get_app().config
+                self.flush_interval = config.get(self.config_prefix + '_FLUSH_INTERVAL', self.flush_interval)
+                self.flush_size = config.get(self.config_prefix + '_FLUSH_SIZE', self.flush_size)
+
+            self._flush_thread = threading.Thread(target=self._run, name='write-behind-%s' % self.model.__name__)
+            self._flush_thread.daemon = True
+            self._flush_thread.start()
+            atexit.register(self.close)
+
+    def _run(self):
+        while not self._closed:
+            self._wake_event.wait(self.flush_interval)
+            self._wake_event.clear()
+            try:
+                self.flush()
+            except Exception:
+                logging.getLogger(__name__).exception('WRITE_BEHIND_FLUSH_FAILED:%s', self.model.__name__)